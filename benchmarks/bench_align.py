@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark the per-multiply overhead of index alignment.
+
+Multiplies every pair of CPTs in the lungcancer network that share at least
+one variable, once with the states in network order (alignment is a no-op)
+and once with the states of every CPT reversed (alignment needs a
+`numpy.take` per axis).
+
+Usage:
+    python benchmarks/bench_align.py [repeat]
+"""
+import sys
+import timeit
+import itertools
+
+import thomas.core
+from thomas.core import examples
+from thomas.core.factor import Factor
+
+
+def reversed_states(factor):
+    """Return a copy of `factor` with the states of every variable reversed."""
+    target = Factor(1, {RV: states[::-1] for RV, states in factor.states.items()})
+    return factor.align_index(target)
+
+
+def run(repeat=5, number=20):
+    bn = examples.get_lungcancer_network()
+    CPTs = [node.cpt.as_factor() for node in bn.nodes.values()]
+    CPTs_reversed = [reversed_states(f) for f in CPTs]
+
+    pairs = [
+        (i, j) for i, j in itertools.combinations(range(len(CPTs)), 2)
+        if CPTs[i].vars.intersection(CPTs[j].vars)
+    ]
+
+    def multiply(first, second):
+        for i, j in pairs:
+            first[i] * second[j]
+
+    cases = {
+        'aligned': lambda: multiply(CPTs, CPTs),
+        'reordered': lambda: multiply(CPTs, CPTs_reversed),
+    }
+
+    print(f'{len(pairs)} pairs of CPTs with overlapping scope')
+
+    for name, func in cases.items():
+        timings = timeit.repeat(func, repeat=repeat, number=number)
+        per_multiply = min(timings) / number / len(pairs) * 1e6
+        print(f'  {name:<10} {per_multiply:8.1f} µs per multiply')
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    run(repeat)
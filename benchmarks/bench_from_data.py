@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark counting data with Factor.from_data().
+
+Compares the (integer coded) bincount implementation with the previous
+implementation that used `DataFrame.groupby()` and a MultiIndex.
+
+Usage:
+    python benchmarks/bench_from_data.py [rows]
+"""
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from thomas.core import examples
+from thomas.core.factor import Factor
+
+
+def from_data_groupby(df, cols, states, complete_value=0):
+    """Previous implementation of Factor.from_data()."""
+    counts = df[cols].groupby(cols).size()
+    total = Factor(complete_value, states).as_series() + counts
+    values = np.nan_to_num(total.values, nan=complete_value)
+    return Factor(values, states=states)
+
+
+def run(rows=1000000, repeat=3):
+    bn = examples.get_lungcancer_network()
+    rng = np.random.default_rng(0)
+
+    cols = ['T', 'N', 'M', 'death']
+    # The groupby implementation only labels values correctly if the states
+    # are sorted.
+    states = {RV: sorted(bn[RV].states) for RV in cols}
+    df = pd.DataFrame({RV: rng.choice(states[RV], rows) for RV in cols})
+
+    expected = from_data_groupby(df, cols, states)
+    assert np.allclose(Factor.from_data(df, cols, states).values, expected.values)
+
+    # Categorical columns are already integer coded.
+    df_cat = df.astype({RV: pd.CategoricalDtype(states[RV]) for RV in cols})
+
+    cases = {
+        'groupby': lambda: from_data_groupby(df, cols, states),
+        'bincount': lambda: Factor.from_data(df, cols, states),
+        'bincount (categorical)': lambda: Factor.from_data(df_cat, cols, states),
+    }
+
+    print(f'{rows} rows, {len(cols)} columns, {expected.values.size} combinations')
+
+    for name, func in cases.items():
+        timing = min(timeit.repeat(func, repeat=repeat, number=1))
+        print(f'  {name:<24} {timing * 1e3:8.1f} ms')
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    run(rows)
@@ -63,6 +63,32 @@ class TestBag(unittest.TestCase):
         self.assertAlmostEqual(fC_a1['c0'], 0.12, places=2)
         self.assertAlmostEqual(fC_a1['c1'], 0.48, places=2)
 
+    def test_variable_elimination_pruning(self):
+        """Test pruning of factors that are irrelevant to the query."""
+        factors = examples.get_student_CPTs()
+        bag = Bag('Student', list(factors.values()))
+
+        # L and S are barren when querying G; G is not.
+        pruned = bag._prune_barren(bag._factors, {'G'})
+        self.assertEqual({f.conditioned[0] for f in pruned}, {'D', 'I', 'G'})
+
+        # Given I, only P(S|I) is needed to compute P(S|I).
+        pruned = bag._prune_barren(bag._factors, {'S', 'I'})
+        self.assertEqual({f.conditioned[0] for f in pruned}, {'I', 'S'})
+
+        reduced = [f.reduce(I='i1') for f in pruned]
+        connected = bag._prune_disconnected(reduced, ['S'])
+        self.assertEqual([f.scope for f in connected], [['S']])
+
+        S = bag.compute_posterior(['S'], {}, [], {'I': 'i1'})
+        self.assertAlmostEqual(S['s0'], 0.20, places=2)
+
+        # Without pruning the constants, the result is the joint.
+        self.assertAlmostEqual(bag.eliminate([], {'G': 'g1'}).values, 0.362, places=3)
+
+        order = bag.find_elimination_ordering(['S'], bag._factors, 'min-fill')
+        self.assertEqual(set(order), {'D', 'I', 'G', 'L'})
+
     def test_compute_posterior(self):
         """Test the function Bag.compute_posterior()."""
         factors = examples.get_student_CPTs()
@@ -280,9 +280,88 @@ class TestBayesianNetwork(unittest.TestCase):
         DS = self.Gs.compute_posterior(['D', 'S'], {}, [], {})
         self.assertAlmostEqual(DS.sum(), 1, places=3)
 
+        # Reducing the evidence gives the same result.
+        I_g1 = self.Gs.compute_posterior(['I'], {}, [], {'G': 'g1'})
+        reduced = self.Gs.compute_posterior(['I'], {}, [], {'G': 'g1'}, reduce=True)
+        self.assertTrue(I_g1.equals(reduced))
+
         # This fails ...
         # s0 = self.Gs.compute_posterior([], {'S': 's0'}, [], {})
 
+    def test_compute_posterior_batch(self):
+        """Test bn.compute_posterior_batch()."""
+        evidence = pd.DataFrame({
+            'I': ['i0', 'i1', np.nan, 'i0'],
+            'L': ['l0', np.nan, 'l1', 'l1'],
+            'unknown': [1, 2, 3, 4],
+        })
+
+        # G is in a single cluster, (D, S) requires extending the JT.
+        for qd in [['G'], ['S', 'D']]:
+            posteriors = self.Gs.compute_posterior_batch(qd, evidence, chunksize=3)
+            self.assertEqual(posteriors.shape, (4, 2, 2) if len(qd) > 1 else (4, 3))
+
+            for idx, (_, row) in enumerate(evidence.iterrows()):
+                ev = {RV: row[RV] for RV in ['I', 'L'] if pd.notna(row[RV])}
+                expected = self.Gs.compute_posterior(qd, {}, [], ev)
+                expected = expected.reorder_scope(qd).values
+
+                self.assertTrue(np.allclose(posteriors[idx], expected))
+
+        with self.assertRaises(thomas.core.error.InvalidStateError):
+            self.Gs.compute_posterior_batch(['G'], pd.DataFrame({'I': ['i2']}))
+
+    def test_query_cache(self):
+        """Test caching of query results."""
+        bn = self.Gs
+        bn.set_query_cache(maxsize=2)
+
+        G1 = bn.P('G|I=i1')
+        G2 = bn.compute_posterior(['G'], {}, [], {'I': 'i1'})
+        self.assertTrue(G1.equals(G2))
+        self.assertEqual(bn.query_cache_info()['hits'], 1)
+        self.assertEqual(bn.query_cache_info()['misses'], 1)
+
+        # Results are copies: changing one does not affect the cache.
+        G2.values[:] = 0
+        self.assertTrue(bn.P('G|I=i1').equals(G1))
+
+        # The least recently used result is evicted.
+        bn.P('S|I=i0')
+        bn.P('D')
+        bn.P('G|I=i1')
+        info = bn.query_cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['currsize']), (2, 4, 2))
+
+        # Changing a CPT invalidates the cache and the junction tree.
+        I = bn['I'].cpt
+        bn['I'].cpt = CPT([0.5, 0.5], states=I.states)
+        self.assertEqual(bn.query_cache_info()['currsize'], 0)
+
+        expected = bn.compute_posterior(['G'], {}, [], {'I': 'i1'}, use_VE=True)
+        self.assertTrue(np.allclose(bn.P('G|I=i1').values, expected.values))
+        self.assertTrue(np.allclose(bn.P('I').values, [0.5, 0.5]))
+
+        # ... as does learning.
+        df = pd.DataFrame({
+            'D': ['d0', 'd0', 'd1'],
+            'I': ['i0', 'i1', 'i1'],
+            'G': ['g1', 'g2', 'g1'],
+            'S': ['s0', 's1', 's1'],
+            'L': ['l0', 'l1', 'l1'],
+        })
+        bn.ML_estimation(df, pseudocount=1)
+        self.assertEqual(bn.query_cache_info()['currsize'], 0)
+        self.assertAlmostEqual(bn.P('I')['i1'], 3/5)
+
+        # Query values are returned as arrays; these are copies too.
+        G = bn.P('G=g1|I=i1')
+        G[...] = 99
+        self.assertNotEqual(bn.P('G=g1|I=i1')[0], 99)
+
+        bn.set_query_cache(None)
+        self.assertEqual(bn.query_cache_info()['currsize'], 0)
+
     def test_joint_with_jt(self):
         """Testing computing a joint using a JT."""
         IS1 = self.Gs.compute_joint_with_jt(['I', 'S'])
@@ -333,6 +412,95 @@ class TestBayesianNetwork(unittest.TestCase):
         self.assertAlmostEqual(bn['E'].cpt['F', 'T'], 1/2)
         self.assertAlmostEqual(bn['E'].cpt['F', 'F'], 1/2)
 
+        # Laplace smoothing
+        bn.ML_estimation(df, pseudocount=1)
+        self.assertAlmostEqual(bn['H'].cpt['T'], 13/18)
+        self.assertAlmostEqual(bn['S'].cpt['F', 'T'], 2/6)
+
+    def test_ML_estimation_state_order(self):
+        """Test ML estimation when a CPT's states are ordered differently."""
+        bn = examples.get_lungcancer_network()
+        self.assertNotEqual(bn['death'].cpt.states['death'], bn['death'].states)
+
+        rng = np.random.default_rng(42)
+        df = pd.DataFrame({
+            RV: rng.choice(node.states, 50) for RV, node in bn.nodes.items()
+        })
+        df['death'] = '1-4 months'
+
+        bn.ML_estimation(df)
+        death = bn.get_marginals(['death'])['death']
+        self.assertAlmostEqual(death['1-4 months'], 1)
+
+    def test_ML_estimation_streaming(self):
+        """Test ML estimation from chunks of data."""
+        filename = thomas.core.get_pkg_data('dataset_17_2.csv')
+        df = pd.read_csv(filename, sep=';')
+
+        H = DiscreteNetworkNode('H', states=['T', 'F'])
+        S = DiscreteNetworkNode('S', states=['T', 'F'])
+        bn = BayesianNetwork('Example 17.2', [H, S], [('H', 'S')])
+        bn.ML_estimation(df)
+
+        # From an iterable of chunks ...
+        chunks = BayesianNetwork.from_dict(bn.as_dict())
+        chunks.ML_estimation(pd.read_csv(filename, sep=';', chunksize=5))
+
+        # ... and from a file.
+        streamed = BayesianNetwork.from_dict(bn.as_dict())
+        streamed.ML_estimation(filename, chunksize=3, sep=';')
+
+        for RV in bn.nodes:
+            self.assertTrue(bn[RV].cpt.equals(chunks[RV].cpt))
+            self.assertTrue(bn[RV].cpt.equals(streamed[RV].cpt))
+
+    def test_log_likelihood(self):
+        """Test bn.log_likelihood()."""
+        # Complete rows use the chain rule, the others are propagated.
+        df = pd.DataFrame({
+            'D': ['d0', 'd1', None, 'd0', 'd1', 'd1'],
+            'I': ['i0', 'i1', 'i1', None, 'i0', 'i1'],
+            'G': ['g1', 'g3', None, 'g2', 'g1', 'g2'],
+            'S': ['s0', 's1', 's1', 's1', 's0', None],
+            'L': ['l1', 'l0', None, 'l0', 'l1', 'l1'],
+        })
+
+        expected = []
+
+        for _, row in df.iterrows():
+            P = self.Gs.compute_posterior([], row.dropna().to_dict(), [], {})
+            expected.append(np.log(P[0]))
+
+        per_case = self.Gs.log_likelihood(df, per_case=True)
+        self.assertIsInstance(per_case, np.ndarray)
+        self.assertTrue(np.allclose(per_case, expected))
+
+        expected = sum(expected)
+        self.assertAlmostEqual(self.Gs.log_likelihood(df), expected)
+        self.assertAlmostEqual(self.Gs.log_likelihood(df, chunksize=2), expected)
+        self.assertAlmostEqual(self.Gs.likelihood(df), np.exp(expected))
+
+        # The product of many probabilities underflows; its log does not.
+        large = pd.concat([df] * 200, ignore_index=True)
+        self.assertAlmostEqual(self.Gs.log_likelihood(large), 200 * expected)
+        self.assertEqual(np.prod([np.exp(expected)] * 200), 0)
+
+    def test_log_likelihood_state_order(self):
+        """Test bn.log_likelihood() when a CPT's states are ordered differently."""
+        bn = examples.get_lungcancer_network()
+        self.assertNotEqual(bn['death'].cpt.states['death'], bn['death'].states)
+
+        df = bn.sample(6, seed=42).astype(object)
+        df.loc[3:, 'T'] = None
+
+        expected = [
+            np.log(bn.compute_posterior([], row.dropna().to_dict(), [], {})[0])
+            for _, row in df.iterrows()
+        ]
+
+        per_case = bn.log_likelihood(df, per_case=True)
+        self.assertTrue(np.allclose(per_case, expected))
+
     def test_serialization(self):
         """Test serialization to and loading from dictionary."""
         serialized = self.Gs.as_dict()
@@ -400,4 +568,63 @@ class TestBayesianNetwork(unittest.TestCase):
         self.assertAlmostEqual(bn['D'].cpt['b2', 'd1'], 1.000, places=3)
         self.assertAlmostEqual(bn['D'].cpt['b2', 'd2'], 0.000, places=3)
 
+    def test_EM_learning_convergence(self):
+        """Test EM-learning with a convergence tolerance."""
+        bn = examples.get_example17_3_network()
+        filename = thomas.core.get_pkg_data('dataset_17_3.csv')
+        df = pd.read_csv(filename, sep=';').set_index('Case')
+
+        history = bn.EM_learning(df, max_iterations=100, tol=1e-6, chunksize=2)
+
+        # The log-likelihood never decreases and EM stops early.
+        self.assertTrue(np.all(np.diff(history) >= -1e-9))
+        self.assertLess(len(history), 100)
+        self.assertAlmostEqual(bn['A'].cpt.values.sum(), 1)
+
+    def test_EM_learning_parallel(self):
+        """Test EM-learning with multiple worker processes."""
+        filename = thomas.core.get_pkg_data('dataset_17_3.csv')
+        df = pd.read_csv(filename, sep=';').set_index('Case')
+
+        sequential = examples.get_example17_3_network()
+        parallel = examples.get_example17_3_network()
+
+        h1 = sequential.EM_learning(df, max_iterations=3)
+        h2 = parallel.EM_learning(df, max_iterations=3, n_jobs=2)
+
+        self.assertTrue(np.allclose(h1, h2))
+
+        for RV in sequential.nodes:
+            self.assertTrue(sequential[RV].cpt.equals(parallel[RV].cpt))
+
+        # A network whose CPTs order some states differently than the nodes.
+        sequential = examples.get_lungcancer_network()
+        parallel = examples.get_lungcancer_network()
+
+        df = sequential.sample(500, seed=42).astype(object)
+        missing = np.random.default_rng(42).random(df.shape) < 0.3
+        df = df.mask(missing)
+
+        h1 = sequential.EM_learning(df, max_iterations=3, notify=False)
+        h2 = parallel.EM_learning(df, max_iterations=3, n_jobs=2, notify=False)
+
+        self.assertTrue(np.allclose(h1, h2))
+
+        for RV in sequential.nodes:
+            self.assertTrue(sequential[RV].cpt.equals(parallel[RV].cpt))
+
+    def test_EM_learning_state_order(self):
+        """Test EM-learning when a CPT's states are ordered differently."""
+        bn = examples.get_lungcancer_network()
+        self.assertNotEqual(bn['death'].cpt.states['death'], bn['death'].states)
+
+        df = pd.DataFrame({
+            'T': ['1A', '2A', '3', '4'] * 5,
+            'death': ['1-4 months'] * 20,
+        })
+
+        bn.EM_learning(df, max_iterations=1, notify=False)
+        death = bn.get_marginals(['death'])['death']
+        self.assertAlmostEqual(death['1-4 months'], 1)
+
 
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import unittest
+import logging
+
+import thomas.core
+from thomas.core import examples
+from thomas.core.elimination import (
+    get_adjacency,
+    get_elimination_clusters,
+    get_maximal_clusters,
+    get_total_table_size,
+    greedy_ordering,
+    min_fill,
+    weighted_min_fill,
+)
+
+log = logging.getLogger(__name__)
+
+
+class TestElimination(unittest.TestCase):
+
+    def setUp(self):
+        thomas.core.options['quiet'] = True
+
+        # A - B - C - D - A is a cycle; E hangs off C and F is isolated.
+        nodes = ['A', 'B', 'C', 'D', 'E', 'F']
+        edges = [('A', 'B'), ('B', 'C'), ('C', 'D'), ('D', 'A'), ('C', 'E')]
+        self.adjacency = get_adjacency(nodes, edges)
+        self.cardinalities = {'A': 2, 'B': 10, 'C': 2, 'D': 10, 'E': 2, 'F': 2}
+
+    def test_heuristics(self):
+        """Test the costs of eliminating a node."""
+        self.assertEqual(min_fill('A', self.adjacency, None), 1)
+        self.assertEqual(min_fill('E', self.adjacency, None), 0)
+        self.assertEqual(weighted_min_fill('A', self.adjacency, self.cardinalities), 100)
+        self.assertEqual(weighted_min_fill('B', self.adjacency, self.cardinalities), 4)
+
+    def test_greedy_ordering(self):
+        """Test greedy_ordering()."""
+        for heuristic in ['min-degree', 'min-fill', 'weighted-min-fill']:
+            order = greedy_ordering(self.adjacency, heuristic, self.cardinalities)
+            self.assertEqual(set(order), set(self.adjacency))
+
+        # Weighted min-fill avoids connecting B and D.
+        order = greedy_ordering(self.adjacency, 'weighted-min-fill', self.cardinalities)
+        self.assertEqual(order[:3], ['E', 'F', 'B'])
+
+        # Nodes in `keep` are not eliminated.
+        order = greedy_ordering(self.adjacency, 'min-fill', keep={'A', 'F'})
+        self.assertEqual(set(order), {'B', 'C', 'D', 'E'})
+
+        with self.assertRaises(ValueError):
+            greedy_ordering(self.adjacency, 'unknown')
+
+    def test_clusters(self):
+        """Test the clusters induced by an ordering."""
+        order = ['E', 'F', 'B', 'A', 'C', 'D']
+        clusters = get_elimination_clusters(self.adjacency, order)
+
+        self.assertEqual(clusters[0], {'E', 'C'})
+        self.assertEqual(clusters[2], {'A', 'B', 'C'})
+
+        maximal = get_maximal_clusters(clusters, order)
+        self.assertEqual(maximal, [{'E', 'C'}, {'F'}, {'A', 'B', 'C'}, {'A', 'C', 'D'}])
+
+        size = get_total_table_size(self.adjacency, order, self.cardinalities)
+        self.assertEqual(size, 4 + 2 + 40 + 40)
+
+    def test_large_chain(self):
+        """Test that large graphs are triangulated without recursion."""
+        nodes = list(range(5000))
+        edges = list(zip(nodes[:-1], nodes[1:]))
+        adjacency = get_adjacency(nodes, edges)
+
+        order = greedy_ordering(adjacency, 'min-fill')
+        clusters = get_elimination_clusters(adjacency, order)
+        maximal = get_maximal_clusters(clusters, order)
+
+        self.assertEqual(len(maximal), len(edges))
+        self.assertTrue(all(len(C) == 2 for C in maximal))
+
+    def test_bn_elimination_order(self):
+        """Test selecting a heuristic for a BayesianNetwork."""
+        bn = examples.get_lungcancer_network()
+        prior = bn.get_marginals()
+
+        order, size = bn.find_elimination_order(restarts=5, seed=42)
+        self.assertLessEqual(size, bn.get_total_table_size('weighted-min-fill'))
+        self.assertEqual(size, bn.get_total_table_size(order))
+
+        bn.set_query_cache()
+
+        for heuristic in ['min-degree', 'min-fill', order]:
+            jt = bn.jt
+            bn.P('T|N=1')
+
+            # Selecting an ordering discards the tree and the cached results.
+            bn.elimination_order = heuristic
+            self.assertIsNot(bn.jt, jt)
+            self.assertEqual(bn.query_cache_info()['currsize'], 0)
+
+            marginals = bn.get_marginals()
+
+            for RV in prior:
+                self.assertTrue(marginals[RV].equals(prior[RV]))
@@ -8,7 +8,8 @@ import numpy as np
 import pandas as pd
 
 import thomas
-from thomas.core.factor import Factor, mul
+from thomas.core.factor import Factor, mul, multiply_and_sum_out, multiply_and_project
+from thomas.core.factor import encode_data, count_codes
 from thomas.core import examples
 from thomas.core import error
 
@@ -65,6 +66,45 @@ class TestFactor(unittest.TestCase):
         self.assertIsInstance(fB_A.get(A='a0', B='b1'), np.ndarray)
         self.assertIsInstance(fB_A.get(A='a0'), np.ndarray)
 
+    def test_set(self):
+        """Test factor.set() and factor.set_complement()."""
+        fA, fB_A, fC_A, fD_BC, fE_C = examples.get_sprinkler_factors()
+        fAB = fA * fB_A
+
+        f = fAB.set(0, B='b1')
+        self.assertEqual(list(f.get(B='b1')), [0, 0])
+        self.assertEqual(list(f.get(B='b0')), list(fAB.get(B='b0')))
+
+        f = fAB.set_complement(0, A='a1', B='b1')
+        self.assertAlmostEqual(f['a1', 'b1'], fAB['a1', 'b1'])
+        self.assertAlmostEqual(f.sum(), fAB['a1', 'b1'])
+
+        # Variables that are not in scope are ignored.
+        self.assertEqual(len(fA.get(A='a0', B='b1')), 1)
+
+        # Cells are returned in the same order as factor.flat
+        reordered = fAB.reorder_scope(['B', 'A'])
+        self.assertEqual(list(reordered.get()), list(reordered.flat))
+
+        with self.assertRaises(error.InvalidStateError):
+            fA.get(A='a2')
+
+    def test_reduce(self):
+        """Test factor.reduce()."""
+        fA, fB_A, fC_A, fD_BC, fE_C = examples.get_sprinkler_factors()
+
+        f = fD_BC.reduce(B='b1', E='e0')
+        self.assertEqual(f.scope, ['C', 'D'])
+        self.assertTrue(np.allclose(f.values.flat, fD_BC.get(B='b1')))
+
+        f = fD_BC.reduce(inplace=True, B='b1', C='c0', D='d1')
+        self.assertIsNone(f)
+        self.assertEqual(fD_BC.scope, [])
+        self.assertAlmostEqual(fD_BC.sum(), 0.9)
+
+        with self.assertRaises(error.InvalidStateError):
+            fA.reduce(A='a2')
+
     def test_mul(self):
         """Test factor.mul()."""
         fA, fB_A, fC_A, fD_BC, fE_C = examples.get_sprinkler_factors()
@@ -220,6 +260,56 @@ class TestFactor(unittest.TestCase):
         self.assertEquals(aligned['a1'], 1.0)
         self.assertEquals(aligned['a0'], 0.0)
 
+    def test_state_signature(self):
+        """Test factor.state_signature."""
+        fB_A1 = Factor([0.2, 0.8, 0.75, 0.25], {
+            'A': ['a1', 'a0'],
+            'B': ['b1', 'b0']
+        })
+
+        fB_A2 = Factor([0.8, 0.2, 0.25, 0.75], {
+            'A': ['a1', 'a0'],
+            'B': ['b0', 'b1']
+        })
+
+        signature = fB_A1.state_signature
+        self.assertEqual(signature, (('A', ('a1', 'a0')), ('B', ('b1', 'b0'))))
+        self.assertEqual(hash(signature), hash(fB_A1.copy().state_signature))
+        self.assertNotEqual(signature, fB_A2.state_signature)
+
+        # Aligning to the signature of another factor.
+        aligned = fB_A2.align_index(fB_A1)
+        self.assertEqual(aligned.state_signature, signature)
+        self.assertTrue(np.array_equal(aligned.values, fB_A1.values))
+
+        # Aligning factors that are already aligned is a no-op.
+        self.assertTrue(np.array_equal(fB_A1.align_index(fB_A1).values, fB_A1.values))
+
+        with self.assertRaises(error.StatesNotAlignedError):
+            fB_A1.align_index(Factor(1, {'A': ['a1', 'a2']}))
+
+    def test_count_codes(self):
+        """Test encode_data() and count_codes()."""
+        states = {'A': ['a0', 'a1'], 'B': ['b0', 'b1', 'b2']}
+        df = pd.DataFrame({
+            'A': ['a1', 'a0', 'a1', np.nan, 'a1'],
+            'B': ['b2', 'b0', 'b2', 'b1', 'b0'],
+            'C': [1, 2, 3, 4, 5],
+        })
+
+        codes = encode_data(df, states)
+        self.assertEqual(list(codes.keys()), ['A', 'B'])
+        self.assertEqual(list(codes['A']), [1, 0, 1, -1, 1])
+        self.assertEqual(list(codes['B']), [2, 0, 2, 1, 0])
+
+        # Rows with missing values are not counted.
+        counts = count_codes([codes['A'], codes['B']], [2, 3])
+        expected = [[1, 0, 0], [1, 0, 2]]
+        self.assertTrue(np.array_equal(counts, expected))
+
+        with self.assertRaises(error.InvalidStateError):
+            encode_data(pd.DataFrame({'A': ['a2']}), states)
+
     def test_multiplication(self):
         """Test factor multiplication."""
         # Get the Factors for the Sprinkler network
@@ -254,6 +344,38 @@ class TestFactor(unittest.TestCase):
         self.assertAlmostEquals(multiplied['T'], 1.0, places=2)
         self.assertAlmostEquals(multiplied['F'], 0.0, places=2)
 
+    def test_multiply_and_sum_out(self):
+        """Test the fused multiply/sum-out operation."""
+        fA, fB_A, fC_A, fD_BC, fE_C = examples.get_sprinkler_factors()
+        factors = [fA, fB_A, fC_A, fD_BC]
+
+        expected = fA.mul(fB_A).mul(fC_A).mul(fD_BC).sum_out(['A', 'B'])
+        fused = multiply_and_sum_out(factors, ['A', 'B'])
+
+        self.assertEqual(fused.vars, {'C', 'D'})
+        self.assertTrue(fused.equals(expected))
+
+        # Scalars are multiplied into the result.
+        fB = multiply_and_sum_out([2, fA, fB_A], 'A')
+        self.assertAlmostEqual(fB.sum(), 2, places=8)
+
+        with self.assertRaises(error.NotInScopeError):
+            multiply_and_sum_out(factors, 'E')
+
+    def test_multiply_and_project(self):
+        """Test the fused multiply/project operation."""
+        fA, fB_A, fC_A, fD_BC, fE_C = examples.get_sprinkler_factors()
+
+        fCA = multiply_and_project([fA, fB_A, fC_A], ['C', 'A'])
+        self.assertEqual(fCA.scope, ['C', 'A'])
+        self.assertTrue(fCA.equals((fA * fB_A * fC_A).project({'A', 'C'})))
+
+        # States are aligned by name, not by position.
+        fB_A2 = fB_A.align_index(Factor(1, {'B': ['b0', 'b1']}))
+        fB = multiply_and_project([fA, fB_A2], 'B')
+        self.assertAlmostEqual(fB['b1'], 0.42, places=2)
+        self.assertAlmostEqual(fB['b0'], 0.58, places=2)
+
     @unittest.skip('deprecate?')
     def test_overlaps_with(self):
         """Test factor.overlaps_with()."""
@@ -318,6 +440,16 @@ class TestFactor(unittest.TestCase):
         self.assertEqual(set(factor.scope), set(scope))
         self.assertEqual(factor.sum(), 16)
 
+        # States that do not occur get `complete_value`; rows with NAs are
+        # dropped.
+        df.loc[0, 'S'] = np.nan
+        states = {'H': ['T', 'F', 'X'], 'S': ['T', 'F']}
+        factor = Factor.from_data(df, cols=['H', 'S'], states=states, complete_value=1)
+
+        self.assertEqual(factor.states, states)
+        self.assertEqual(factor['X', 'T'], 1)
+        self.assertEqual(factor.sum(), 15 + 6)
+
     def test_serialization_simple(self):
         """Test the JSON serialization."""
         [fA, fB_A, fC_A, fD_BC, fE_C] = examples.get_sprinkler_factors()
@@ -7,13 +7,17 @@ import itertools
 import json
 
 from tempfile import gettempdir
+from unittest import mock
 
 import pandas as pd
+import numpy as np
+import networkx as nx
 
 import thomas.core
 from thomas.core import error
 from thomas.core.cpt import CPT
 from thomas.core.bayesiannetwork import BayesianNetwork, DiscreteNetworkNode
+from thomas.core.junctiontree import TreeNode
 from thomas.core import examples
 
 
@@ -36,6 +40,272 @@ class TestJunctionTree(unittest.TestCase):
         jt.ensure_cluster(Q2)
         self.assertTrue(jt.get_node_for_set(Q2) is not None)
 
+    def test_separators(self):
+        """Test that separators are updated when clusters grow."""
+        # A chain: X0 -> X1 -> ... -> X99
+        nodes = [DiscreteNetworkNode(f'X{i}', states=['a', 'b']) for i in range(100)]
+        edges = [(f'X{i}', f'X{i+1}') for i in range(99)]
+        bn = BayesianNetwork('chain', nodes, edges)
+
+        for node in bn.nodes.values():
+            node.reset()
+
+        jt = bn.jt
+        jt.ensure_cluster({'X0', 'X99'})
+
+        node = jt.get_node_for_set({'X0', 'X99'})
+        self.assertIsNotNone(node)
+
+        for edge in jt.edges:
+            expected = edge._left.cluster & edge._right.cluster
+            self.assertEqual(edge.separator, expected)
+
+        # Growing the clusters does not affect the marginals.
+        joint = node.project('X99')
+        expected = bn.compute_posterior(['X99'], {}, [], {}, use_VE=True)
+        self.assertTrue(np.allclose(joint.values, expected.values))
+
+    def test_structure(self):
+        """Test that the tree satisfies the running intersection property."""
+        A = DiscreteNetworkNode('A', states=['a0', 'a1'])
+        B = DiscreteNetworkNode('B', states=['b0', 'b1'])
+        C = DiscreteNetworkNode('C', states=['c0', 'c1'])
+
+        # The network has two components: {A, B} and {C}.
+        disconnected = BayesianNetwork('disconnected', [A, B, C], [('A', 'B')])
+
+        for node in disconnected.nodes.values():
+            node.reset()
+
+        for bn in [self.Gs, examples.get_lungcancer_network(), disconnected]:
+            jt = bn.jt
+            G = jt.as_networkx()
+            G.add_nodes_from(jt.nodes.values())
+
+            # A tree is connected and has one edge less than it has nodes.
+            self.assertEqual(len(jt.edges), len(jt.nodes) - 1)
+            self.assertTrue(nx.is_connected(G))
+
+            # The nodes containing a variable form a connected subtree.
+            for RV in bn.nodes:
+                containing = [n for n in jt.nodes.values() if RV in n.cluster]
+                self.assertTrue(nx.is_connected(G.subgraph(containing)))
+
+    def test_compile(self):
+        """Test tree.compile()."""
+        jt = self.Gs.jt
+        jt.compile()
+
+        node = jt.get_node_for_RV('G')
+        edge = node._edges[0]
+        buffers = [edge._messages[n] for n in (edge._left, edge._right)]
+
+        jt.reset_evidence()
+        jt.set_evidence_hard(I='i1')
+        G = node.project('G')
+
+        # Propagation happens in place: the buffers are reused.
+        self.assertIs(edge._messages[edge._left], buffers[0])
+        self.assertIs(edge._messages[edge._right], buffers[1])
+
+        expected = self.Gs.compute_posterior(['G'], {}, [], {'I': 'i1'}, use_VE=True)
+        self.assertTrue(np.allclose(G.values, expected.values))
+
+        # Changing the structure requires recompilation.
+        jt.ensure_cluster({'L', 'G', 'S'})
+        self.assertFalse(jt._compiled)
+        L = jt.get_node_for_set({'L', 'G', 'S'}).project('L')
+        self.assertTrue(jt._compiled)
+        self.assertAlmostEqual(L.sum(), 1)
+
+    def test_propagate(self):
+        """Test tree.propagate()."""
+        bn = examples.get_lungcancer_network()
+        jt = bn.jt
+        jt.set_evidence_hard(TNM='1A')
+
+        with mock.patch.object(TreeNode, '_run', autospec=True, side_effect=TreeNode._run) as run:
+            jt.propagate()
+
+            # Each edge carries two messages; each node computes its belief.
+            messages = [c for c in run.call_args_list if len(c[0]) > 1]
+            self.assertEqual(len(messages), 2 * len(jt.edges))
+            self.assertEqual(run.call_count, 2 * len(jt.edges) + len(jt.nodes))
+
+            # Once calibrated, marginals are read off the beliefs.
+            run.reset_mock()
+            marginals = jt.get_marginals()
+            self.assertEqual(run.call_count, 0)
+
+        # Beliefs agree on the variables they share.
+        for edge in jt.edges:
+            left = edge._left.project(edge.separator)
+            right = edge._right.project(edge.separator)
+            self.assertTrue(left.equals(right))
+
+        T = marginals['T']
+        self.assertAlmostEqual(T.sum(), 1)
+        self.assertAlmostEqual(marginals['TNM']['1A'], 1)
+
+    def test_incremental_evidence(self):
+        """Test that evidence only invalidates the messages depending on it."""
+        bn = examples.get_lungcancer_network()
+        jt = bn.jt
+        jt.propagate()
+
+        leaf = [n for n in jt.nodes.values() if len(n._edges) == 1][0]
+        RV = [RV for RV, node in jt._RVs.items() if node is leaf][0]
+        state = bn[RV].states[0]
+
+        with mock.patch.object(TreeNode, '_run', autospec=True, side_effect=TreeNode._run) as run:
+            # Only the messages *away* from the leaf need to be recomputed.
+            jt.set_evidence_hard(**{RV: state})
+            jt.propagate()
+            messages = [c for c in run.call_args_list if len(c[0]) > 1]
+            self.assertEqual(len(messages), len(jt.edges))
+
+            # Setting the same evidence again is free.
+            run.reset_mock()
+            jt.set_evidence_hard(**{RV: state})
+            jt.propagate()
+            self.assertEqual(run.call_count, 0)
+
+            # Retracting evidence again only affects messages from the leaf.
+            run.reset_mock()
+            jt.retract_evidence(RV)
+            jt.propagate()
+            messages = [c for c in run.call_args_list if len(c[0]) > 1]
+            self.assertEqual(len(messages), len(jt.edges))
+
+        marginals = jt.get_marginals()
+        prior = examples.get_lungcancer_network().get_marginals()
+
+        for RV in marginals:
+            self.assertTrue(marginals[RV].equals(prior[RV]))
+
+    def test_compute_joint(self):
+        """Test tree.compute_joint() for variables in different clusters."""
+        bn = examples.get_lungcancer_network()
+        jt = bn.jt
+        Q = ['T', 'death', 'cM', 'edition']
+        self.assertIsNone(jt.get_node_for_set(set(Q)))
+
+        jt.set_evidence_hard(N='1')
+        joint = jt.compute_joint(Q).normalize()
+        self.assertEqual(joint.scope, Q)
+
+        # Out-of-clique inference should not change the tree.
+        self.assertIsNone(jt.get_node_for_set(set(Q)))
+
+        expected = bn.as_bag().compute_posterior(Q, {}, [], {'N': '1'})
+        expected = expected.reorder_scope(Q).align_index(joint)
+        self.assertTrue(np.allclose(joint.values, expected.values))
+
+    def test_reduce_evidence(self):
+        """Test tree.reduce_evidence()."""
+        bn = examples.get_lungcancer_network()
+        jt = bn.jt
+        expected = examples.get_lungcancer_network().jt
+
+        jt.compile()
+        sizes = sum(n._potential.size for n in jt.nodes.values())
+
+        for evidence in [{'N': '1'}, {'N': '2'}, {'N': '2', 'edition': 'TNM 7'}]:
+            jt.reduce_evidence(**evidence)
+            expected.replace_evidence(**evidence)
+
+            marginals = jt.get_marginals()
+
+            for RV, marginal in expected.get_marginals().items():
+                self.assertTrue(np.allclose(marginals[RV].values, marginal.values))
+
+            Q = ['N', 'T', 'death']
+            joint = jt.compute_joint(Q).normalize()
+            self.assertEqual(joint.scope, Q)
+            self.assertTrue(joint.equals(expected.compute_joint(Q).normalize()))
+
+        # Observed variables are sliced out of the potentials.
+        self.assertEqual(set(jt._reduced), {'N', 'edition'})
+        self.assertLess(sum(n._potential.size for n in jt.nodes.values()), sizes)
+
+        # Changing the observed state does not require recompilation.
+        jt.set_evidence_hard(N='3')
+        self.assertTrue(jt._compiled)
+        self.assertAlmostEqual(jt.get_marginals(['N'])['N']['3'], 1)
+
+        # Other evidence expands the variable again.
+        jt.set_evidence_likelihood('N', **{'1': 0.5})
+        self.assertNotIn('N', jt._reduced)
+
+        jt.reset_evidence()
+        jt.ensure_compiled()
+        self.assertEqual(jt._reduced, {})
+        self.assertEqual(sum(n._potential.size for n in jt.nodes.values()), sizes)
+
+    def test_propagate_batch(self):
+        """Test tree.propagate_batch()."""
+        bn = examples.get_student_network()
+        jt = bn.jt
+        I = np.array([[1, 0], [0, 1], [1, 1]])
+
+        beliefs = jt.propagate_batch({'I': I})
+
+        for idx, row in enumerate(I):
+            jt.set_evidence_likelihood('I', i0=row[0], i1=row[1])
+            jt.propagate()
+
+            # Beliefs in the tree are scaled to sum to 1.
+            for node in jt.nodes.values():
+                belief = node._ensure_belief() * np.exp(node._log_scale)
+                self.assertTrue(np.allclose(beliefs[node][idx], belief))
+
+        # Without evidence the beliefs are not batched.
+        node = list(jt.nodes.values())[0]
+        beliefs = jt.propagate_batch({}, [node])
+        self.assertEqual(beliefs[node].shape[0], 1)
+        self.assertAlmostEqual(beliefs[node].sum(), 1)
+
+        # Scaled propagation yields normalized beliefs and log P(e).
+        beliefs = jt.propagate_batch({'I': I}, [node])
+        scaled, logPe = jt.propagate_batch({'I': I}, [node], scaled=True)
+        Pe = beliefs[node].reshape(len(I), -1).sum(axis=1)
+        self.assertTrue(np.allclose(logPe, np.log(Pe)))
+        scaled = scaled[node].reshape(len(I), -1) * Pe[:, np.newaxis]
+        self.assertTrue(np.allclose(scaled, beliefs[node].reshape(len(I), -1)))
+
+    def test_propagate_deep(self):
+        """Test that propagation does not underflow in a deep tree."""
+        # A chain X0 -> X1 -> ... -> X1199 with alternating evidence.
+        N = 1200
+        nodes = [DiscreteNetworkNode(f'X{i}', states=['a', 'b']) for i in range(N)]
+        edges = [(f'X{i}', f'X{i+1}') for i in range(N - 1)]
+        bn = BayesianNetwork('chain', nodes, edges)
+
+        bn['X0'].cpt = CPT([0.5, 0.5], states={'X0': ['a', 'b']})
+
+        for i in range(1, N):
+            bn[f'X{i}'].cpt = CPT(
+                [0.9, 0.1, 0.1, 0.9],
+                states={f'X{i-1}': ['a', 'b'], f'X{i}': ['a', 'b']}
+            )
+
+        ev = {f'X{i}': 'ab'[i % 2] for i in range(1, N)}
+        expected = bn.compute_posterior_batch(['X0'], pd.DataFrame([ev]))[0]
+
+        P = bn.compute_posterior(['X0'], {}, [], ev)
+        self.assertTrue(np.allclose(P.values, expected))
+
+        marginals = bn.compute_marginals(['X0'], ev)
+        self.assertTrue(np.allclose(marginals['X0'].values, expected))
+
+        query = bn.compile_query('X0|X1=b')
+        self.assertTrue(np.allclose(query(**ev).values, expected))
+
+        # P(e) is available as log P(e).
+        logPe = bn.jt.compute_log_evidence()
+        self.assertTrue(np.isfinite(logPe))
+        self.assertLess(logPe, np.log(np.finfo(float).tiny))
+
     def test_set_evidence_hard(self):
         """Test tree.set_evidence_hard()."""
         with self.assertRaises(error.InvalidStateError):
@@ -15,4 +15,17 @@ class TestProbabilisticModel(unittest.TestCase):
         model = ProbabilisticModel()
 
         with self.assertRaises(NotImplementedError) as context:
-            model.compute_posterior([], {}, [], {})
\ No newline at end of file
+            model.compute_posterior([], {}, [], {})
+
+    def test_parse_query_string(self):
+        """Test ProbabilisticModel.parse_query_string()."""
+        qd, qv, ed, ev = ProbabilisticModel.parse_query_string('I,G=g1|D,L=l0')
+        self.assertEqual(qd, ['I'])
+        self.assertEqual(qv, {'G': 'g1'})
+        self.assertEqual(ed, ['D'])
+        self.assertEqual(ev, {'L': 'l0'})
+
+        # Parsing is cached, but results can be modified safely.
+        ev['L'] = 'l1'
+        parsed = ProbabilisticModel.parse_query_string('I,G=g1|D,L=l0')
+        self.assertEqual(parsed[3], {'L': 'l0'})
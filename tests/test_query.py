@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import unittest
+import logging
+
+import numpy as np
+
+import thomas.core
+from thomas.core import error
+from thomas.core import examples
+from thomas.core.query import Query
+
+log = logging.getLogger(__name__)
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        thomas.core.options['quiet'] = True
+        self.Gs = examples.get_student_network()
+
+    def test_compile_query(self):
+        """Test bn.compile_query()."""
+        query = self.Gs.compile_query('I,G=g1|D,L=l0')
+        self.assertIsInstance(query, Query)
+        self.assertEqual(repr(query), '<Query P(I,G=g1|D,L=l0)>')
+
+        with self.assertRaises(error.NotInScopeError):
+            self.Gs.compile_query('X|L=l0')
+
+        with self.assertRaises(error.InvalidStateError):
+            self.Gs.compile_query('I|L=l2')
+
+        with self.assertRaises(error.InvalidStateError):
+            query(L='l2')
+
+    def test_call(self):
+        """Test executing a query with different evidence."""
+        queries = [
+            ('I,G=g1|D,L=l0', {'L': 'l1'}),
+            ('G|D,I', {'L': 'l1'}),
+            ('S|L=l1,G=g2', {'L': 'l0'}),
+            # D and S are not in a single cluster
+            ('D,S', {'G': 'g3'}),
+        ]
+
+        for query_string, evidence in queries:
+            query = self.Gs.compile_query(query_string)
+            qd, qv, ed, ev = self.Gs.parse_query_string(query_string)
+
+            for ev in [ev, {**ev, **evidence}]:
+                result = query(**ev)
+                expected = self.Gs.compute_posterior(qd, qv, ed, ev)
+
+                if qv:
+                    self.assertTrue(np.allclose(result, expected))
+                else:
+                    self.assertEqual(result.scope, expected.scope)
+                    self.assertEqual(result.conditioned, expected.conditioned)
+                    self.assertTrue(np.allclose(result.values, expected.values))
+
+    def test_changes(self):
+        """Test that queries remain valid when the network changes."""
+        query = self.Gs.compile_query('L|I=i1')
+        before = query()
+
+        # Extending a cluster recompiles the tree.
+        self.Gs.jt.ensure_cluster({'L', 'G', 'S'})
+        self.assertTrue(query().equals(before))
+
+        # Rebuilding the tree.
+        self.Gs.add_edges([])
+        self.assertTrue(query().equals(before))
+
+        # Changing a CPT is picked up.
+        G = self.Gs['G'].cpt.copy()
+        G.values[:] = G.values[..., ::-1]
+        self.Gs['G'].cpt = G
+
+        expected = self.Gs.compute_posterior(['L'], {}, [], {'I': 'i1'}, use_VE=True)
+        self.assertTrue(np.allclose(query().values, expected.values))
+        self.assertFalse(np.allclose(query().values, before.values))
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import unittest
+import logging
+
+import numpy as np
+import pandas as pd
+
+import thomas.core
+from thomas.core import error
+from thomas.core import examples
+from thomas.core.cpt import CPT
+from thomas.core.bayesiannetwork import BayesianNetwork
+from thomas.core.sampling import topological_order
+
+log = logging.getLogger(__name__)
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        thomas.core.options['quiet'] = True
+        self.Gs = examples.get_student_network()
+
+    def test_topological_order(self):
+        """Test topological_order()."""
+        order = topological_order(self.Gs)
+        self.assertEqual(set(order), set(self.Gs.nodes))
+
+        for RV, node in self.Gs.nodes.items():
+            for parent in node.parents:
+                self.assertLess(order.index(parent.RV), order.index(RV))
+
+    def test_sample(self):
+        """Test bn.sample()."""
+        df = self.Gs.sample(50000, seed=42)
+
+        self.assertEqual(len(df), 50000)
+        self.assertEqual(list(df.columns), list(self.Gs.nodes))
+
+        for RV, node in self.Gs.nodes.items():
+            self.assertIsInstance(df[RV].dtype, pd.CategoricalDtype)
+            self.assertEqual(list(df[RV].cat.categories), node.states)
+
+        # The same seed yields the same samples.
+        self.assertTrue(df.equals(self.Gs.sample(50000, seed=42)))
+
+        # Frequencies approximate the marginals.
+        for RV, marginal in self.Gs.get_marginals().items():
+            states = self.Gs.nodes[RV].states
+            freq = df[RV].value_counts(normalize=True).reindex(states)
+            self.assertTrue(np.allclose(freq.values, marginal.values, atol=0.01))
+
+    def test_sample_state_order(self):
+        """Test bn.sample() when a CPT's states are ordered differently."""
+        bn = examples.get_lungcancer_network()
+        self.assertNotEqual(bn['death'].cpt.states['death'], bn['death'].states)
+
+        df = bn.sample(50000, seed=42)
+
+        for RV, marginal in bn.get_marginals().items():
+            freq = df[RV].value_counts(normalize=True).reindex(bn[RV].states)
+            self.assertTrue(np.allclose(freq.values, marginal.values, atol=0.01))
+
+    def test_sample_evidence(self):
+        """Test bn.sample() with evidence."""
+        evidence = {'L': 'l1', 'S': 's1'}
+        df = self.Gs.sample(20000, seed=42, evidence=evidence)
+
+        self.assertEqual(len(df), 20000)
+        self.assertTrue((df['L'] == 'l1').all())
+        self.assertTrue((df['S'] == 's1').all())
+
+        freq = df['I'].value_counts(normalize=True).reindex(['i0', 'i1'])
+        expected = self.Gs.P('I|L=l1,S=s1')
+        self.assertTrue(np.allclose(freq.values, expected.values, atol=0.01))
+
+        with self.assertRaises(error.InvalidStateError):
+            self.Gs.sample(10, evidence={'L': 'l2'})
+
+        # B is a copy of A, so A=a0, B=b1 cannot be sampled.
+        bn = BayesianNetwork.from_CPTs('copy', [
+            CPT([0.5, 0.5], states={'A': ['a0', 'a1']}),
+            CPT([1, 0, 0, 1], states={'A': ['a0', 'a1'], 'B': ['b0', 'b1']}),
+        ])
+
+        with self.assertRaises(error.SamplingError):
+            bn.sample(10, evidence={'A': 'a0', 'B': 'b1'})
+
+    def test_estimate_posterior(self):
+        """Test bn.estimate_posterior()."""
+        queries = [
+            (['I'], {}, [], {'L': 'l1', 'S': 's1'}),
+            (['G'], {}, ['D'], {'L': 'l0'}),
+            ([], {'G': 'g1'}, [], {'L': 'l0'}),
+        ]
+
+        for method in ['lw', 'is']:
+            for qd, qv, ed, ev in queries:
+                P, stderr = self.Gs.estimate_posterior(
+                    qd, qv, ed, ev, method=method, samples=50000, seed=42
+                )
+                expected = self.Gs.compute_posterior(qd, qv, ed, ev)
+
+                if not qv:
+                    self.assertEqual(P.scope, expected.scope)
+                    P, stderr, expected = P.values, stderr.values, expected.values
+
+                self.assertTrue(np.all(np.abs(P - expected) <= 5 * stderr + 1e-3))
+                self.assertTrue(np.all(stderr < 0.01))
+
+            # compute_posterior() only returns the estimate.
+            P = self.Gs.compute_posterior(['I'], {}, [], {'L': 'l1'}, method=method, seed=1)
+            self.assertAlmostEqual(P.values.sum(), 1)
+
+        # Sampling stops as soon as the standard errors are small enough.
+        _, coarse = self.Gs.estimate_posterior(['I'], {}, [], {'L': 'l1'}, tol=0.02, seed=1)
+        _, fine = self.Gs.estimate_posterior(['I'], {}, [], {'L': 'l1'}, seed=1)
+        self.assertTrue(np.all(coarse.values <= 0.02))
+        self.assertTrue(np.all(fine.values < coarse.values))
+
+        with self.assertRaises(ValueError):
+            self.Gs.compute_posterior(['I'], {}, [], {}, method='unknown')
+
+    def test_importance_sampling(self):
+        """Test that pre-propagating evidence improves the estimates."""
+        bn = examples.get_lungcancer_network()
+        evidence = {'cT': '1A', 'cN': '2', 'cM': '1', 'death': '0-30 days'}
+
+        _, lw = bn.estimate_posterior(['M'], {}, [], evidence, method='lw', seed=42)
+        _, IS = bn.estimate_posterior(['M'], {}, [], evidence, method='is', seed=42)
+        self.assertLess(IS.values.max(), lw.values.max())
+
+        # Evidence on a variable whose CPT orders its states differently.
+        expected = bn.compute_posterior(['T'], {}, [], {'death': '1-4 months'})
+
+        for method in ['lw', 'is']:
+            P, stderr = bn.estimate_posterior(
+                ['T'], {}, [], {'death': '1-4 months'}, method=method, seed=42
+            )
+            self.assertTrue(np.all(np.abs(P.values - expected.values) <= 5 * stderr.values + 1e-3))
+
+        # A network with a copied variable: A=a0, B=b1 is impossible.
+        bn = BayesianNetwork.from_CPTs('copy', [
+            CPT([0.5, 0.5], states={'A': ['a0', 'a1']}),
+            CPT([1, 0, 0, 1], states={'A': ['a0', 'a1'], 'B': ['b0', 'b1']}),
+        ])
+
+        for method in ['lw', 'is']:
+            with self.assertRaises(error.SamplingError):
+                bn.estimate_posterior(['A'], {}, [], {'B': 'b1', 'A': 'a0'}, method=method)
+
+            P = bn.compute_posterior(['A'], {}, [], {'B': 'b1'}, method=method)
+            self.assertAlmostEqual(P['a1'], 1)
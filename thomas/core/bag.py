@@ -3,18 +3,19 @@
 import os
 from datetime import datetime as dt
 
-from collections import OrderedDict
+import itertools
+from collections import OrderedDict, defaultdict
 
 import numpy as np
 import pandas as pd
 from pandas.core.dtypes.dtypes import CategoricalDtype
-from functools import reduce
 
 import json
 
 from .base import ProbabilisticModel, remove_none_values_from_dict
-from .factor import Factor, mul
+from .factor import Factor, multiply_and_sum_out, multiply_and_project
 from .cpt import CPT
+from .elimination import get_adjacency, greedy_ordering
 
 from . import error
 
@@ -59,54 +60,192 @@ class Bag(ProbabilisticModel):
         return self._scope(self._factors)
 
     # --- inference ---
-    def find_elimination_ordering(self, Q, factors):
+    def find_elimination_ordering(self, Q, factors, heuristic='weighted-min-fill'):
         """Return a variable ordering for a set of factors.
 
-        The result will only contain variables *not* in Q.
+        The ordering is found greedily on the factors' interaction graph (see
+        `elimination.greedy_ordering()`). The result will only contain
+        variables *not* in Q.
+
+        Args:
+            Q (list): variables to keep.
+            factors (list): list of Factors.
+            heuristic (str): one of 'min-degree', 'min-fill' or
+                'weighted-min-fill'.
+
+        Returns:
+            list of variables.
+        """
+        cardinalities = {}
+        edges = []
+
+        for f in factors:
+            cardinalities.update({RV: len(f.states[RV]) for RV in f.scope})
+            edges += itertools.combinations(f.scope, 2)
+
+        adjacency = get_adjacency(cardinalities, edges)
+
+        return greedy_ordering(adjacency, heuristic, cardinalities, keep=set(Q))
+
+    @staticmethod
+    def _prune_barren(factors, relevant):
+        """Remove CPTs of barren variables.
+
+        A variable is barren if it is not relevant (i.e. queried or observed)
+        and it has no children: summing it out of its CPT yields 1.
+        Removing a CPT can make its parents barren. CPTs that are not
+        normalized are never removed.
+
+        Args:
+            factors (list): list of Factors.
+            relevant (set): variables that should be kept.
+
+        Returns:
+            list of Factors.
+        """
+        containing = defaultdict(set)
+
+        for idx, f in enumerate(factors):
+            for RV in f.scope:
+                containing[RV].add(idx)
+
+        def is_barren(idx):
+            f = factors[idx]
+
+            if not isinstance(f, CPT):
+                return False
+
+            barren = all(
+                RV not in relevant and containing[RV] == {idx}
+                for RV in f.conditioned
+            )
+
+            if not barren:
+                return False
+
+            # The conditioned variables are the rightmost axes.
+            axes = tuple(range(-len(f.conditioned), 0))
+            return np.allclose(f.values.sum(axis=axes), 1)
+
+        stack = [idx for idx in range(len(factors)) if is_barren(idx)]
+        pruned = set()
+
+        while stack:
+            idx = stack.pop()
+
+            if idx in pruned or not is_barren(idx):
+                continue
+
+            pruned.add(idx)
+
+            for RV in factors[idx].scope:
+                containing[RV].discard(idx)
+
+                if len(containing[RV]) == 1:
+                    stack.extend(containing[RV])
+
+        return [f for idx, f in enumerate(factors) if idx not in pruned]
+
+    @staticmethod
+    def _prune_disconnected(factors, Q):
+        """Remove factors that are not connected to Q.
+
+        After the evidence has been applied, these factors only contribute a
+        constant to the joint over Q.
+
+        Args:
+            factors (list): list of Factors.
+            Q (list): query variables.
+
+        Returns:
+            list of Factors.
         """
-        scope = self._scope(factors)
-        return [v for v in scope if v not in Q]
+        containing = defaultdict(list)
+
+        for idx, f in enumerate(factors):
+            for RV in f.scope:
+                containing[RV].append(idx)
+
+        connected = set()
+        visited = set(Q)
+        stack = list(Q)
+
+        while stack:
+            RV = stack.pop()
+
+            for idx in containing[RV]:
+                if idx not in connected:
+                    connected.add(idx)
+                    new = set(factors[idx].scope) - visited
+                    visited.update(new)
+                    stack.extend(new)
+
+        return [f for idx, f in enumerate(factors) if idx in connected]
 
-    def eliminate(self, Q, evidence=None):
-        """Perform variable elimination."""
+    def eliminate(self, Q, evidence=None, heuristic='weighted-min-fill',
+                  keep_constants=True):
+        """Perform variable elimination.
+
+        Only the factors that are relevant to the query are used: CPTs of
+        barren variables are pruned and factors are reduced by the evidence
+        (i.e. the axes of observed variables that are not in Q are removed).
+
+        Args:
+            Q (list): variables to compute the joint over. If Q is a list, the
+                result's scope will have the same order.
+            evidence (dict): dict of states, indexed by RV.
+            heuristic (str): heuristic for the elimination ordering; see
+                `find_elimination_ordering()`.
+            keep_constants (bool): if False, factors that are disconnected
+                from Q after applying the evidence are not multiplied in; the
+                result is then only *proportional* to P(Q, evidence).
+
+        Returns:
+            Factor: joint over Q and the evidence.
+        """
         if evidence is None:
             evidence = {}
 
-        # Initialize the list of factors and apply the evidence
-        factors = list(self._factors)
+        factors = self._prune_barren(list(self._factors), set(Q) | set(evidence))
+
+        # Evidence on a variable in Q is applied by setting the other states
+        # to zero, to retain the variable's axis.
+        reduce_ev = {RV: s for RV, s in evidence.items() if RV not in Q}
+        zero_ev = {RV: s for RV, s in evidence.items() if RV in Q}
 
-        # factors = [f.keep_values(**evidence) for f in factors]
-        factors = [f.set_complement(0, **evidence) for f in factors]
+        for idx, f in enumerate(factors):
+            if any(RV in reduce_ev for RV in f.scope):
+                f = f.reduce(**reduce_ev)
+
+            if any(RV in zero_ev for RV in f.scope):
+                f = f.set_complement(0, **zero_ev)
+
+            factors[idx] = f
+
+        if not keep_constants:
+            factors = self._prune_disconnected(factors, Q)
 
         # ordering will contain a list of variables *not* in Q, i.e. the
         # remaining variables from the full distribution.
-        ordering = self.find_elimination_ordering(Q, factors)
+        ordering = self.find_elimination_ordering(Q, factors, heuristic)
 
         # Iterate over the variables in the ordering.
         for X in ordering:
             # Find factors that have the current variable 'X' in scope
             related_factors = [f for f in factors if X in f.scope]
 
-            # Multiply all related factors with each other and sum out 'X'
-            new_factor = reduce(mul, related_factors)
-            new_factor = new_factor.sum_out(X)
+            # Multiply all related factors with each other and sum out 'X'.
+            # This is done in a single step, so the full product is never
+            # allocated.
+            new_factor = multiply_and_sum_out(related_factors, X)
 
             # Replace the factors we have eliminated with the new factor.
             factors = [f for f in factors if f not in related_factors]
             factors.append(new_factor)
 
-        result = reduce(mul, factors)
-
-        if isinstance(result, Factor):
-            try:
-                result = result.reorder_scope(Q)
-                # result.sort_index()
-            except Exception as e:
-                log.error(f'Could not reorder scope: {e}')
-                log.error(result.scope)
-                pass
-
-        return result
+        # The remaining factors only cover variables in Q; their product
+        # is returned with the scope ordered as Q.
+        return multiply_and_project(factors, list(Q))
 
     def compute_posterior(self, qd, qv, ed, ev):
         """Compute the probability of the query variables given the evidence.
@@ -133,7 +272,8 @@ class Bag(ProbabilisticModel):
         evidence_vars = list(ev.keys()) + ed
 
         # First, compute the joint over the query variables and the evidence.
-        result = self.eliminate(query_vars + ed, ev)
+        # Constants cancel out when normalizing.
+        result = self.eliminate(query_vars + ed, ev, keep_constants=False)
         result = result.normalize()
 
         # At this point, result's scope is over all query and evidence variables
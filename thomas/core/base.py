@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+from functools import lru_cache
+
 import pandas as pd
 
 def index_to_dict(idx):
@@ -15,6 +17,38 @@ def remove_none_values_from_dict(dict_):
    return result
 
 
+@lru_cache(maxsize=1024)
+def _parse_query_string(query_string):
+    """Parse a query string; see ProbabilisticModel.parse_query_string().
+
+    Returns:
+        tuple: (query_dist, query_values, evidence_dist, evidence_values),
+            with the values as tuples of (key, value) pairs.
+    """
+    def split(s):
+        dist, values = [], []
+        params = []
+
+        if s:
+            params = s.split(',')
+
+        for p in params:
+            if '=' in p:
+                key, value = p.split('=')
+                values.append((key, value))
+            else:
+                dist.append(p)
+
+        return tuple(dist), tuple(values)
+
+    query_str, given_str = query_string, ''
+
+    if '|' in query_str:
+        query_str, given_str = query_string.split('|')
+
+    return split(query_str) + split(given_str)
+
+
 # ------------------------------------------------------------------------------
 # ProbabilisticModel
 # ------------------------------------------------------------------------------
@@ -30,29 +64,11 @@ class ProbabilisticModel(object):
             query_values = {'G': 'g1'}
             evidence_dist = ('D',)
             evidence_values = {'L': 'l0'}
-        """
-        def split(s):
-            dist, values = [], {}
-            params = []
-
-            if s:
-                params = s.split(',')
-
-            for p in params:
-                if '=' in p:
-                    key, value = p.split('=')
-                    values[key] = value
-                else:
-                    dist.append(p)
 
-            return dist, values
-
-        query_str, given_str = query_string, ''
-
-        if '|' in query_str:
-            query_str, given_str = query_string.split('|')
-
-        return split(query_str) + split(given_str)
+        Parsed query strings are cached; each call returns new lists/dicts.
+        """
+        qd, qv, ed, ev = _parse_query_string(query_string)
+        return list(qd), dict(qv), list(ed), dict(ev)
 
     @classmethod
     def create_query_string(cls, qd=None, qv=None, ed=None, ev=None):
@@ -12,18 +12,21 @@ import networkx.algorithms.moral
 import numpy as np
 import pandas as pd
 from pandas.core.dtypes.dtypes import CategoricalDtype
-from functools import reduce
 
 import json
 
 from . import options
-from .factor import Factor, mul
+from .factor import Factor, mul, encode_data, count_codes, _aligned_values
 from .cpt import CPT
 from .jpt import JPT
 
 from .base import ProbabilisticModel
 from .bag import Bag
+from .query import Query
+from . import sampling
 from .junctiontree import JunctionTree, TreeNode
+from .elimination import get_adjacency, greedy_ordering, find_ordering
+from .elimination import get_total_table_size
 
 from . import error
 
@@ -66,6 +69,16 @@ class BayesianNetwork(ProbabilisticModel):
         self.nodes = {}
         self.evidence = {}
 
+        # Cached junction tree and the ordering used to build it
+        self._jt = None
+        self._elimination_order = None
+
+        # Cached query results (LRU); disabled by default.
+        self._query_cache = None
+        self._query_cache_maxsize = 0
+        self._query_cache_hits = 0
+        self._query_cache_misses = 0
+
         # Process the nodes and edges.
         if nodes:
             self.add_nodes(nodes)
@@ -73,11 +86,6 @@ class BayesianNetwork(ProbabilisticModel):
             if edges:
                 self.add_edges(edges)
 
-        self.elimination_order = None
-
-        # Cached junction tree
-        self._jt = None
-
         # Widget ...
         self.__widget = None
 
@@ -105,6 +113,22 @@ class BayesianNetwork(ProbabilisticModel):
 
         return edges
 
+    @property
+    def elimination_order(self):
+        """Elimination ordering or heuristic used to build the junction tree.
+
+        Either an explicit ordering or the name of a heuristic (see
+        `thomas.core.elimination.HEURISTICS`); `None` selects the default.
+        Setting it discards the junction tree and the query cache.
+        """
+        return self._elimination_order
+
+    @elimination_order.setter
+    def elimination_order(self, order):
+        self._elimination_order = order
+        self._jt = None
+        self._invalidate_query_cache()
+
     @property
     def junction_tree(self):
         """Return the junction tree for this network."""
@@ -245,8 +269,10 @@ class BayesianNetwork(ProbabilisticModel):
         """Add a Node to the network."""
         for node in nodes:
             self.nodes[node.RV] = node
+            node._network = self
 
         self._jt = None
+        self._invalidate_query_cache()
 
     def add_edges(self, edges):
         """Recreate the edges using the nodes' CPTs."""
@@ -254,6 +280,7 @@ class BayesianNetwork(ProbabilisticModel):
             self.nodes[parent_RV].add_child(self.nodes[child_RV])
 
         self._jt = None
+        self._invalidate_query_cache()
 
     def moralize_graph(self):
         """Return the moral graph for the DAG.
@@ -271,30 +298,151 @@ class BayesianNetwork(ProbabilisticModel):
         return list(G_moral.edges)
 
     # -- parameter estimation
-    def EM_learning(self, data, max_iterations=1, notify=True):
-        """Perform parameter learning.
+    def _EM_statistics(self, groups, chunksize=None):
+        """Compute the expected counts for all families (E-step).
+
+        Args:
+            groups (list): (RVs, codes, weights) tuples as returned by
+                `_group_by_missing()`.
+            chunksize (int): maximum number of rows to propagate at once.
+
+        Returns:
+            tuple (dict, float): the expected counts, indexed by RV, with
+            axes in the order of `node.cpt.scope` (states in the order of the
+            nodes' states, like the cluster beliefs) and the log-likelihood
+            of the rows.
+        """
+        # Each family is contained in (at least) one cluster.
+        jt = self.junction_tree
+        families = {node: jt.get_node_for_family(node.vars) for node in self.nodes.values()}
+        clusters = list(set(families.values()))
+        jt.expand_evidence()
+        jt.ensure_compiled()
+
+        # Expected counts, indexed by cluster.
+        stats = {n: np.zeros(n._potential.shape) for n in clusters}
+        loglikelihood = 0
+
+        for observed, values, weights in groups:
+            size = chunksize or len(weights)
+
+            for start in range(0, len(weights), size):
+                chunk = {
+                    RV: values[start:start+size, i]
+                    for i, RV in enumerate(observed)
+                }
+                w = weights[start:start+size]
+
+                likelihoods = self._evidence_likelihoods(chunk)
+
+                # Scaled propagation yields normalized beliefs (all zeros
+                # if the evidence is impossible) and log P(e) without
+                # underflowing.
+                beliefs, logPe = jt.propagate_batch(likelihoods, clusters, scaled=True)
+                loglikelihood += (w * np.broadcast_to(logPe, w.shape)).sum()
+
+                for n, belief in beliefs.items():
+                    belief = np.broadcast_to(belief, (len(w), *belief.shape[1:]))
+                    stats[n] += np.tensordot(w, belief, axes=(0, 0))
+
+        counts = {}
+
+        for node, cluster in families.items():
+            labels = [cluster._labels[RV] for RV in node.cpt.scope]
+            all_labels = list(range(len(cluster._scope)))
+            counts[node.RV] = np.einsum(stats[cluster], all_labels, labels)
+
+        return counts, loglikelihood
+
+    def _update_CPTs(self, counts):
+        """Update the CPTs from the (expected) counts of their families.
+
+        Parent configurations without any counts get all zeros.
+
+        Args:
+            counts (dict): (expected) counts, indexed by RV, with axes in the
+                order of `node.cpt.scope` and states in the order of the
+                nodes' states (which may differ from the CPT's).
+        """
+        for RV, node in self.nodes.items():
+            scope = node.cpt.scope
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = counts[RV] / counts[RV].sum(axis=-1, keepdims=True)
+
+            values[np.isnan(values)] = 0
+
+            node.cpt = CPT(
+                values,
+                states={v: self.nodes[v].states for v in scope},
+                conditioned=node.conditioned
+            )
+
+    def EM_learning(self, data, max_iterations=1, tol=None, chunksize=None,
+                    n_jobs=None, notify=True):
+        """Perform parameter learning using Expectation Maximization.
+
+        The E-step computes the expected counts for all families at once:
+        the unique rows in `data` are grouped by their pattern of missing
+        values and each group is propagated through the junction tree as a
+        single (weighted) batch.
+
         Sources:
             * https://www.cse.ust.hk/bnbook/pdf/l07.h.pdf
             * https://www.youtube.com/watch?v=NDoHheP2ww4
+
+        Args:
+            data (pandas.DataFrame): dataset that contains columns with names
+                corresponding to the variables in this BN's scope. Missing
+                values (NAs) are marginalized.
+            max_iterations (int): maximum number of iterations.
+            tol (float): stop when the log-likelihood improves by less than
+                `tol` (relative to its absolute value). If None, exactly
+                `max_iterations` iterations are performed.
+            chunksize (int): maximum number of unique rows to propagate at
+                once. Limits memory use.
+            n_jobs (int): number of worker processes for the E-step. The
+                unique rows are sharded across the workers; each worker
+                keeps its own copy of the network. Use -1 for one worker per
+                CPU. If None, the E-step runs in this process.
+            notify (bool): whether to update the widget after each iteration.
+
+        Returns:
+            list of floats: the log-likelihood of the data at the start of
+            each iteration.
         """
-        # Children (i.e. nodes with parents) identify the families in the BN.
-        nodes_with_parents = self.nodes_with_parents
-        nodes_without_parents = self.nodes_without_parents
-
-        # Create a dataset with unique rows (& counts) ...
-        overlapping_cols = list(set(data.columns).intersection(self.vars))
-        counts = data.fillna('NaN')
-        counts = counts.groupby(overlapping_cols, observed=True).size()
-        counts.name = 'count'
-        counts = pd.DataFrame(counts)
-        counts = counts.reset_index()
-        counts = counts[counts['count'] > 0]
-        counts = counts.reset_index(drop=True)
-        counts = counts.replace('NaN', np.nan)
-
-        # print()
-        # print('counts:')
-        # print(counts)
+        # Encode the data and find the unique rows (& counts).
+        codes = self._encode_data(data)
+        RVs = list(codes.keys())
+
+        if RVs:
+            matrix = np.stack([codes[RV] for RV in RVs], axis=1)
+            patterns, weights = np.unique(matrix, axis=0, return_counts=True)
+        else:
+            patterns = np.empty((1, 0), dtype=int)
+            weights = np.array([len(data)])
+
+        if n_jobs is not None and n_jobs < 0:
+            n_jobs = os.cpu_count()
+
+        workers = []
+
+        if n_jobs is not None and n_jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            # Every worker gets its own shard of the unique rows. The network
+            # is only shipped once; after that, only the CPTs' values are.
+            bn = self.as_dict()
+            shards = np.array_split(np.arange(len(weights)), n_jobs)
+
+            for shard in [s for s in shards if len(s)]:
+                workers.append(ProcessPoolExecutor(
+                    max_workers=1,
+                    initializer=_EM_worker_init,
+                    initargs=(bn, RVs, patterns[shard], weights[shard], chunksize)
+                ))
+        else:
+            groups = _group_by_missing(RVs, patterns, weights)
 
         iterator = range(max_iterations)
 
@@ -307,161 +455,407 @@ class BayesianNetwork(ProbabilisticModel):
                 print('Could not instantiate tqdm')
                 print(e)
 
+        history = []
 
-        for k in iterator:
-            # print(f'--- iteration {k} ---')
+        try:
+            for k in iterator:
+                if workers:
+                    # The CPTs' states may be ordered differently than the
+                    # nodes' (and change order after an update), so only
+                    # ship values aligned to the nodes' states.
+                    signatures = {RV: tuple(s) for RV, s in self.states.items()}
+                    CPTs = {
+                        RV: _aligned_values(n.cpt, signatures)
+                        for RV, n in self.nodes.items()
+                    }
+                    futures = [w.submit(_EM_worker_step, CPTs) for w in workers]
+                    results = [f.result() for f in futures]
+
+                    counts = {
+                        RV: sum(r[0][RV] for r in results) for RV in self.nodes
+                    }
+                    loglikelihood = sum(r[1] for r in results)
+                else:
+                    counts, loglikelihood = self._EM_statistics(groups, chunksize)
+
+                history.append(loglikelihood)
+
+                self._update_CPTs(counts)
+                self.reset_evidence(notify=False)
+
+                # Update the widget after each iteration
+                if self.__widget and notify:
+                    self.__widget.update()
+
+                if tol is not None and len(history) > 1:
+                    if abs(history[-1] - history[-2]) <= tol * abs(history[-2]):
+                        break
+        finally:
+            for w in workers:
+                w.shutdown()
 
-            # dict of joint distributions, indexed by family index
-            joints = {}
+        return history
 
-            # Iterate over the data: set a row as evidence and compute the
-            # JPT for each family.
-            # for idx, row in counts.iterrows():
-            for row_idx, row in counts.iterrows():
+    def _iter_chunks(self, data, chunksize=None, **kwargs):
+        """Iterate over (chunks of) a dataset.
 
-                N = row.pop('count')
-                evidence = row.dropna().to_dict()
+        Args:
+            data (pandas.DataFrame, iterable, str): a DataFrame, an iterable
+                of DataFrames (e.g. the result of `pd.read_csv(...,
+                chunksize=n)`) or the path to a CSV file.
+            chunksize (int): number of rows per chunk when reading from a
+                file. If None, the file is read at once.
+            **kwargs: passed to `pandas.read_csv()`.
+
+        Yields:
+            pandas.DataFrame
+        """
+        if isinstance(data, pd.DataFrame):
+            yield data
+            return
 
-                self.reset_evidence()
-                self.junction_tree.set_evidence_hard(**evidence)
+        if isinstance(data, (str, os.PathLike)):
+            # Only read the columns that we need; read states as strings so
+            # they're not parsed as numbers.
+            kwargs.setdefault('usecols', lambda col: col in self.nodes)
+            kwargs.setdefault('dtype', {
+                RV: str for RV, node in self.nodes.items()
+                if all(isinstance(state, str) for state in node.states)
+            })
 
-                # print(f'------ row: {row_idx} ------\n{row}\n')
-                # print(f'------ row: {row_idx} ------')
-                # print(f'Setting evidence: {evidence}')
-                # print(f'Weight: {N}')
-                # print()
+            data = pd.read_csv(data, chunksize=chunksize, **kwargs)
 
-                for node in nodes_with_parents:
-                    # print(f'======== Processing node for {node.cpt.display_name} ========')
-                    jt_node = self.junction_tree.get_node_for_family(node.vars)
+            if chunksize is None:
+                data = [data]
 
-                    # print(f'Using JT node with cluster {jt_node.label}')
-                    jpt = jt_node.joint * N
+        yield from data
 
-                    # print()
-                    # print(f'JPT:\n{jpt}\n')
+    def ML_estimation(self, data, pseudocount=0, chunksize=None, **kwargs):
+        """Perform Maximum Likelihood estimation of the BN parameters.
+
+        Only the families (i.e. a node and its parents) are counted, so this
+        scales linearly with the number of nodes. Rows with missing values
+        for a family's variables are ignored for that family; use
+        `EM_learning()` to properly account for missing values.
+
+        Data can be streamed: counts are accumulated per chunk, so memory use
+        does not depend on the number of rows.
+
+        *** Note: this will overwrite any CPTs already set. ***
+
+        Args:
+            data (pandas.DataFrame, iterable, str): dataset that contains
+                columns with names corresponding to the variables in this
+                BN's scope. Can also be an iterable of DataFrames (chunks)
+                or the path to a CSV file.
+            pseudocount (float): Dirichlet prior; added to every count. Use 1
+                for Laplace smoothing.
+            chunksize (int): number of rows to read at once if `data` is a
+                path. If None, the file is read at once.
+            **kwargs: passed to `pandas.read_csv()` if `data` is a path.
+        """
+        # Codes (and thus counts) follow the order of the nodes' states.
+        counts = {
+            RV: np.zeros([len(self.nodes[v].states) for v in node.cpt.scope])
+            for RV, node in self.nodes.items()
+        }
 
-                    joints[node] = joints[node] + jpt if node in joints else jpt
+        for chunk in self._iter_chunks(data, chunksize, **kwargs):
+            codes = self._encode_data(chunk)
 
-                # print()
+            for RV, node in self.nodes.items():
+                scope = node.cpt.scope
 
-            # Update CPTs for nodes *with* parents
-            for node in nodes_with_parents:
-                jpt = joints[node].project(node.vars)
+                if not set(scope).issubset(codes):
+                    missing = set(scope) - set(codes)
+                    raise error.NotInScopeError(missing, set(chunk.columns))
 
-                node.cpt = CPT(
-                    data=jpt / jpt.project(node.conditioning),
-                    conditioned=node.conditioned
+                counts[RV] += count_codes(
+                    [codes[v] for v in scope],
+                    counts[RV].shape
                 )
 
-            # Update JPTs for nodes *without* parents
-            for node in nodes_without_parents:
-                for jpt in joints.values():
-                    # Find a JPT that contains this node's RV
-                    if node.vars.issubset(jpt.vars):
-                        node.cpt = CPT(
-                            data=jpt.project(node.vars).normalize(),
-                            conditioned=node.conditioned
-                        )
-
-                        # Break from the *inner* for loop
-                        break
+        for RV in counts:
+            counts[RV] += pseudocount
 
-            # Since the JT is linked to the BN's nodes' CPTs, we'll need to
-            # invalidate the cache to recompute the probabilities. Setting
-            # hard=True is needed to enforce recomputing joints.
-            self.reset_evidence()
-            self.jt.invalidate_caches(hard=True)
+        self._update_CPTs(counts)
 
-            # Update the widget after each iteration
-            if self.__widget and notify:
-                self.__widget.update()
+        # Update the widget
+        if self.__widget:
+            self.__widget.update()
 
-    def ML_estimation(self, df):
-        """Perform Maximum Likelihood estimation of the BN parameters.
+    def likelihood(self, df, per_case=False):
+        """Return the likelihood of the current network parameters given data.
 
-        *** Note: this will overwrite any CPTs already set. ***
+        Args:
+            df (pandas.DataFrame): data; see `log_likelihood()`.
+            per_case (bool): return the probability of each row instead of
+                their product.
+
+        Returns:
+            float or pandas.Series (iff per_case is True).
+        """
+        if per_case:
+            P = np.exp(self.log_likelihood(df, per_case=True))
+            return pd.Series(P, index=df.index)
+
+        # Multiplying the results underflows for larger datasets.
+        return np.exp(self.log_likelihood(df))
+
+    def log_likelihood(self, data, chunksize=None, per_case=False, **kwargs):
+        """Return the log-likelihood of the network parameters given data.
+
+        Complete rows are scored using the chain rule: the CPT entries are
+        looked up for all rows at once. Rows with missing values (NAs) are
+        grouped by the variables they observe; identical rows are only
+        propagated once and the missing values are marginalized out.
 
         Args:
-            df (pandas.Dataframe): dataset that contains columns with names
-                corresponding to the variables in this BN's scope.
+            data (pandas.DataFrame, iterable, str): dataset that contains
+                columns with names corresponding to the variables in this
+                BN's scope. Can also be an iterable of DataFrames (chunks)
+                or the path to a CSV file.
+            chunksize (int): number of rows to read and propagate at once.
+                Limits memory use. If None, all rows are processed at once.
+            per_case (bool): return the log-probability of each row instead
+                of their sum.
+            **kwargs: passed to `pandas.read_csv()` if `data` is a path.
+
+        Returns:
+            float: the sum of the natural logarithm of P(row) over all rows
+            (-inf if any of the rows is impossible) or, iff per_case is
+            True, a numpy.ndarray with the log-probability of each row.
         """
+        results = []
 
-        # The empirical distribution may not contain all combinations of
-        # variable states; `from_data` fixes that by setting all missing entries
-        # to 0.
-        jpt = JPT.from_data(df, cols=self.scope)
+        for chunk in self._iter_chunks(data, chunksize, **kwargs):
+            codes = self._encode_data(chunk)
 
-        for name, node in self.nodes.items():
-            # print(name, node, node.cpt)
-            cpt = jpt.compute_dist(node.conditioned, node.conditioning)
-            node.cpt = cpt
+            if codes:
+                results.append(self._log_probabilities(codes, chunksize))
+            else:
+                # Nothing observed: every row has probability 1.
+                results.append(np.zeros(len(chunk)))
 
-        # CPTs have updated, so cache is no longer valid. JunctionTree will have
-        # to be recreated.
-        self._jt = None
+        logP = np.concatenate(results) if results else np.zeros(0)
 
-        # Update the widget
-        if self.__widget:
-            self.__widget.update()
+        if per_case:
+            return logP
 
+        return float(logP.sum())
 
-    def likelihood(self, df, per_case=False):
-        """Return the likelihood of the current network parameters given data.
+    def _log_probabilities(self, codes, chunksize=None):
+        """Return log P(row) for integer coded rows.
+
+        Args:
+            codes (dict): arrays of ints, indexed by RV (see _encode_data).
+            chunksize (int): maximum number of rows to propagate at once.
 
-        Warning: naive/slow implementation :-)
+        Returns:
+            numpy.ndarray of floats with one entry per row.
         """
-        # Create a subset of the dataframe that only contains relevant columns
-        vars = self.vars.intersection(df.columns)
-        subset = df[vars]
+        RVs = list(codes)
+        matrix = np.stack([codes[RV] for RV in RVs], axis=1)
+        logP = np.zeros(len(matrix))
 
-        # Compute the posterior probability for each row of data
-        func = lambda x: self.compute_posterior([], x.dropna().to_dict(), [], {})
+        if set(self.nodes).issubset(codes):
+            complete = (matrix >= 0).all(axis=1)
+        else:
+            complete = np.zeros(len(matrix), dtype=bool)
 
-        result = subset.apply(func, axis=1)
+        if complete.any():
+            logP[complete] = self._chain_rule_log_probabilities(
+                {RV: coded[complete] for RV, coded in codes.items()}
+            )
 
-        if per_case:
-            return result
+        incomplete = np.flatnonzero(~complete)
+
+        if len(incomplete):
+            patterns, inverse = np.unique(
+                matrix[incomplete],
+                axis=0,
+                return_inverse=True
+            )
+            inverse = np.asarray(inverse).reshape(-1)
+            pattern_logP = np.empty(len(patterns))
+
+            # Use the pattern indices as weights to map the groups back.
+            groups = _group_by_missing(RVs, patterns, np.arange(len(patterns)))
+
+            for observed, values, idx in groups:
+                pattern_logP[idx] = self._propagated_log_probabilities(
+                    {RV: values[:, i] for i, RV in enumerate(observed)},
+                    len(idx),
+                    chunksize
+                )
+
+            logP[incomplete] = pattern_logP[inverse]
+
+        # Like compute_posterior(), normalize by the total of the joint.
+        return logP - self._log_normalizer()
+
+    def _log_normalizer(self):
+        """Return the log of the sum of the joint distribution.
+
+        This is 0 unless some CPT rows do not sum to 1 (e.g. parent
+        configurations that were never observed during learning).
+        """
+        if all(np.allclose(n.cpt.values.sum(axis=-1), 1) for n in self.nodes.values()):
+            return 0.0
+
+        return self._propagated_log_probabilities({}, 1)[0]
+
+    def _chain_rule_log_probabilities(self, codes):
+        """Return log P(row) for complete rows using the chain rule.
+
+        Args:
+            codes (dict): arrays of ints (without missing values), indexed
+                by RV. Should contain all variables in the network.
 
-        # Multiply the results with each other and return
-        return reduce(lambda x, y: x*y, result)
+        Returns:
+            numpy.ndarray of floats with one entry per row.
+        """
+        # Codes follow the nodes' states; a CPT may order them differently.
+        signatures = {RV: tuple(states) for RV, states in self.states.items()}
+        logP = 0
+
+        with np.errstate(divide='ignore'):
+            for node in self.nodes.values():
+                cpt = node.cpt
+                values = _aligned_values(cpt, signatures)
+                index = tuple(codes[RV] for RV in cpt.scope)
+                logP = logP + np.log(values[index])
+
+        return logP
+
+    def _propagated_log_probabilities(self, codes, N, chunksize=None):
+        """Return log P(row) for rows with missing values.
+
+        The rows are propagated through the junction tree in batches;
+        messages are rescaled during propagation so unlikely rows do not
+        underflow.
+
+        Args:
+            codes (dict): arrays of ints, indexed by RV (see _encode_data).
+                May be empty if nothing is observed.
+            N (int): number of rows.
+            chunksize (int): maximum number of rows to propagate at once.
+
+        Returns:
+            numpy.ndarray of floats with one entry per row.
+        """
+        jt = self.junction_tree
+        jt.expand_evidence()
+        jt.ensure_compiled()
+
+        # P(e) can be read off any node, so only collect to a single one.
+        node = next(iter(jt.nodes.values()))
+        chunksize = chunksize or N
+        results = []
+
+        for start in range(0, N, chunksize):
+            chunk = {RV: c[start:start+chunksize] for RV, c in codes.items()}
+            size = min(chunksize, N - start)
+
+            likelihoods = self._evidence_likelihoods(chunk)
+            _, logPe = jt.propagate_batch(likelihoods, [node], scaled=True)
+            results.append(np.broadcast_to(logPe, (size,)))
+
+        return np.concatenate(results)
 
     # --- inference ---
     # FIXME: this method probably belongs somewhere else
-    def get_node_elimination_order(self):
-        """Return a naïve elimination ordering, based on nodes' degree."""
-        if self.elimination_order is None:
-            G = nx.Graph()
-            G.add_edges_from(self.moralize_graph())
+    def _get_adjacency(self):
+        """Return the moral graph as adjacency sets and the cardinalities."""
+        adjacency = get_adjacency(self.scope, self.moralize_graph())
+        cardinalities = {RV: len(s) for RV, s in self.states.items()}
+        return adjacency, cardinalities
 
-            degrees = list(G.degree)
-            degrees.sort(key=lambda x: x[1])
+    def _resolve_elimination_order(self, order, adjacency=None):
+        """Return an explicit ordering for an ordering or heuristic name.
 
-            self.elimination_order = [d[0] for d in degrees]
+        Args:
+            order (list, str): ordering or heuristic name; see
+                `get_node_elimination_order()`.
+            adjacency (dict): the moral graph as adjacency sets, if it was
+                already computed.
+        """
+        order = order or 'weighted-min-fill'
 
-        return self.elimination_order
+        if isinstance(order, str):
+            if adjacency is None:
+                adjacency, _ = self._get_adjacency()
 
-    def compute_joint_with_jt(self, RVs):
-        """Compute the joint distribution over multiple variables.
+            cardinalities = {RV: len(s) for RV, s in self.states.items()}
+            order = greedy_ordering(adjacency, order, cardinalities)
+
+        return list(order)
+
+    def get_node_elimination_order(self, adjacency=None):
+        """Return the elimination ordering used to create the junction tree.
+
+        `self.elimination_order` can be set to an explicit ordering or to the
+        name of a heuristic (see `thomas.core.elimination.HEURISTICS`).
+        Defaults to 'weighted-min-fill'.
 
         Args:
-            RVs (list or set): Set of random variables to compute joint over.
+            adjacency (dict): the moral graph as adjacency sets, if it was
+                already computed.
+        """
+        return self._resolve_elimination_order(self.elimination_order, adjacency)
+
+    def find_elimination_order(self, heuristic='weighted-min-fill', restarts=0,
+                               seed=None):
+        """Find a cheap elimination ordering for the junction tree.
+
+        The ordering is *not* used until it is assigned to
+        `self.elimination_order`.
+
+        Args:
+            heuristic (str): 'min-degree', 'min-fill' or 'weighted-min-fill'.
+            restarts (int): number of greedy searches with random
+                tie-breaking to perform in addition to the deterministic one.
+            seed (int): seed for the randomized restarts.
 
         Returns:
-            Factor:  marginal distribution over the RVs in Q.
+            tuple (list, int): the elimination ordering and the total size of
+            the (maximal) clusters' tables it induces.
         """
-        Q = set(RVs) if isinstance(RVs, list) else RVs
+        adjacency, cardinalities = self._get_adjacency()
+        return find_ordering(adjacency, cardinalities, heuristic, restarts, seed)
 
-        jt = JunctionTree(self)
-        jt.ensure_cluster(Q)
-        node = jt.get_node_for_set(Q)
+    def get_total_table_size(self, order=None):
+        """Return the total size of the cluster tables induced by an ordering.
+
+        Args:
+            order (list, str): elimination ordering or name of a heuristic.
+                Defaults to `self.elimination_order`.
+
+        Returns:
+            int
+        """
+        order = self._resolve_elimination_order(order or self.elimination_order)
+        adjacency, cardinalities = self._get_adjacency()
+
+        return get_total_table_size(adjacency, order, cardinalities)
+
+    def compute_joint_with_jt(self, RVs):
+        """Compute the (prior) joint distribution over multiple variables.
 
-        joint = node.pull()
+        The RVs do not need to be contained in a single cluster of the
+        junction tree (see `JunctionTree.compute_joint()`).
 
-        if isinstance(RVs, list):
-            joint = joint.reorder_scope(RVs)
+        Note that calling this method will reset any evidence previously set
+        using `set_evidence()`!
+
+        Args:
+            RVs (list or set): Set of random variables to compute joint over.
 
-        return joint
+        Returns:
+            Factor:  marginal distribution over the RVs in Q.
+        """
+        self.junction_tree.replace_evidence()
+        return self.junction_tree.compute_joint(RVs).normalize()
 
     def compute_marginals(self, qd=None, ev=None):
         """Compute the marginals of the query variables given the evidence.
@@ -480,13 +874,14 @@ class BayesianNetwork(ProbabilisticModel):
         if ev is None:
             ev = {}
 
-        # Reset the tree and apply evidence
-        self.junction_tree.reset_evidence()
-        self.junction_tree.set_evidence_hard(**ev)
+        # Replace the evidence in the tree; messages that do not depend on
+        # changed evidence are kept.
+        self.junction_tree.replace_evidence(**ev)
 
         return self.junction_tree.get_marginals(qd)
 
-    def compute_posterior(self, qd, qv, ed, ev, use_VE=False):
+    def compute_posterior(self, qd, qv, ed, ev, use_VE=False, reduce=False,
+                          method=None, **kwargs):
         """Compute the (posterior) probability of query given evidence.
 
         The query P(I,G=g1|D,L=l0) would imply:
@@ -495,42 +890,110 @@ class BayesianNetwork(ProbabilisticModel):
             ed = ['D']
             ev = {'L': 'l0'}
 
+        If the query cache is enabled (see `set_query_cache()`), results are
+        cached and the same query is only computed once.
+
         Args:
             qd (list): query distributions: RVs to query
             qv (dict): query values: RV-values to extract
             ed (list): evidence distributions: coniditioning RVs to include
             ev (dict): evidence values: values to set as evidence.
+            use_VE (bool): use variable elimination instead of the junction
+                tree.
+            reduce (bool): slice the observed variables out of the junction
+                tree (see `JunctionTree.reduce_evidence()`). This pays off
+                when many variables are observed.
+            method (str): 'jt' (junction tree; default), 've' (variable
+                elimination) or one of the approximate methods 'lw'
+                (likelihood weighting) and 'is' (importance sampling). See
+                `estimate_posterior()` for the latter; their results are not
+                cached.
+            **kwargs: passed to `estimate_posterior()` for approximate
+                methods.
 
         Returns:
             CPT or scalar (iff `qv` is specified)
         """
-        # Evidence we can just set on the JT, but we'll need to compute the
-        # joint over the other variables to answer the query.
-        required_RVs = set(qd + list(qv.keys()) + ed)
-        node = self.junction_tree.get_node_for_set(required_RVs)
+        if method in ('lw', 'is'):
+            return self.estimate_posterior(qd, qv, ed, ev, method, **kwargs)[0]
+
+        if method not in (None, 'jt', 've'):
+            raise ValueError(f"Unknown inference method '{method}'")
+
+        use_VE = use_VE or method == 've'
+
+        if self._query_cache is None:
+            return self._compute_posterior(qd, qv, ed, ev, use_VE, reduce)
+
+        key = (
+            tuple(qd),
+            tuple(sorted(qv.items())),
+            tuple(ed),
+            tuple(sorted(ev.items())),
+            use_VE,
+        )
+
+        if key in self._query_cache:
+            self._query_cache.move_to_end(key)
+            self._query_cache_hits += 1
+        else:
+            self._query_cache_misses += 1
+            self._query_cache[key] = self._compute_posterior(
+                qd, qv, ed, ev, use_VE, reduce
+            )
+
+            if len(self._query_cache) > self._query_cache_maxsize:
+                self._query_cache.popitem(last=False)
 
-        if node is None and use_VE == False:
-            log.info('Cannot answer this query with the current junction tree.')
-            use_VE = True
+        # Callers get a copy, so modifying a result does not affect the cache.
+        result = self._query_cache[key]
 
+        if isinstance(result, (Factor, np.ndarray)):
+            return result.copy()
+
+        return result
+
+    def _compute_posterior(self, qd, qv, ed, ev, use_VE=False, reduce=False):
+        """Compute the (posterior) probability of query given evidence.
+
+        See `compute_posterior()`.
+        """
         if use_VE:
             log.debug('Using VE')
             return self.as_bag().compute_posterior(qd, qv, ed, ev)
 
-
-        # Compute the answer to the query using the junction tree.
-        log.debug(f'Found a node in the JT that contains {required_RVs}: {node.cluster}')
-        self.junction_tree.reset_evidence()
-        self.junction_tree.set_evidence_hard(**ev)
-
-        # Process evidence distributions
-        log.debug(f'  Projecting onto {required_RVs} without normalization')
-        result = node.joint.project(set(required_RVs))
+        # Evidence we can just set on the JT, but we'll need to compute the
+        # joint over the other variables to answer the query. If these are
+        # not in a single cluster, messages are combined along the subtree
+        # that connects them.
+        required_RVs = list(dict.fromkeys(qd + list(qv.keys()) + ed))
+        self.junction_tree.replace_evidence(**ev)
+
+        if reduce:
+            self.junction_tree.reduce_evidence(**{
+                RV: state for RV, state in ev.items() if RV not in required_RVs
+            })
+
+        log.debug(f'  Computing the joint over {required_RVs} using the JT')
+        result = self.junction_tree.compute_joint(required_RVs)
         result = result.normalize()
 
         if ed:
             result = result / result.project(set(ed))
 
+        return self._format_posterior(result, qd, qv)
+
+    def _format_posterior(self, result, qd, qv):
+        """Turn a (conditional) joint distribution into a query's result.
+
+        Args:
+            result (Factor): distribution over the query's variables.
+            qd (list): query distributions: RVs to query
+            qv (dict): query values: RV-values to extract
+
+        Returns:
+            CPT or scalar (iff `qv` is specified)
+        """
         # RVs that are part of the query will need to be set as column names.
         query_vars = list(qv.keys()) + qd
 
@@ -543,19 +1006,267 @@ class BayesianNetwork(ProbabilisticModel):
 
         return result
 
+    def estimate_posterior(self, qd, qv, ed, ev, method='lw', samples=100000,
+                           seed=None, tol=None, batchsize=10000):
+        """Estimate the (posterior) probability of query given evidence.
+
+        Uses weighted samples instead of exact inference, so memory use and
+        running time do not depend on the width of the junction tree. The
+        evidence is clamped and the samples are weighted by the probability
+        of the evidence (likelihood weighting) or by P(x, e) / Q(x) where the
+        proposal Q is the network with the evidence pre-propagated
+        (importance sampling). See `sampling.estimate_posterior()`.
+
+        Args:
+            qd (list): query distributions: RVs to query
+            qv (dict): query values: RV-values to extract
+            ed (list): evidence distributions: coniditioning RVs to include
+            ev (dict): evidence values: values to set as evidence.
+            method (str): 'lw' (likelihood weighting) or 'is' (importance
+                sampling).
+            samples (int): maximum number of samples to draw.
+            seed (int, numpy.random.Generator): seed for the random number
+                generator.
+            tol (float): stop sampling as soon as all standard errors are at
+                most `tol`.
+            batchsize (int): number of samples to draw at once.
+
+        Returns:
+            tuple: the estimate and its standard errors; both CPTs, or
+            scalars iff `qv` is specified.
+        """
+        scope = list(dict.fromkeys(qd + list(qv.keys()) + ed))
+        states = {RV: self.nodes[RV].states for RV in scope}
+
+        values, stderr = sampling.estimate_posterior(
+            self, scope, ed, ev, method, samples, seed, tol, batchsize
+        )
+
+        return (
+            self._format_posterior(Factor(values, states), qd, qv),
+            self._format_posterior(Factor(stderr, states), qd, qv),
+        )
+
+    def compile_query(self, query_string):
+        """Compile a query for repeated execution.
+
+        Args:
+            query_string (str): query, e.g. 'I,G=g1|D,L=l0'. Evidence values
+                serve as defaults and can be replaced when executing the
+                query.
+
+        Returns:
+            Query: callable; `query(**evidence)` returns the same result as
+            `compute_posterior()`.
+        """
+        qd, qv, ed, ev = self.parse_query_string(query_string)
+        return Query(self, qd, qv, ed, ev)
+
+    # --- query cache ---
+    def set_query_cache(self, maxsize=128):
+        """Enable (or disable) caching of query results.
+
+        The cache holds the results of `compute_posterior()` (and hence
+        `P()`), indexed by query and evidence. Results are evicted when the
+        network's structure or any of its CPTs changes.
+
+        Args:
+            maxsize (int): maximum number of results to keep; the least
+                recently used result is evicted first. Use 0 or None to
+                disable the cache.
+        """
+        if not maxsize:
+            self._query_cache = None
+            self._query_cache_maxsize = 0
+            return
+
+        if self._query_cache is None:
+            self._query_cache = OrderedDict()
+
+        self._query_cache_maxsize = maxsize
+
+        while len(self._query_cache) > maxsize:
+            self._query_cache.popitem(last=False)
+
+    def clear_query_cache(self):
+        """Remove all results from the query cache and reset its counters."""
+        self._invalidate_query_cache()
+        self._query_cache_hits = 0
+        self._query_cache_misses = 0
+
+    def query_cache_info(self):
+        """Return statistics of the query cache.
+
+        Returns:
+            dict with keys 'hits', 'misses', 'maxsize' and 'currsize'.
+        """
+        return {
+            'hits': self._query_cache_hits,
+            'misses': self._query_cache_misses,
+            'maxsize': self._query_cache_maxsize,
+            'currsize': len(self._query_cache or []),
+        }
+
+    def _invalidate_query_cache(self):
+        """Remove all results from the query cache."""
+        if self._query_cache is not None:
+            self._query_cache.clear()
+
+    def _cpt_changed(self, RV):
+        """Invalidate cached results that depend on the CPT of RV.
+
+        Called by a node when its CPT is replaced.
+        """
+        self._invalidate_query_cache()
+
+        if self._jt is not None and RV in self._jt._RVs:
+            self._jt.invalidate_cpt(RV)
+
+    def _encode_data(self, df):
+        """Integer-code the columns of a DataFrame against the nodes' states.
+
+        Only columns that correspond to variables in the network are used.
+
+        Args:
+            df (pandas.DataFrame): data
+
+        Returns:
+            dict of numpy.ndarray of ints, indexed by RV. Missing values are
+            coded as -1.
+        """
+        return encode_data(df, self.states)
+
+    def _evidence_likelihoods(self, codes):
+        """Convert integer codes to (one-hot) likelihoods.
+
+        Args:
+            codes (dict): arrays of ints, indexed by RV (see _encode_data)
+
+        Returns:
+            dict of arrays of shape (N, |states|), indexed by RV. Rows
+            without evidence (code -1) are all ones.
+        """
+        likelihoods = {}
+
+        for RV, coded in codes.items():
+            observed = coded >= 0
+
+            if not observed.any():
+                continue
+
+            values = np.ones((len(coded), len(self.nodes[RV].states)))
+            values[observed, :] = 0
+            values[observed, coded[observed]] = 1
+            likelihoods[RV] = values
+
+        return likelihoods
+
+    def compute_posterior_batch(self, qd, evidence, chunksize=None):
+        """Compute the posterior over qd for many evidence configurations.
+
+        All rows are propagated through the (compiled) junction tree at once
+        by giving the indicators a leading batch axis.
+
+        Args:
+            qd (list): query distributions: RVs to query. These should be
+                contained in a single cluster of the junction tree; if they
+                are not, the tree is extended using `ensure_cluster()`.
+            evidence (pandas.DataFrame): one evidence configuration per row.
+                Columns that do not correspond to a variable in the network
+                are ignored; missing values (NAs) are not used as evidence.
+            chunksize (int): maximum number of rows to propagate at once.
+                Limits memory use. If None, all rows are propagated at once.
+
+        Returns:
+            numpy.ndarray of shape (N, |states of qd[0]|, ...). Rows with
+            evidence that is impossible are NaN.
+        """
+        qd = [qd] if isinstance(qd, str) else list(qd)
+        Q = set(qd)
+
+        jt = self.junction_tree
+        node = jt.get_node_for_set(Q)
+
+        if node is None:
+            jt.ensure_cluster(Q)
+            node = jt.get_node_for_set(Q)
+
+        jt.expand_evidence()
+        jt.ensure_compiled()
+
+        codes = self._encode_data(evidence)
+        N = len(evidence)
+        chunksize = chunksize or N
+
+        if N == 0:
+            return np.empty((0, *[len(self.nodes[RV].states) for RV in qd]))
+
+        # Axes to sum out and the permutation of the remaining axes to qd.
+        axes = tuple(1 + i for i, RV in enumerate(node._scope) if RV not in Q)
+        remaining = [RV for RV in node._scope if RV in Q]
+        order = [0] + [1 + remaining.index(RV) for RV in qd]
+
+        results = []
+
+        for start in range(0, N, chunksize):
+            chunk = {RV: c[start:start+chunksize] for RV, c in codes.items()}
+            size = min(chunksize, N - start)
+
+            likelihoods = self._evidence_likelihoods(chunk)
+            beliefs, _ = jt.propagate_batch(likelihoods, [node], scaled=True)
+            belief = beliefs[node]
+
+            joint = belief.sum(axis=axes).transpose(order)
+            joint = np.broadcast_to(joint, (size, *joint.shape[1:]))
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                totals = joint.reshape(size, -1).sum(axis=1)
+                totals = totals.reshape((size,) + (1,) * len(qd))
+                results.append(joint / totals)
+
+        return np.concatenate(results)
+
+    # --- sampling ---
+    def sample(self, n, seed=None, evidence=None):
+        """Draw samples from the network using ancestral sampling.
+
+        Nodes are sampled in topological order; each node's states are
+        drawn for all samples at once, using its CPT row for the parents'
+        sampled states. If evidence is given, samples that are inconsistent
+        with it are rejected (see `sampling.sample()`).
+
+        Args:
+            n (int): number of samples.
+            seed (int, numpy.random.Generator): seed for the random number
+                generator.
+            evidence (dict): states, indexed by RV.
+
+        Returns:
+            pandas.DataFrame with a categorical column for each variable.
+        """
+        return sampling.sample(self, n, seed=seed, evidence=evidence)
+
     def reset_evidence(self, RVs=None, notify=True):
         """Reset evidence."""
         self.junction_tree.reset_evidence(RVs)
 
         if RVs:
             for RV in RVs:
-                del self.evidence[RV]
+                self.evidence.pop(RV, None)
         else:
             self.evidence = {}
 
         if self.__widget and notify:
             self.__widget.update()
 
+    def retract_evidence(self, RV, notify=True):
+        """Retract the evidence on a single variable.
+
+        Only the messages that depend on RV's evidence are recomputed on the
+        next query.
+        """
+        self.reset_evidence([RV], notify)
+
     def set_evidence_likelihood(self, RV, **kwargs):
         """Set likelihood evidence on a variable."""
         self.junction_tree.set_evidence_likelihood(RV, **kwargs)
@@ -686,6 +1397,69 @@ class BayesianNetwork(ProbabilisticModel):
             data = fp.read()
             return cls.from_json(data)
 
+# ------------------------------------------------------------------------------
+# EM helpers
+# ------------------------------------------------------------------------------
+def _group_by_missing(RVs, patterns, weights):
+    """Group (unique) rows of integer codes by their pattern of missing values.
+
+    Args:
+        RVs (list): names of the columns of `patterns`.
+        patterns (numpy.ndarray): matrix of integer codes; -1 for missing.
+        weights (numpy.ndarray): weight (count) for each row.
+
+    Returns:
+        list of (RVs, codes, weights) tuples: the observed variables, the
+        codes for these variables and the weights, for each group.
+    """
+    masks, group_idx = np.unique(patterns >= 0, axis=0, return_inverse=True)
+    group_idx = np.asarray(group_idx).reshape(-1)
+
+    groups = []
+
+    for g, mask in enumerate(masks):
+        rows = group_idx == g
+        observed = [RV for RV, m in zip(RVs, mask) if m]
+        columns = [i for i, m in enumerate(mask) if m]
+        groups.append((observed, patterns[rows][:, columns], weights[rows]))
+
+    return groups
+
+# State of an EM worker process; set by _EM_worker_init().
+_EM_worker = {}
+
+def _EM_worker_init(bn, RVs, patterns, weights, chunksize):
+    """Initialize an EM worker process with its own copy of the network."""
+    _EM_worker['bn'] = BayesianNetwork.from_dict(bn)
+    _EM_worker['groups'] = _group_by_missing(RVs, patterns, weights)
+    _EM_worker['chunksize'] = chunksize
+
+def _EM_worker_step(CPTs):
+    """Compute the expected counts for the worker's shard of the data.
+
+    Args:
+        CPTs (dict): the CPTs' values, indexed by RV, with axes in the order
+            of `node.cpt.scope` and states in the order of the nodes' states.
+
+    Returns:
+        tuple (dict, float): see BayesianNetwork._EM_statistics().
+    """
+    bn = _EM_worker['bn']
+
+    # Replacing the CPTs invalidates the affected potentials and messages.
+    for RV, values in CPTs.items():
+        node = bn.nodes[RV]
+        scope = node.cpt.scope
+
+        node.cpt = CPT(
+            values,
+            states={v: bn.nodes[v].states for v in scope},
+            conditioned=node.conditioned
+        )
+
+    return bn._EM_statistics(_EM_worker['groups'], _EM_worker['chunksize'])
+
+
 # ------------------------------------------------------------------------------
 # Node
 # ------------------------------------------------------------------------------
@@ -719,6 +1493,10 @@ class Node(object):
         # children.
         self._children = []
 
+        # The network this node is part of; it is notified when the node's
+        # parameters change.
+        self._network = None
+
     @property
     def parents(self):
         return self._parents
@@ -929,6 +1707,9 @@ class DiscreteNetworkNode(Node):
         # Looking good :-)
         self._cpt = cpt
 
+        if self._network is not None:
+            self._network._cpt_changed(self.RV)
+
     @property
     def vars(self):
         """Return the variables in this node (i.e. the scope) as a set."""
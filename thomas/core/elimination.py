@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""Elimination orderings.
+
+The elimination ordering determines the clusters of a junction tree (or the
+intermediate factors of variable elimination). Finding an optimal ordering is
+NP-hard; the functions below implement the usual greedy heuristics.
+
+Graphs are represented as adjacency sets: a dict of sets of neighbors,
+indexed by node.
+"""
+import heapq
+
+import numpy as np
+
+import logging
+log = logging.getLogger('thomas.elimination')
+
+
+# ------------------------------------------------------------------------------
+# Heuristics
+# ------------------------------------------------------------------------------
+def min_degree(node, adjacency, cardinalities):
+    """Cost of eliminating a node: the number of neighbors."""
+    return len(adjacency[node])
+
+def min_fill(node, adjacency, cardinalities):
+    """Cost of eliminating a node: the number of fill-in edges."""
+    neighbors = list(adjacency[node])
+    fill = 0
+
+    for idx, u in enumerate(neighbors):
+        for w in neighbors[idx+1:]:
+            if w not in adjacency[u]:
+                fill += 1
+
+    return fill
+
+def weighted_min_fill(node, adjacency, cardinalities):
+    """Cost of eliminating a node: the sum of the weights of the fill-in
+    edges, where an edge's weight is the product of its endpoints' number
+    of states.
+    """
+    neighbors = list(adjacency[node])
+    fill = 0
+
+    for idx, u in enumerate(neighbors):
+        for w in neighbors[idx+1:]:
+            if w not in adjacency[u]:
+                fill += cardinalities[u] * cardinalities[w]
+
+    return fill
+
+HEURISTICS = {
+    'min-degree': min_degree,
+    'min-fill': min_fill,
+    'weighted-min-fill': weighted_min_fill,
+}
+
+
+# ------------------------------------------------------------------------------
+# Helper functions.
+# ------------------------------------------------------------------------------
+def get_adjacency(nodes, edges):
+    """Return the adjacency sets for an undirected graph.
+
+    Args:
+        nodes (list): nodes in the graph; isolated nodes are retained.
+        edges (list): (u, v) tuples.
+
+    Returns:
+        dict of sets, indexed by node.
+    """
+    adjacency = {n: set() for n in nodes}
+
+    for u, v in edges:
+        adjacency[u].add(v)
+        adjacency[v].add(u)
+
+    return adjacency
+
+def _eliminate(node, adjacency):
+    """Remove a node from the graph after connecting its neighbors.
+
+    Modifies `adjacency` in place.
+
+    Returns:
+        tuple (set, list): the node's neighbors at the time of elimination
+        and the fill-in edges that were added.
+    """
+    neighbors = adjacency.pop(node)
+    fill = []
+
+    for u in neighbors:
+        adjacency[u].discard(node)
+
+        missing = neighbors - adjacency[u]
+        missing.discard(u)
+
+        if missing:
+            adjacency[u].update(missing)
+            fill.extend((u, w) for w in missing)
+
+    return neighbors, fill
+
+def get_elimination_clusters(adjacency, order):
+    """Return the clusters induced by eliminating nodes in order.
+
+    The cluster of a node consists of the node and its neighbors at the time
+    of elimination.
+
+    Args:
+        adjacency (dict): adjacency sets; not modified.
+        order (list): elimination ordering.
+
+    Returns:
+        list of sets, one per node in `order`.
+    """
+    adjacency = {n: set(neighbors) for n, neighbors in adjacency.items()}
+    return [{node} | _eliminate(node, adjacency)[0] for node in order]
+
+def get_maximal_clusters(clusters, order):
+    """Return the clusters that are not contained in another cluster.
+
+    Uses the parent size test: the cluster of a node v is contained in
+    another cluster iff there is a node u, eliminated before v, whose
+    cluster is exactly one larger and for which v is the first neighbor to
+    be eliminated (i.e. v is u's parent).
+
+    The order of the result satisfies the running intersection property: a
+    non-maximal cluster is replaced by the cluster that contains it.
+
+    Args:
+        clusters (list): elimination clusters, as returned by
+            `get_elimination_clusters()`.
+        order (list): elimination ordering that induced the clusters.
+
+    Returns:
+        list of sets.
+    """
+    position = {node: idx for idx, node in enumerate(order)}
+    slots = list(clusters)
+    replaced = [False] * len(clusters)
+
+    for idx, node in enumerate(order):
+        neighbors = clusters[idx] - {node}
+
+        if not neighbors:
+            continue
+
+        parent = position[min(neighbors, key=position.get)]
+
+        if len(clusters[idx]) == len(clusters[parent]) + 1 and not replaced[parent]:
+            slots[parent], slots[idx] = slots[idx], None
+            replaced[parent] = True
+
+    return [C for C in slots if C is not None]
+
+def get_total_table_size(adjacency, order, cardinalities):
+    """Return the total size of the cluster tables induced by an ordering.
+
+    This is the number of entries in all (maximal) clusters' potentials, a
+    good proxy for the cost of inference with the resulting junction tree.
+
+    Args:
+        adjacency (dict): adjacency sets.
+        order (list): elimination ordering.
+        cardinalities (dict): number of states, indexed by node.
+
+    Returns:
+        int
+    """
+    clusters = get_elimination_clusters(adjacency, order)
+    clusters = get_maximal_clusters(clusters, order)
+    return sum(int(np.prod([cardinalities[n] for n in C])) for C in clusters)
+
+
+# ------------------------------------------------------------------------------
+# Orderings.
+# ------------------------------------------------------------------------------
+def greedy_ordering(adjacency, heuristic='weighted-min-fill',
+                    cardinalities=None, seed=None, keep=None):
+    """Return an elimination ordering by greedily picking the cheapest node.
+
+    Costs are updated as fill-in edges are added; only the nodes whose
+    neighborhood changed are re-evaluated.
+
+    Args:
+        adjacency (dict): adjacency sets; not modified.
+        heuristic (str): one of 'min-degree', 'min-fill' or
+            'weighted-min-fill'.
+        cardinalities (dict): number of states, indexed by node. Required for
+            'weighted-min-fill'.
+        seed (int): if provided, ties are broken at random. Otherwise, ties
+            are broken by the order of the nodes in `adjacency`.
+        keep (set): nodes that should not be eliminated (e.g. the query
+            variables in variable elimination).
+
+    Returns:
+        list of nodes; excludes the nodes in `keep`.
+    """
+    if heuristic not in HEURISTICS:
+        msg = f"Unknown heuristic '{heuristic}'; use one of {list(HEURISTICS)}"
+        raise ValueError(msg)
+
+    cost = HEURISTICS[heuristic]
+    adjacency = {n: set(neighbors) for n, neighbors in adjacency.items()}
+    keep = set(keep or [])
+
+    rng = np.random.default_rng(seed) if seed is not None else None
+    position = {n: idx for idx, n in enumerate(adjacency)}
+
+    def entry(node):
+        tiebreak = rng.random() if rng else position[node]
+        return (cost(node, adjacency, cardinalities), tiebreak, position[node])
+
+    # The heap can contain outdated entries; `current` holds the valid ones.
+    current = {n: entry(n) for n in adjacency if n not in keep}
+    heap = list(current.values())
+    heapq.heapify(heap)
+
+    nodes = list(adjacency)
+    order = []
+
+    while heap:
+        item = heapq.heappop(heap)
+        node = nodes[item[2]]
+
+        if current.get(node) != item:
+            continue
+
+        del current[node]
+        neighbors, fill = _eliminate(node, adjacency)
+        order.append(node)
+
+        # Eliminating a node changes the neighborhood of its neighbors. Fill
+        # edges also affect the nodes that are adjacent to both endpoints.
+        affected = set(neighbors)
+
+        if heuristic != 'min-degree':
+            for u, w in fill:
+                affected.update(adjacency[u] & adjacency[w])
+
+        for u in affected - keep:
+            current[u] = entry(u)
+            heapq.heappush(heap, current[u])
+
+    return order
+
+def find_ordering(adjacency, cardinalities, heuristic='weighted-min-fill',
+                  restarts=0, seed=None):
+    """Find a cheap elimination ordering.
+
+    Runs the greedy heuristic once with deterministic tie-breaking and
+    `restarts` times with random tie-breaking, and returns the ordering with
+    the smallest total table size.
+
+    Args:
+        adjacency (dict): adjacency sets.
+        cardinalities (dict): number of states, indexed by node.
+        heuristic (str): see `greedy_ordering()`.
+        restarts (int): number of randomized restarts.
+        seed (int): seed for the randomized restarts.
+
+    Returns:
+        tuple (list, int): the elimination ordering and its total table size.
+    """
+    best = greedy_ordering(adjacency, heuristic, cardinalities)
+    best_size = get_total_table_size(adjacency, best, cardinalities)
+
+    rng = np.random.default_rng(seed)
+
+    for _ in range(restarts):
+        order = greedy_ordering(
+            adjacency,
+            heuristic,
+            cardinalities,
+            seed=rng.integers(2**32)
+        )
+        size = get_total_table_size(adjacency, order, cardinalities)
+
+        if size < best_size:
+            best, best_size = order, size
+
+    log.debug(f'Found elimination ordering with total table size {best_size}')
+    return best, best_size
@@ -19,8 +19,7 @@ class StatesNotAlignedError(Exception):
         super().__init__(msg)
 
 class InvalidStateError(Exception):
-    def __init__(self, variable, state, factor):
-        name = factor.display_name
+    def __init__(self, variable, state, factor=None):
         msg = f"State '{state}' is invalid for variable '{variable}'"
         super().__init__(msg)
 
@@ -35,4 +34,9 @@ class NoStatesOrIndexProvidedError(Exception):
 
 class InvalidCPTError(Exception):
     def __init__(self, msg):
-        super().__init__(msg)
\ No newline at end of file
+        super().__init__(msg)
+
+class SamplingError(Exception):
+    """Raised when sampling does not yield enough (accepted) samples."""
+    def __init__(self, msg):
+        super().__init__(msg)
@@ -3,9 +3,8 @@
 import os
 from datetime import datetime as dt
 import itertools
-from functools import reduce
+from functools import reduce, lru_cache
 from itertools import product
-import warnings
 
 import numpy as np
 import pandas as pd
@@ -52,6 +51,232 @@ def mul(x1, x2):
 
     return result
 
+def multiply_and_sum_out(factors, variables):
+    """Multiply factors and sum out `variables` in a single operation.
+
+    The (full) product of the factors is never allocated: the multiplication
+    and the summation are executed as a single contraction.
+
+    Args:
+        factors (list): list of Factors (and/or scalars).
+        variables (str, list): Name or list of names of variables to sum out.
+
+    Returns:
+        Factor: product of the factors, with `variables` summed out.
+    """
+    if isinstance(variables, (str, tuple)):
+        variables = [variables]
+
+    variables = set(variables)
+    scope = _union_states([f for f in factors if isinstance(f, Factor)])
+
+    if not variables.issubset(scope):
+        raise error.NotInScopeError(variables, set(scope))
+
+    return _contract(factors, [RV for RV in scope if RV not in variables])
+
+def multiply_and_project(factors, Q):
+    """Multiply factors and project the product onto Q in a single operation.
+
+    Args:
+        factors (list): list of Factors (and/or scalars).
+        Q (str, list, set): variable(s) to keep. If Q is a list, the result's
+            scope will have the same order.
+
+    Returns:
+        Factor: marginal over the RVs in Q.
+    """
+    if isinstance(Q, str):
+        Q = [Q]
+
+    if not isinstance(Q, list):
+        scope = _union_states([f for f in factors if isinstance(f, Factor)])
+        Q = [RV for RV in scope if RV in Q]
+
+    return _contract(factors, Q)
+
+def encode_data(df, states):
+    """Integer-code the columns of a DataFrame against known states.
+
+    Args:
+        df (pandas.DataFrame): data
+        states (dict): list of allowed states for each random variable,
+            indexed by name. Variables without a column in `df` are skipped.
+
+    Returns:
+        dict of numpy.ndarray of ints, indexed by RV. Missing values are
+        coded as -1.
+
+    Raises:
+        InvalidStateError: if a (non-missing) value is not one of the states.
+    """
+    codes = {}
+
+    for RV in [RV for RV in states if RV in df.columns]:
+        column = df[RV]
+        coded = pd.Categorical(column, categories=states[RV]).codes
+
+        # Values that could not be coded are either missing or invalid.
+        uncoded = column.values[coded == -1]
+        invalid = uncoded[pd.notna(uncoded)]
+
+        if len(invalid):
+            raise error.InvalidStateError(RV, invalid[0], None)
+
+        codes[RV] = coded.astype(int)
+
+    return codes
+
+def count_codes(codes, cardinalities):
+    """Count the combinations of integer-coded states.
+
+    Combinations are mapped to a flat (mixed-radix) index and counted using
+    `numpy.bincount()`. Rows with a missing value (-1) are not counted.
+
+    Args:
+        codes (list): arrays of ints (of equal length), one per variable. At
+            least one variable is required.
+        cardinalities (list): number of states of each variable.
+
+    Returns:
+        numpy.ndarray: counts with shape `cardinalities`.
+    """
+    cardinalities = [int(c) for c in cardinalities]
+    size = int(np.prod(cardinalities))
+
+    index = np.zeros(len(codes[0]), dtype=np.int64)
+    valid = np.ones(len(codes[0]), dtype=bool)
+
+    for coded, cardinality in zip(codes, cardinalities):
+        index = index * cardinality + coded
+        valid &= coded >= 0
+
+    counts = np.bincount(index[valid], minlength=size)
+    return counts.reshape(cardinalities).astype(float)
+
+def _union_states(factors):
+    """Return the state signatures of all variables covered by the factors.
+
+    Variables are ordered by first appearance. The state order of the first
+    factor that contains a variable determines the state order.
+
+    Returns:
+        dict of state tuples, indexed by RV.
+    """
+    signatures = {}
+
+    for f in factors:
+        for RV, signature in f._signatures.items():
+            if RV not in signatures:
+                signatures[RV] = signature
+
+    return signatures
+
+@lru_cache(maxsize=1024)
+def _state_permutation(source, target):
+    """Return the positions of the states in `target` on an axis ordered as
+    `source`, or None if the orders are identical.
+
+    Args:
+        source (tuple): state signature of the axis.
+        target (tuple): requested state signature.
+
+    Returns:
+        numpy.ndarray of ints or None.
+    """
+    if source == target:
+        return None
+
+    lookup = {state: position for position, state in enumerate(source)}
+
+    try:
+        return np.array([lookup[state] for state in target])
+    except KeyError:
+        raise error.StatesNotAlignedError(list(source), list(target))
+
+def _aligned_values(factor, signatures):
+    """Return factor.values with the states on each axis ordered as in
+    `signatures`.
+
+    Axes that are already aligned are left untouched; others are reordered
+    with a single `numpy.take`.
+
+    Args:
+        factor (Factor): factor to align.
+        signatures (dict): state tuples, indexed by RV; should contain (at
+            least) the variables in the factor's scope.
+
+    Returns:
+        numpy.ndarray with the same axes as `factor.values`.
+    """
+    values = factor.values
+
+    for axis, RV in enumerate(factor.scope):
+        positions = _state_permutation(factor._signatures[RV], signatures[RV])
+
+        if positions is not None:
+            values = np.take(values, positions, axis=axis)
+
+    return values
+
+def _broadcast_values(factor, signatures):
+    """Return factor.values aligned and broadcastable to `signatures`.
+
+    The axes of the result follow the order of `signatures`; variables that
+    are not in the factor's scope get an axis of length 1.
+    """
+    values = _aligned_values(factor, signatures)
+    order = [RV for RV in signatures if RV in factor.states]
+    values = values.transpose([factor.scope.index(RV) for RV in order])
+    shape = [len(signatures[RV]) if RV in factor.states else 1 for RV in signatures]
+
+    return values.reshape(shape)
+
+def _contract(factors, keep):
+    """Multiply factors and sum out all variables that are not in `keep`.
+
+    Scopes are aligned once by mapping each variable to an einsum label; the
+    product and summation are subsequently executed by a single call to
+    `numpy.einsum`.
+
+    Args:
+        factors (list): list of Factors (and/or scalars).
+        keep (list): variables to keep, in the order of the result's scope.
+
+    Returns:
+        Factor
+    """
+    scalar = 1
+    operands = []
+
+    for f in factors:
+        if isinstance(f, Factor):
+            operands.append(f)
+        else:
+            scalar = scalar * f
+
+    signatures = _union_states(operands)
+    labels = {RV: label for label, RV in enumerate(signatures)}
+
+    if not set(keep).issubset(signatures):
+        raise error.NotInScopeError(set(keep) - set(signatures), set(signatures))
+
+    args = []
+
+    for f in operands:
+        args.append(_aligned_values(f, signatures))
+        args.append([labels[RV] for RV in f.scope])
+
+    args.append([labels[RV] for RV in keep])
+
+    # The optimizer only pays off when there's an actual choice to make.
+    values = np.einsum(*args, optimize=len(operands) > 2)
+
+    if scalar != 1:
+        values = values * scalar
+
+    return Factor(values, {RV: list(signatures[RV]) for RV in keep})
+
 # ------------------------------------------------------------------------------
 # FactorIndex
 # ------------------------------------------------------------------------------
@@ -174,9 +399,14 @@ class Factor(object):
         self.name_to_number = {}
         self.number_to_name = {}
 
+        # Hashable state order per variable. Comparing signatures is enough
+        # to determine whether two axes are aligned.
+        self._signatures = {}
+
         for RV, values in self.states.items():
             self.name_to_number[RV] = {name: nr for nr, name in enumerate(self.states[RV])}
             self.number_to_name[RV] = {nr: name for nr, name in enumerate(self.states[RV])}
+            self._signatures[RV] = tuple(values)
 
     def _states_to_indices(self, states):
         """Return the indices for states.
@@ -210,26 +440,32 @@ class Factor(object):
 
         return list(product(*states))
 
-    def _get_state_idx(self, RV):
-        """Return ..."""
+    def _get_axis_idx(self, **states):
+        """Return a tuple that indexes self.values for the provided states.
 
-        # Return the column that corresponds to the position of 'RV'
-        idx_cols = np.array(self._get_index_tuples())
-        return idx_cols[:, self.variables.index(RV)]
+        Variables are mapped to their axis and states to their position on
+        that axis, so no (Cartesian) index of the factor is materialized.
+        Variables that are not in scope are ignored; variables in scope that
+        are not specified select their entire axis.
 
-    def _get_bool_idx(self, **states):
-        """Return ..."""
-        idx_cols = np.array(self._get_index_tuples())
+        Args:
+            **states: states, indexed by RV.
 
-        # Select all entries by default
-        trues = np.ones(idx_cols.shape) == 1
+        Returns:
+            tuple of ints and slices, with one entry per axis.
+        """
+        idx = [slice(None)] * self.width
 
-        # Filter on kwargs
-        for idx, RV in enumerate(self.scope):
+        for axis, RV in enumerate(self.scope):
             if RV in states:
-                trues[:, idx] = idx_cols[:, idx] == states[RV]
+                state = states[RV]
 
-        return trues.all(axis=1)
+                try:
+                    idx[axis] = self.name_to_number[RV][state]
+                except KeyError:
+                    raise error.InvalidStateError(RV, state, self)
+
+        return tuple(idx)
 
     @property
     def display_name(self):
@@ -243,6 +479,15 @@ class Factor(object):
         """Return the size of the dimensions of this Factor."""
         return self.values.shape
 
+    @property
+    def state_signature(self):
+        """Return the (hashable) state order of this factor.
+
+        Returns:
+            tuple of (RV, tuple of states) pairs, in order of scope.
+        """
+        return tuple(self._signatures.items())
+
     @property
     def scope(self):
         """Return the scope of this factor."""
@@ -297,60 +542,30 @@ class Factor(object):
         """Align the index to conform to `other`.
 
         Note: this requires the scope of the two factors to overlap!
+
+        Axes whose state order already matches `other` are left untouched;
+        the others are reordered using `numpy.take`.
         """
         factor = self if inplace else Factor.copy(self)
-        original_scope = factor.scope
 
         # We need at least one overlapping variable to be able to align anything
-        shared_vars = list(set(other.variables).intersection(factor.variables))
-        shared_states = {RV: other.states[RV] for RV in shared_vars}
-
+        shared_vars = [RV for RV in factor.scope if RV in other.states]
 
         if not len(shared_vars):
             raise error.IncompatibleScopeError(factor.scope, other.scope)
 
-        # Make sure that the shared_vars are first in scope
-        factor.reorder_scope(shared_vars, inplace=True)
-
-        # get a list of tuples; each tuple is ordered according to the scope
-        shared_indices = other._get_index_tuples(shared_vars)
-
-        remaining_vars = factor.variables[len(shared_vars):]
-
-        if remaining_vars:
-            # if there are other variables in scope, we'll need to extend the
-            # indices in include theirs
-            remaining_indices = factor._get_index_tuples(remaining_vars)
-
-            # `product` creates a list of tuples: combinations of shared_indices
-            # and remaining_indices. by adding those we get the full index.
-            _combine_indices = lambda x: x[0] + x[1]
-            indices = list(
-                map(
-                    _combine_indices,
-                    product(shared_indices, remaining_indices)
-                )
-            )
+        signatures = dict(factor._signatures)
+        signatures.update({RV: other._signatures[RV] for RV in shared_vars})
 
-            states = {
-                **shared_states,
-                **{RV: factor.states[RV] for RV in remaining_vars}
-            }
+        if signatures == factor._signatures:
+            # Nothing to do
+            return None if inplace else factor
 
-
-        else:
-            # if there are no other variables in scope, we can just use the
-            # shared_indices to rearrange the values
-            indices = shared_indices
-            states = shared_states
-
-        # sort factor.values according to the indices
-        cardinality = [len(i) for i in states.values()]
-        values = np.array(factor[indices]).reshape(cardinality)
-
-        factor._set_states(states)
-        factor.values = values
-        factor.reorder_scope(original_scope, inplace=True)
+        factor.values = _aligned_values(factor, signatures)
+        factor._set_states({
+            RV: other.states[RV] if RV in other.states else factor.states[RV]
+            for RV in factor.scope
+        })
 
         if not inplace:
             return factor
@@ -386,6 +601,7 @@ class Factor(object):
             factor.states.update(other.states)
             factor.name_to_number.update(other.name_to_number)
             factor.number_to_name.update(other.number_to_name)
+            factor._signatures.update(other._signatures)
 
         if not inplace:
             return factor
@@ -419,6 +635,28 @@ class Factor(object):
         """Sum all values of the factor."""
         return self.values.sum()
 
+    def _apply(self, other, op, inplace=False):
+        """Apply a binary (elementwise) operation to two Factors.
+
+        Both factors are broadcast to the union of their scopes: variables
+        are mapped to axes once, after which `op` operates on plain arrays.
+        """
+        factor = self if inplace else Factor.copy(self)
+        signatures = _union_states([factor, other])
+
+        values = op(
+            _broadcast_values(factor, signatures),
+            _broadcast_values(other, signatures)
+        )
+
+        factor._set_states({RV: list(sig) for RV, sig in signatures.items()})
+        factor.values = np.broadcast_to(
+            values,
+            [len(sig) for sig in signatures.values()]
+        ).copy()
+
+        return factor
+
     def add(self, other, inplace=False):
         """A + B <=> A.add(B)"""
         factor = self if inplace else Factor.copy(self)
@@ -427,9 +665,8 @@ class Factor(object):
             factor.values += other
 
         else:
-            # # Assuming 'other' is another Factor.
-            factor, other = self.extend_and_reorder(factor, other)
-            factor.values = factor.values + other.values
+            # Assuming 'other' is another Factor.
+            factor._apply(other, np.add, inplace=True)
 
         if not inplace:
             return factor
@@ -442,9 +679,10 @@ class Factor(object):
             factor.values *= other
 
         else:
-            # # Assuming 'other' is another Factor.
-            factor, other = self.extend_and_reorder(factor, other)
-            factor.values = factor.values * other.values
+            # Assuming 'other' is another Factor.
+            product = _contract([factor, other], list(_union_states([factor, other])))
+            factor._set_states(product.states)
+            factor.values = product.values
 
         if not inplace:
             return factor
@@ -453,19 +691,15 @@ class Factor(object):
         """A / B <=> A.div(B)"""
         factor = self if inplace else Factor.copy(self)
 
-        if isinstance(other, (int, float)):
-            factor.values /= other
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if isinstance(other, (int, float)):
+                factor.values /= other
 
-        else:
-            # # Assuming 'other' is another Factor.
-            factor, other = self.extend_and_reorder(factor, other)
-
-            with warnings.catch_warnings(record=True) as w:
-                # Cause all warnings to always be triggered.
-                warnings.simplefilter("always")
+            else:
+                # Assuming 'other' is another Factor.
+                factor._apply(other, np.divide, inplace=True)
 
-                factor.values = factor.values / other.values
-                factor.values[np.isnan(factor.values)] = 0
+            factor.values[np.isnan(factor.values)] = 0
 
         if not inplace:
             return factor
@@ -480,6 +714,7 @@ class Factor(object):
             del self.states[RV]
             del self.name_to_number[RV]
             del self.number_to_name[RV]
+            del self._signatures[RV]
 
     def get_state_index(self, RV, state):
         """Return the index for RV with state."""
@@ -506,7 +741,10 @@ class Factor(object):
         >>> factor.get(A='a0')
         array([1.])
         """
-        return self.flat[self._get_bool_idx(**kwargs)]
+        # Indexing with ints drops the corresponding axes; the remaining
+        # cells are returned in the same (C) order as self.flat.
+        selection = self.values[self._get_axis_idx(**kwargs)]
+        return np.array(selection).reshape(-1)
 
     def set(self, value, inplace=False, **kwargs):
         """Set a value to cells identified by **kwargs.
@@ -530,11 +768,33 @@ class Factor(object):
         """
         factor = self if inplace else Factor.copy(self)
 
-        factor.flat[factor._get_bool_idx(**kwargs)] = value
+        factor.values[factor._get_axis_idx(**kwargs)] = value
 
         if not inplace:
             return factor
 
+    def reduce(self, inplace=False, **kwargs):
+        """Reduce the factor to the cells identified by **kwargs.
+
+        Unlike `set_complement()`, this removes the axes of the provided
+        variables, so the result is smaller. Variables that are not in scope
+        are ignored.
+
+        Examples
+        --------
+        >>> factor = Factor([1, 2, 3, 4], {'A': ['a0', 'a1'], 'B': ['b0', 'b1']})
+        >>> factor.reduce(A='a1').values
+        array([3., 4.])
+        """
+        idx = self._get_axis_idx(**kwargs)
+
+        if not inplace:
+            states = {RV: self.states[RV] for RV in self.scope if RV not in kwargs}
+            return Factor(self.values[idx], states)
+
+        self.del_state_names([RV for RV in self.scope if RV in kwargs])
+        self.values = np.array(self.values[idx])
+
     def set_complement(self, value, inplace=False, **kwargs):
         """Set a value to cells *not* identified by **kwargs.
 
@@ -557,8 +817,14 @@ class Factor(object):
         """
         factor = self if inplace else Factor.copy(self)
 
-        idx = np.invert(factor._get_bool_idx(**kwargs))
-        factor.flat[idx] = value
+        # Save the selected cells, overwrite everything and restore the
+        # selection. This only touches the array and never builds a mask of
+        # state tuples.
+        idx = factor._get_axis_idx(**kwargs)
+        selection = np.array(factor.values[idx])
+
+        factor.values[...] = value
+        factor.values[idx] = selection
 
         if not inplace:
             return factor
@@ -754,20 +1020,24 @@ class Factor(object):
             Factor (unnormalized)
         """
         cols = cols if cols else list(df.columns)
-        subset = df[cols]
-        counts = subset.groupby(cols).size()
 
         if states is None:
-            # We'll need to try to determine states from the jpt
-            states = cls.index_to_states(counts.index)
-
-        # Create a factor containing *all* combinations set to `complete_value`.
-        f2 = Factor(complete_value, states)
+            # Determine the states from the data.
+            states = {}
+
+            for col in cols:
+                if isinstance(df[col].dtype, CategoricalDtype):
+                    states[col] = list(df[col].cat.categories)
+                else:
+                    states[col] = sorted(df[col].dropna().unique())
+        else:
+            states = {col: list(states[col]) for col in cols}
 
-        # By summing the Factor with the Series all combinations not in the
-        # data are set to `complete_value`.
-        total = f2.as_series() + counts
+        # Count combinations of (integer coded) states; rows with NAs are
+        # not counted.
+        codes = encode_data(df, states)
+        cardinalities = [len(states[col]) for col in cols]
+        counts = count_codes([codes[col] for col in cols], cardinalities)
 
-        values = np.nan_to_num(total.values, nan=complete_value)
-        return Factor(values, states=states)
+        return Factor(counts + complete_value, states=states)
 
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 """JunctionTree"""
 import networkx as nx
-from networkx.algorithms.shortest_paths.generic import shortest_path
 
-from functools import reduce
+from collections import Counter, deque
+import itertools
+
+import numpy as np
 
 from . import error
-from .factor import mul, Factor
+from .factor import Factor, _aligned_values
+from .elimination import get_elimination_clusters
+from .elimination import get_maximal_clusters
 # ------------------------------------------------------------------------------
 # JunctionTree
 # ------------------------------------------------------------------------------
@@ -29,11 +33,23 @@ class JunctionTree(object):
         self.edges = []
         self.indicators = {} # evidence indicators; indexed by RV
         self._RVs = {}       # TreeNode, indexed by RV and
+        self._cpt_nodes = {} # TreeNodes with a CPT that contains RV, indexed by RV
+
+        # Set by compile(); reset whenever the structure changes.
+        self._compiled = False
+
+        # Hard evidence that is sliced out of the compiled tree: the state's
+        # index, indexed by RV (see `reduce_evidence()`).
+        self._reduced = {}
 
         # Create the structure.
         self.clusters = self._get_elimination_clusters()
         self._create_structure()
 
+        # Separators are maintained incrementally from here on.
+        for edge in self.edges:
+            edge.recompute_separator()
+
         # Assign factors & evidence indicators.
         self._assign_factors(bn)
 
@@ -50,148 +66,75 @@ class JunctionTree(object):
         """
         bn = self._bn
 
-        # Get the full set of clusters.
-        edges = bn.moralize_graph()
-        order = bn.get_node_elimination_order()
-        clusters = self._get_elimination_clusters_rec(edges, order)
-
-        # Merge clusters that are contained in other clusters by iterating over
-        # the full set and replacing the smaller with the larger clusters.
-        merged = list(clusters)
-        clusters = list(clusters)
-
-        # We should merge later clusters into earlier clusters.
-        # The reversion is undone just before the function returns.
-        clusters.reverse()
-
-        should_continue = len(clusters) > 1
-        while should_continue:
-            should_continue = False
-
-            for idx_i in range(len(clusters)):
-                modified = False
-                C_i = clusters[idx_i]
-
-                for idx_j in range(idx_i+1, len(clusters)):
-                    C_j = clusters[idx_j]
-
-                    if C_i.issubset(C_j):
-                        clusters[idx_i] = C_j
-                        clusters.pop(idx_j)
+        # Triangulate the moral graph by eliminating nodes in order. The
+        # adjacency is computed once and shared with the ordering heuristic.
+        adjacency, _ = bn._get_adjacency()
+        order = bn.get_node_elimination_order(adjacency)
+        clusters = get_elimination_clusters(adjacency, order)
 
-                        modified = True
-                        should_continue = len(clusters) > 1
-
-                        # Break from the inner for-loop
-                        break
-
-                if modified:
-                    # Break from the outer for-loop
-                    break
-
-        # Undo the earlier reversion.
-        clusters.reverse()
-        return clusters
-
-    def _get_elimination_clusters_rec(self, edges, order):
-        """Recursively compute the clusters for the elimination tree.
-
-        Args:
-            edges (list): List of edges that make up the (remaining) Graph.
-            order (list): Elimination order.
-
-        Returns:
-            list of clusters (i.e. sets of RVs)
-        """
-        # Create a copy to make sure we're not modifying the method argument.
-        order = list(order)
-
-        if not len(order):
-            return []
-
-        # Reconstruct the graph
-        G = nx.Graph()
-        G.add_nodes_from(order)
-        G.add_edges_from(edges)
-
-        node = order.pop(0)
-
-        # Make sure the neighbors from `node` are connected by adding fill-in
-        # edges.
-        neighbors = list(G.neighbors(node))
-
-        if len(neighbors) > 1:
-            for outer_idx in range(len(neighbors)):
-                n1 = neighbors[outer_idx]
-
-                for inner_idx in range(outer_idx+1, len(neighbors)):
-                    n2 = neighbors[inner_idx]
-                    G.add_edge(n1, n2)
-
-        G.remove_node(node)
-        cluster = set([node, ] + neighbors)
-
-        return [cluster, ] + self._get_elimination_clusters_rec(G.edges, order)
+        # Only keep the maximal clusters; their order satisfies the running
+        # intersection property.
+        return get_maximal_clusters(clusters, order)
 
     def _create_structure(self):
-        """Create the tree's structure (i.e. add edges) using the clusters."""
+        """Create the tree's structure (i.e. add edges) using the clusters.
 
+        The tree is a maximum weight spanning tree (Kruskal) over the
+        clusters' intersections: the weight of an edge is the size of its
+        separator. Ties are broken in favor of clusters with smaller tables,
+        which are computed from the variables' number of states. Clusters
+        that do not share any variables are connected by empty separators.
+        """
         # Each cluster is added to a TreeNode by reference, meaning that any
         # changes to `node.cluster` are also reflected in `self.clusters`.
-        for c in self.clusters:
-            # Create a TreeNode and add it to self.nodes
-            self.add_node(c)
+        nodes = [self.add_node(c) for c in self.clusters]
 
-        # The nodes contain a variable `cluster` that corresponds to one of the
-        # tree's clusters. The order is equivalent to `self.clusters`.
-        nodes = list(self.nodes.values())
+        cardinalities = {RV: len(s) for RV, s in self._bn.states.items()}
+        sizes = [
+            int(np.prod([cardinalities[RV] for RV in C]))
+            for C in self.clusters
+        ]
 
-        # Iterate over the tree's nodes to find a neighbor for each node.
-        # We need to cast the iterator to a list to use reversed()
-        for idx, node_i in reversed(list(enumerate(nodes))):
-            C_i = node_i.cluster
+        # Count the shared variables for every pair of clusters that has at
+        # least one variable in common.
+        containing = {}
 
-            # `remaining_nodes` will hold clusters C_i+1 , C_i+2, .... C_n
-            remaining_nodes = nodes[idx+1:]
+        for idx, C in enumerate(self.clusters):
+            for RV in C:
+                containing.setdefault(RV, []).append(idx)
 
-            if remaining_nodes:
-                remaining_clusters = [n.cluster for n in remaining_nodes]
+        weights = Counter()
 
-                # We'll compute union over the remaining clusters and determine
-                # the intersection with the current cluster.
-                intersection = C_i.intersection(set.union(*remaining_clusters))
+        for indices in containing.values():
+            weights.update(itertools.combinations(indices, 2))
 
-                # According to the running intersection property, there should
-                # be a node/cluster that contains the above intersection.
-                options = []
-
-                for node_j in remaining_nodes:
-                   C_j = node_j.cluster
+        candidates = sorted(
+            weights,
+            key=lambda pair: (-weights[pair], sizes[pair[0]] + sizes[pair[1]], pair)
+        )
 
-                   if intersection.issubset(C_j):
-                        options.append(node_j)
+        # Kruskal, using union-find with path halving to track components.
+        parent = list(range(len(nodes)))
 
-                       # self.add_edge(node_i, node_j)
-                       # break from the for loop
-                       # break
+        def find(idx):
+            while parent[idx] != idx:
+                parent[idx] = parent[parent[idx]]
+                idx = parent[idx]
+            return idx
 
+        for i, j in candidates:
+            root_i, root_j = find(i), find(j)
 
+            if root_i != root_j:
+                parent[root_j] = root_i
+                self.add_edge(nodes[i], nodes[j])
 
-                if len(options) > 1:
-                    complexities = []
+        # Connect the remaining components (if any).
+        roots = {find(idx): idx for idx in reversed(range(len(nodes)))}
+        first = sorted(roots.values())
 
-                    for n in options:
-                        CPTs = [self._bn[RV].cpt for RV in n.cluster]
-                        reduced = reduce(mul, CPTs)
-                        complexities.append(len(reduced))
-                    # sizes = [len(n.joint) for n in options]
-                    # print(sizes)
-                    # print(options)
-                    option_idx = complexities.index(min(complexities))
-                    self.add_edge(node_i, options[option_idx])
-                else:
-
-                    self.add_edge(node_i, options[0])
+        for i, j in zip(first[:-1], first[1:]):
+            self.add_edge(nodes[i], nodes[j])
 
     def _assign_factors(self, bn):
         """Assign the BNs factors (nodes) to one of the clusters."""
@@ -200,33 +143,159 @@ class JunctionTree(object):
         # Iterate over all nodes in the BN to assign each BN node/CPT to the
         # first TreeNode that contains the BN node's RV. Also, assign an evidence
         # indicator for that variable to that JT node.
+        containing = {}
+
+        for jt_node in self.nodes.values():
+            for RV in jt_node.cluster:
+                containing.setdefault(RV, []).append(jt_node)
+
         for RV, bn_node in bn.nodes.items():
-            # Iterate over the JT nodes/clusters
-            for jt_node in self.nodes.values():
+            # Iterate over the JT nodes/clusters that contain RV
+            for jt_node in containing.get(RV, []):
                 # node.vars returns all variables in the node's factor
                 if bn_node.vars.issubset(jt_node.cluster):
                     jt_node.add_bn_node(bn_node)
                     self.set_node_for_RV(RV, jt_node)
 
+                    for var in bn_node.vars:
+                        self._cpt_nodes.setdefault(var, []).append(jt_node)
+
                     states = {RV: bn_node.states}
                     indicator = Factor(1, states=states)
                     self.add_indicator(indicator, jt_node)
                     break
 
         # Iterate over the JT nodes/clusters to make sure each cluster has
-        # the correct factors assigned.
+        # the correct factors assigned. Trivial factors are never modified,
+        # so clusters can share the one for a variable.
+        trivial = {}
+
         for jt_node in self.nodes.values():
             for missing in (jt_node.cluster - jt_node.vars):
-                bn_node = bn.nodes[missing]
-                states = {bn_node.RV: bn_node.states}
-                trivial = Factor(1, states=states)
-                jt_node.add_factor(trivial)
+                if missing not in trivial:
+                    bn_node = bn.nodes[missing]
+                    states = {bn_node.RV: bn_node.states}
+                    trivial[missing] = Factor(1, states=states)
+
+                jt_node.add_factor(trivial[missing])
 
     @property
     def width(self):
         """Return the width of the JT."""
         return max([len(c) for c in self.clusters]) -1
 
+    def compile(self):
+        """Compile the tree for (repeated) propagation.
+
+        For every node this fixes the order of the variables in its cluster
+        and allocates buffers for its potential and belief. For every edge it
+        allocates a buffer for the message in either direction. Finally, the
+        einsum operands and subscripts required to send each message are
+        precomputed.
+
+        Afterwards, propagating evidence performs no Factor constructions:
+        messages are computed in place using plain array arithmetic.
+
+        Variables with reduced evidence (see `reduce_evidence()`) are left
+        out of all buffers.
+        """
+        states = self._bn.states
+        order = {RV: idx for idx, RV in enumerate(self._bn.scope)}
+
+        for node in self.nodes.values():
+            node._compile(states, order, self._reduced)
+
+        for edge in self.edges:
+            edge._compile(states, order, self._reduced)
+
+        for node in self.nodes.values():
+            node._compile_programs()
+
+        self._schedule = self._get_schedule()
+        self._compiled = True
+
+    def _get_schedule(self, root=None, distribute=True):
+        """Return the message schedule for a full propagation.
+
+        The first half of the schedule collects evidence towards the root
+        (leaves first); the second half distributes evidence back to the
+        leaves. Every edge appears exactly once in each half.
+
+        Args:
+            root (TreeNode): node to collect evidence towards. Defaults to
+                the first node in the tree.
+            distribute (bool): include the distribution pass.
+
+        Returns:
+            list of (sender, edge) tuples.
+        """
+        if root is None:
+            root = next(iter(self.nodes.values()))
+
+        # Iterative depth first traversal; `discovered` holds (node, edge)
+        # tuples in pre-order, where edge connects node to its parent.
+        discovered = []
+        stack = [(root, None)]
+
+        while stack:
+            node, upstream = stack.pop()
+
+            for edge in node.get_downstream_edges(upstream):
+                child = edge.get_neighbor(node)
+                discovered.append((child, edge))
+                stack.append((child, edge))
+
+        collect = list(reversed(discovered))
+
+        if not distribute:
+            return collect
+
+        distribute = [(edge.get_neighbor(child), edge) for child, edge in discovered]
+
+        return collect + distribute
+
+    def propagate(self):
+        """Calibrate the tree using a two-pass (collect/distribute) schedule.
+
+        Messages are passed in the Shafer-Shenoy (division free) fashion:
+        after a full propagation, each of the 2 x edges messages has been
+        computed once and the belief of every node is proportional to the
+        joint over its cluster and the evidence. Messages that are still
+        valid are not recomputed.
+
+        Messages and beliefs are rescaled to sum to 1 (see `TreeNode._run()`),
+        so propagation does not underflow when the evidence is very unlikely;
+        see `compute_log_evidence()` for the probability of the evidence.
+        """
+        self.ensure_compiled()
+
+        for sender, edge in self._schedule:
+            receiver = edge.get_neighbor(sender)
+
+            if not edge._valid[receiver]:
+                sender._run(edge)
+                edge._valid[receiver] = True
+
+        for node in self.nodes.values():
+            node._ensure_belief()
+
+    def compute_log_evidence(self):
+        """Return the log probability of the evidence set on the tree.
+
+        Returns:
+            float: log P(e); -inf if the evidence is impossible.
+        """
+        self.ensure_compiled()
+        node = next(iter(self.nodes.values()))
+        node._ensure_belief()
+
+        return float(node._log_scale)
+
+    def ensure_compiled(self):
+        """Compile the tree, unless this has already been done."""
+        if not self._compiled:
+            self.compile()
+
     def ensure_cluster(self, cluster):
         """Ensure cluster is contained in one of the nodes."""
         Q = set(cluster) if isinstance(cluster, list) else cluster
@@ -243,24 +312,10 @@ class JunctionTree(object):
         # Determine which variables are missing in the cluster
         missing = Q - node.cluster
 
-        # Convert the JT to a NetworkX graph, so we can use it's implementation
-        # of Dijkstra's shortest path later.
-        G = self.as_networkx()
-
         for var in missing:
-            # Find a path to the nearest node that contains `var`.
-            # There may be multiple nodes that contain `var`, so first list all
-            # targets.
-            targets = [n for n in self.nodes.values() if var in n.cluster]
-            paths = []
-
-            for target in targets:
-                paths.append(shortest_path(G, node, target))
-
-            distances = [len(p) for p in paths]
-            idx = distances.index(min(distances))
-            path = paths[idx]
-
+            # Find a path to the nearest node that contains `var` using a
+            # breadth first search from `node`.
+            path = self._get_path_to([node], lambda n: var in n.cluster)
             states = self._bn.nodes[var].states
 
             for tree_node in path:
@@ -270,6 +325,9 @@ class JunctionTree(object):
                     f = Factor(1, states={var: states})
                     tree_node.add_factor(f)
 
+        # Clusters have grown, so buffers and programs need to be recreated.
+        self._compiled = False
+
     def get_node_for_RV(self, RV):
         """A[x] <==> A.__getitem__(x)"""
         return self._RVs[RV]
@@ -293,16 +351,283 @@ class JunctionTree(object):
     # Alias
     get_node_for_family = get_node_for_set
 
+    def propagate_batch(self, evidence, nodes=None, scaled=False):
+        """Propagate a batch of evidence configurations in a single pass.
+
+        Indicators get a leading batch axis. This axis propagates through
+        the messages of the compiled tree: messages that do not depend on
+        any batched indicator are computed once and broadcast. Evidence set
+        on the tree itself (e.g. via `set_evidence_hard()`) is ignored.
+
+        Args:
+            evidence (dict): arrays of shape (N, |states|) with the
+                likelihood of each state, indexed by RV. Use all ones for
+                rows without evidence on RV.
+            nodes (list): TreeNodes to compute beliefs for. If this holds a
+                single node, messages are only collected towards that node.
+                Defaults to all nodes.
+            scaled (bool): rescale every message to sum to 1 and keep track
+                of the log of the scaling factors. This prevents underflow
+                when the evidence is very unlikely (e.g. many observed
+                variables).
+
+        Returns:
+            dict of numpy.ndarray, indexed by TreeNode. Each array has shape
+            (N, *cluster shape), or (1, *cluster shape) if `evidence` is
+            empty. Beliefs are unnormalized: they sum to P(evidence).
+
+            If `scaled` is True, a tuple (dict, numpy.ndarray): the beliefs
+            are normalized and the array holds log P(evidence) for each
+            configuration (-inf if the evidence is impossible).
+        """
+        self.expand_evidence()
+        self.ensure_compiled()
+
+        if nodes is None:
+            nodes = list(self.nodes.values())
+
+        if len(nodes) == 1:
+            schedule = self._get_schedule(nodes[0], distribute=False)
+        else:
+            schedule = self._schedule
+
+        # Messages are indexed by (edge, receiver) and hold a tuple
+        # (values, batched, log_scale).
+        messages = {}
+
+        for sender, edge in schedule:
+            receiver = edge.get_neighbor(sender)
+            messages[(edge, receiver)] = sender._run_batch(
+                edge, messages, evidence, scaled
+            )
+
+        beliefs = {}
+
+        for node in nodes:
+            values, batched, log_scale = node._run_batch(
+                None, messages, evidence, scaled
+            )
+            beliefs[node] = values if batched else values[np.newaxis, ...]
+
+        if scaled:
+            # The scaling factors of any belief multiply to P(evidence).
+            return beliefs, np.atleast_1d(log_scale)
+
+        return beliefs
+
     def get_marginals(self, RVs=None):
-        """Return the probabilities for a set off/all RVs given set evidence."""
+        """Return the probabilities for a set off/all RVs given set evidence.
+
+        If more than a single marginal is requested, the tree is calibrated
+        first (see `propagate()`), after which each marginal is a projection
+        of the belief of the node that holds the RV's indicator.
+        """
         if RVs is None:
-            RVs = self._RVs
+            RVs = list(self._RVs)
+
+        if len(RVs) > 1:
+            self.propagate()
+
+        marginals = {}
+
+        for RV in RVs:
+            node = self.get_node_for_RV(RV)
+            marginals[RV] = node.project(RV)
+
+        return marginals
+
+    def _get_path_to(self, sources, is_target):
+        """Return the shortest path from a source to a node that is a target.
+
+        Args:
+            sources (list): TreeNodes to start from.
+            is_target (callable): returns True iff a node is a target.
+
+        Returns:
+            list of TreeNodes, starting with a source and ending with the
+            target or None if no node is a target.
+        """
+        parents = {source: None for source in sources}
+        queue = deque(sources)
+
+        while queue:
+            node = queue.popleft()
+
+            if is_target(node):
+                path = []
+
+                while node is not None:
+                    path.append(node)
+                    node = parents[node]
+
+                return path[::-1]
+
+            for edge in node._edges:
+                neighbor = edge.get_neighbor(node)
+
+                if neighbor not in parents:
+                    parents[neighbor] = node
+                    queue.append(neighbor)
+
+        return None
+
+    def _get_steiner_tree(self, RVs):
+        """Return a (small) connected set of nodes that covers RVs.
+
+        Starts at the node with the largest overlap and greedily adds the
+        shortest path to a node containing a variable that is not yet
+        covered.
+
+        Args:
+            RVs (set): variables to cover.
+
+        Returns:
+            tuple (set, TreeNode): the nodes in the subtree and the node it
+            was grown from.
+        """
+        root = max(self.nodes.values(), key=lambda n: len(RVs & n.cluster))
+        subtree = {root}
+        covered = RVs & root.cluster
+
+        for var in self._bn.scope:
+            if var in RVs and var not in covered:
+                path = self._get_path_to(list(subtree), lambda n: var in n.cluster)
+                subtree.update(path)
+                covered |= RVs & set.union(*[n.cluster for n in path])
+
+        return subtree, root
+
+    def compute_joint(self, RVs):
+        """Compute the joint over RVs given the evidence set on the tree.
+
+        RVs do not need to be contained in a single cluster: the (calibrated)
+        messages are combined along the subtree that connects the clusters
+        containing them (out-of-clique inference). Other variables are summed
+        out as early as possible, so the joint over the subtree's clusters is
+        never allocated.
+
+        Args:
+            RVs (list or set): variables to compute the joint over.
+
+        Returns:
+            Factor: unnormalized joint, proportional to P(RVs, evidence). If
+            RVs is a list, the scope has the same order.
+        """
+        if isinstance(RVs, (list, tuple)):
+            Q_full = list(RVs)
+        else:
+            Q_full = [RV for RV in self._bn.scope if RV in RVs]
+
+        missing = set(Q_full) - set(self._bn.scope)
+
+        if missing:
+            raise error.NotInScopeError(missing, self._bn.scope)
+
+        # Reduced variables are not part of any cluster's scope; their axes
+        # are added to the result.
+        Q = [RV for RV in Q_full if RV not in self._reduced]
+        Q_set = set(Q)
+
+        # Make sure all messages are valid.
+        self.propagate()
+
+        subtree, root = self._get_steiner_tree(Q_set)
+
+        # Depth first traversal of the subtree; messages are sent towards
+        # the root, leaves first.
+        discovered = []
+        stack = [(root, None)]
+
+        while stack:
+            node, upstream = stack.pop()
+            discovered.append((node, upstream))
+
+            for edge in node.get_downstream_edges(upstream):
+                if edge.get_neighbor(node) in subtree:
+                    stack.append((edge.get_neighbor(node), edge))
+
+        # Messages within the subtree, indexed by sender: (values, scope)
+        messages = {}
+
+        for node, upstream in reversed(discovered):
+            if not node._potential_valid:
+                node._compute_potential()
+
+            operands = [(node._potential, node._scope)]
+            operands += [
+                (i.values, i.scope) for i in node.indicators
+                if i.scope[0] not in self._reduced
+            ]
+
+            for edge in node.get_downstream_edges(upstream):
+                neighbor = edge.get_neighbor(node)
+
+                if neighbor in subtree:
+                    operands.append(messages.pop(neighbor))
+                else:
+                    operands.append((edge._messages[node], edge._scope))
+
+            scope = list(dict.fromkeys(RV for _, sc in operands for RV in sc))
+
+            if upstream is None:
+                keep = Q
+            else:
+                keep = [
+                    RV for RV in scope
+                    if RV in Q_set or RV in upstream.separator
+                ]
+
+            labels = {RV: label for label, RV in enumerate(scope)}
+            args = []
+
+            for values, sc in operands:
+                args += [values, [labels[RV] for RV in sc]]
+
+            args.append([labels[RV] for RV in keep])
+            values = np.einsum(*args, optimize='greedy')
+
+            # Like the tree's messages, rescale to prevent underflow.
+            if upstream is not None and values.sum() > 0:
+                values = values / values.sum()
+
+            messages[node] = (values, keep)
+
+        values, scope = messages[root]
+        factor = self._expand_reduced(values, scope, Q_full)
+
+        if factor.scope != Q_full:
+            factor.reorder_scope(Q_full, inplace=True)
+
+        return factor
+
+    def _expand_reduced(self, values, scope, RVs):
+        """Return a Factor, adding axes for reduced variables in RVs.
 
-        return {RV: self.get_node_for_RV(RV).project(RV) for RV in RVs}
+        The axis of a reduced variable holds a 1 for the observed state and
+        0 otherwise.
+
+        Args:
+            values (numpy.ndarray): values over `scope`.
+            scope (list): variables; should not contain reduced variables.
+            RVs (iterable): variables to add if they are reduced.
+
+        Returns:
+            Factor: factor over `scope`, followed by the reduced variables.
+        """
+        states = {RV: self._bn.nodes[RV].states for RV in scope}
+
+        for RV in RVs:
+            if RV in self._reduced:
+                states[RV] = self._bn.nodes[RV].states
+                indicator = np.zeros(len(states[RV]))
+                indicator[self._reduced[RV]] = 1
+                values = np.multiply.outer(values, indicator)
+
+        return Factor(values, states)
 
     def add_node(self, cluster):
         """Add a node to the junction tree."""
-        node = TreeNode(cluster)
+        node = TreeNode(cluster, tree=self)
         self.nodes[node.label] = node
         return node
 
@@ -321,34 +646,121 @@ class JunctionTree(object):
         self.indicators[RV] = factor
         node.indicators.append(factor)
 
+    def reduce_evidence(self, **kwargs):
+        """Set hard evidence and slice the observed variables out of the tree.
+
+        Compared to `set_evidence_hard()`, the observed variables are removed
+        from every potential, belief and message: the compiled tree shrinks
+        with the evidence. Adding variables requires recompilation; changing
+        the observed state of a reduced variable only invalidates the
+        potentials that contain it.
+
+        The evidence is also set on the indicators, so any other change to a
+        reduced variable's evidence (e.g. retracting it) simply expands it
+        again (see `expand_evidence()`).
+
+        Kwargs:
+            evidence (dict): dict with states, indexed by RV: {RV: state}
+        """
+        self.set_evidence_hard(**kwargs)
+
+        for RV, state in kwargs.items():
+            if RV not in self._reduced:
+                self._reduced[RV] = self.indicators[RV].get_state_index(RV, state)
+                self._compiled = False
+
+    def expand_evidence(self, *RVs):
+        """Reintroduce reduced variables in the compiled tree.
+
+        The evidence itself is kept: it is applied using the indicators.
+
+        Args:
+            *RVs: variables to expand. If none are provided, all reduced
+                variables are expanded.
+        """
+        for RV in (RVs or list(self._reduced)):
+            if RV in self._reduced:
+                del self._reduced[RV]
+                self._compiled = False
+
+    def _update_reduced(self, RV):
+        """Update the reduction of RV after its indicator changed."""
+        values = self.indicators[RV].values
+        nonzero = np.flatnonzero(values)
+
+        if len(nonzero) != 1 or values[nonzero[0]] != 1.0:
+            # No longer hard evidence.
+            self.expand_evidence(RV)
+
+        elif self._reduced[RV] != nonzero[0]:
+            self._reduced[RV] = nonzero[0]
+
+            for node in self._cpt_nodes[RV]:
+                node._potential_valid = False
+
+                if self._compiled:
+                    self._invalidate_messages_from(node)
+
     def reset_evidence(self, RVs=None):
-        """Reset evidence."""
+        """Reset evidence.
+
+        Only messages that depend on an indicator that actually changed are
+        invalidated.
+
+        Args:
+            RVs (list): variables to reset the evidence for. If None, all
+                evidence is reset.
+        """
         if RVs is None:
             RVs = self.indicators
 
         for RV in RVs:
             indicator = self.indicators[RV]
-            indicator.values[:] = 1.0
 
-        self.invalidate_caches()
+            if not (indicator.values == 1.0).all():
+                indicator.values[:] = 1.0
+                self.invalidate_evidence(RV)
+
+    def retract_evidence(self, *RVs):
+        """Retract the evidence on one or more variables.
+
+        This is equivalent to `reset_evidence(RVs)`: afterwards, only the
+        messages directed away from the RVs' nodes need to be recomputed.
+        """
+        self.reset_evidence(RVs)
+
+    def replace_evidence(self, **kwargs):
+        """Replace all evidence by the provided (hard) evidence.
+
+        Variables whose evidence does not change keep their messages, which
+        makes consecutive queries with overlapping evidence cheap.
+
+        Kwargs:
+            evidence (dict): dict with states, indexed by RV: {RV: state}
+        """
+        self.reset_evidence([RV for RV in self.indicators if RV not in kwargs])
+        self.set_evidence_hard(**kwargs)
 
     def set_evidence_likelihood(self, RV, **kwargs):
         """Set likelihood evidence on a variable."""
         indicator = self.indicators[RV]
 
-        # FIXME: it's not pretty to access Factor._data like this!
-        data = indicator._data
-
+        # Indicators are updated in place: compiled programs hold a
+        # reference to their values.
         for state, value in kwargs.items():
-            data[state] = value
+            if state not in indicator.states[RV]:
+                raise error.InvalidStateError(RV, state, indicator)
+
+            indicator.values[indicator.get_state_index(RV, state)] = value
 
-        self.invalidate_caches()
+        self.invalidate_evidence(RV)
 
     def set_evidence_hard(self, **kwargs):
         """Set hard evidence on a variable.
 
         This corresponds to setting the likelihood of the provided state to 1
-        and the likelihood of all other states to 0.
+        and the likelihood of all other states to 0. Setting the same
+        evidence twice does not invalidate any messages.
 
         Kwargs:
             evidence (dict): dict with states, indexed by RV: {RV: state}
@@ -361,10 +773,69 @@ class JunctionTree(object):
             if state not in indicator.states[RV]:
                 raise error.InvalidStateError(RV, state, indicator)
 
+            idx = indicator.get_state_index(RV, state)
+
+            if indicator.values[idx] == 1.0 and indicator.values.sum() == 1.0:
+                # This evidence has already been set.
+                continue
+
             indicator.set(1, **{RV: state}, inplace=True)
             indicator.set_complement(0, **{RV: state}, inplace=True)
+            self.invalidate_evidence(RV)
+
+    def invalidate_evidence(self, RV):
+        """Invalidate the messages that depend on the indicator for RV.
+
+        These are the messages on the edges directed *away* from the node
+        that holds the indicator.
+
+        Args:
+            RV (str): random variable whose evidence changed.
+        """
+        if RV in self._reduced:
+            self._update_reduced(RV)
+
+        if not self._compiled:
+            return
+
+        self._invalidate_messages_from(self.get_node_for_RV(RV))
+
+    def invalidate_cpt(self, RV):
+        """Invalidate the potential that holds RV's CPT.
+
+        The potential is recomputed from the node's (new) CPT on the next
+        propagation; only the messages directed away from it are invalidated.
+
+        Args:
+            RV (str): random variable whose CPT changed.
+        """
+        node = self.get_node_for_RV(RV)
+        node._potential_valid = False
+
+        if self._compiled:
+            self._invalidate_messages_from(node)
+
+    def _invalidate_messages_from(self, source):
+        """Invalidate the messages directed away from `source`.
 
-        self.invalidate_caches()
+        The traversal stops at messages that are already invalid: the
+        messages that depend on those are guaranteed to be invalid too.
+        Beliefs of all nodes are invalidated.
+        """
+        stack = [(source, None)]
+
+        while stack:
+            node, upstream = stack.pop()
+
+            for edge in node.get_downstream_edges(upstream):
+                receiver = edge.get_neighbor(node)
+
+                if edge._valid[receiver]:
+                    edge._valid[receiver] = False
+                    stack.append((receiver, edge))
+
+        for node in self.nodes.values():
+            node._belief_valid = False
 
     def invalidate_caches(self, hard=False):
         """Invalidate the nodes' caches."""
@@ -422,6 +893,12 @@ class TreeEdge(object):
         self._right = node2
         self._separator = None
 
+        # Set by _compile(); indexed by the receiving node.
+        self._scope = None
+        self._messages = {}
+        self._log_scales = {}
+        self._valid = {}
+
         node1.add_neighbor(self)
         node2.add_neighbor(self)
 
@@ -441,6 +918,29 @@ class TreeEdge(object):
 
         return self._separator
 
+    def _compile(self, states, order, reduced=None):
+        """Allocate message buffers (see JunctionTree.compile()).
+
+        Args:
+            states (dict): states, indexed by RV
+            order (dict): position of each RV in the network's scope
+            reduced (dict): variables to leave out
+        """
+        RVs = [RV for RV in self.separator if RV not in (reduced or {})]
+        self._scope = sorted(RVs, key=order.get)
+        shape = [len(states[RV]) for RV in self._scope]
+
+        # Messages, the log of the factors by which they (and the messages
+        # they depend on) were scaled down and their validity are indexed by
+        # the *receiving* node.
+        self._messages = {
+            self._left: np.empty(shape),
+            self._right: np.empty(shape),
+        }
+
+        self._log_scales = {self._left: 0.0, self._right: 0.0}
+        self._valid = {self._left: False, self._right: False}
+
     def get_neighbor(self, node):
         """Return the neighbor for `node`."""
         if node == self._left:
@@ -452,14 +952,12 @@ class TreeEdge(object):
         raise Exception('Supplied node is not connected to this edge!?')
 
     def recompute_separator(self):
-        """(re)compute the separator for this Edge."""
-        left_downstream = self._left.get_all_downstream_nodes(self)
-        right_downstream = self._right.get_all_downstream_nodes(self)
+        """(re)compute the separator for this Edge.
 
-        left_cluster = set.union(*[n.cluster for n in left_downstream])
-        right_cluster = set.union(*[n.cluster for n in right_downstream])
-
-        self._separator = set.intersection(left_cluster, right_cluster)
+        Because the tree satisfies the running intersection property, the
+        separator is the intersection of the clusters on either side.
+        """
+        self._separator = self._left.cluster & self._right.cluster
 
 # ------------------------------------------------------------------------------
 # TreeNode
@@ -467,28 +965,32 @@ class TreeEdge(object):
 class TreeNode(object):
     """Node in an elimination/junction tree."""
 
-    def __init__(self, cluster):
+    def __init__(self, cluster, tree=None):
         """Create a new node.
 
         Args:
             cluster (set): set of RV names (strings)
+            tree (JunctionTree): tree this node is part of.
         """
         self.cluster = cluster
         self.indicators = []
 
+        self._tree = tree
+
         # dict of bayesiannetwork.Node instances, indexed by RV
         self._bn_nodes = {}
         self.__factors = []
 
         self._edges = [] # list: TreeEdge
 
-        # cache
-        self._cache = None
-        self._factors_multiplied = None
-        self._factor_index_cache = None
-
-        # The cache is indexed by upstream node.
-        self.invalidate_cache() # sets self._cache = {}
+        # Set by _compile()
+        self._scope = None
+        self._potential = None
+        self._belief = None
+        self._log_scale = 0.0
+        self._programs = {}
+        self._potential_valid = False
+        self._belief_valid = False
 
     def __repr__(self):
         """x.__repr__() <==> repr(x)"""
@@ -518,28 +1020,6 @@ class TreeNode(object):
         """Return the joint distribution over this TreeNode's cluster."""
         return self.pull().normalize()
 
-    @property
-    def factors_multiplied(self):
-        """Compute the joint of the TreeNode's factors."""
-
-        # _factor_index_cache is a cache of the index for
-        # if self._factor_index_cache is None:
-        #     states = {}
-        #
-        #     for f in self.factors:
-        #         states.update(f.states)
-        #
-        #     self._variable_state_cache = states
-        #     self._factor_index_cache = Factor._index_from_states(states)
-
-        if self._factors_multiplied is None:
-            # print('I should happen only once!')
-            # full = Factor(1, idx=self._factor_index_cache)
-            factors = [*[n.cpt for n in self._bn_nodes.values()]]
-            self._factors_multiplied = reduce(mul, factors, 1)
-
-        return self._factors_multiplied
-
     def add_neighbor(self, edge):
         if edge not in self._edges:
             self._edges.append(edge)
@@ -548,74 +1028,303 @@ class TreeNode(object):
         """Add a (trivial) factor to this TreeNode."""
         self.__factors.append(factor)
 
-        for var in factor.vars:
+        # Separators only grow on edges towards neighbors that already
+        # contain a new variable.
+        for var in factor.vars - self.cluster:
             self.cluster.add(var)
 
-        for edge in self._edges:
-            edge.recompute_separator()
-
-        self._factors_multiplied = None
-        self._factor_index_cache = None
+            for edge in self._edges:
+                if edge._separator is not None:
+                    if var in edge.get_neighbor(self).cluster:
+                        edge._separator.add(var)
 
     def add_bn_node(self, node):
         """Add a Bayesian Network node."""
         self._bn_nodes[node.RV] = node
 
     def invalidate_cache(self, hard=False):
-        """Invalidate the message cache."""
-        self._cache = {}
+        """Invalidate the messages towards this node and its belief.
+
+        Args:
+            hard (bool): also invalidate the node's potential; required when
+                the CPTs have changed.
+        """
+        for edge in self._edges:
+            edge._valid[self] = False
+
+        self._belief_valid = False
 
         if hard:
-            self._factors_multiplied = None
+            self._potential_valid = False
+
+    def _compile(self, states, order, reduced=None):
+        """Allocate buffers for potential and belief.
+
+        Args:
+            states (dict): states, indexed by RV
+            order (dict): position of each RV in the network's scope
+            reduced (dict): variables to leave out
+        """
+        RVs = [RV for RV in self.cluster if RV not in (reduced or {})]
+        self._scope = sorted(RVs, key=order.get)
+        self._states = {RV: states[RV] for RV in self._scope}
+        self._signatures = {RV: tuple(states[RV]) for RV in self.cluster}
+        self._labels = {RV: label for label, RV in enumerate(self._scope)}
+
+        shape = [len(states[RV]) for RV in self._scope]
+        self._potential = np.empty(shape)
+        self._belief = np.empty(shape)
+        self._log_scale = 0.0
+
+        self._potential_valid = False
+        self._belief_valid = False
+
+    def _compile_programs(self):
+        """Precompute the einsum operands for sending messages.
+
+        A program is created for every incident edge (the message sent
+        across that edge) and for `None` (this node's belief). Operands are
+        references to the potential, the indicators' values and the message
+        buffers, which are all updated in place. Each program also lists the
+        edges of its incoming messages, whose log scales it accumulates.
+        """
+        all_labels = list(range(len(self._scope)))
+
+        self._programs = {}
+
+        for upstream in [None, *self._edges]:
+            args = [self._potential, all_labels]
+
+            # Multiply in the indicators of the variables in the scope;
+            # reduced variables are skipped because their evidence is
+            # already sliced into the potential.
+            for indicator in self.indicators:
+                RV = indicator.scope[0]
+
+                if RV in self._labels:
+                    args += [indicator.values, [self._labels[RV]]]
+
+            incoming = self.get_downstream_edges(upstream)
+
+            for edge in incoming:
+                labels = [self._labels[RV] for RV in edge._scope]
+                args += [edge._messages[self], labels]
+
+            if upstream is None:
+                args.append(all_labels)
+                out = self._belief
+            else:
+                args.append([self._labels[RV] for RV in upstream._scope])
+                out = upstream._messages[upstream.get_neighbor(self)]
+
+            self._programs[upstream] = (args, out, incoming)
+
+    def _compute_potential(self):
+        """(Re)compute the product of the assigned CPTs in place.
+
+        The axes of reduced variables are sliced out of the CPTs.
+        """
+        reduced = self._tree._reduced
+        covered = set()
+        args = []
+
+        for bn_node in self._bn_nodes.values():
+            cpt = bn_node.cpt
+            values = _aligned_values(cpt, self._signatures)
+
+            if any(RV in reduced for RV in cpt.scope):
+                values = values[tuple(reduced.get(RV, slice(None)) for RV in cpt.scope)]
+
+            args.append(values)
+            args.append([self._labels[RV] for RV in cpt.scope if RV not in reduced])
+            covered.update(cpt.scope)
+
+        # Variables that are not covered by a CPT have a trivial factor.
+        for RV in self._scope:
+            if RV not in covered:
+                args += [np.ones(len(self._states[RV])), [self._labels[RV]]]
+
+        args.append(list(range(len(self._scope))))
+        np.einsum(*args, out=self._potential)
+
+        self._potential_valid = True
+
+    def _run(self, upstream=None):
+        """Execute the program for `upstream`.
+
+        This computes the message across `upstream` or, if upstream is None,
+        this node's belief. All messages towards this node (except the one
+        across `upstream`) should be valid.
+
+        The result is rescaled (in place) to sum to 1, which prevents
+        underflow in deep trees. The log of the scaling factor, plus those of
+        the incoming messages, is kept with the message (or in
+        `self._log_scale` for the belief); for the belief, this is log P(e).
+        """
+        if not self._potential_valid:
+            self._compute_potential()
+
+        args, out, incoming = self._programs[upstream]
+        np.einsum(*args, out=out)
+
+        total = out.sum()
+
+        if total > 0:
+            out /= total
+
+        with np.errstate(divide='ignore'):
+            log_scale = np.log(total)
+
+        for edge in incoming:
+            log_scale += edge._log_scales[self]
+
+        if upstream is None:
+            self._log_scale = log_scale
+        else:
+            upstream._log_scales[upstream.get_neighbor(self)] = log_scale
+
+        return out
+
+    def _run_batch(self, upstream, messages, evidence, scaled=False):
+        """Compute a message (or belief) for a batch of evidence.
+
+        Uses the same labels as the compiled programs; the batch axis gets
+        a label of its own. The result only has a batch axis if one of the
+        operands has one.
+
+        Args:
+            upstream (TreeEdge): edge to send the message across or None to
+                compute this node's belief.
+            messages (dict): (values, batched, log_scale) tuples, indexed by
+                (TreeEdge, receiving TreeNode).
+            evidence (dict): (N, |states|) likelihoods, indexed by RV.
+            scaled (bool): normalize the result (per configuration).
+
+        Returns:
+            tuple (numpy.ndarray, bool, numpy.ndarray): values, whether
+            they're batched and the log of the factor by which the values
+            were scaled down (0 if `scaled` is False).
+        """
+        if not self._potential_valid:
+            self._compute_potential()
+
+        B = len(self._scope)
+        args = [self._potential, list(range(B))]
+        batched = False
+
+        for indicator in self.indicators:
+            RV = indicator.scope[0]
+
+            if RV in evidence:
+                args += [evidence[RV], [B, self._labels[RV]]]
+                batched = True
+
+        log_scale = 0
+
+        for edge in self.get_downstream_edges(upstream):
+            values, is_batched, message_scale = messages[(edge, self)]
+            labels = [self._labels[RV] for RV in edge._scope]
+            args += [values, [B, *labels] if is_batched else labels]
+            batched = batched or is_batched
+            log_scale = log_scale + message_scale
+
+        if upstream is None:
+            output = list(range(B))
+        else:
+            output = [self._labels[RV] for RV in upstream._scope]
+
+        args.append([B, *output] if batched else output)
+        values = np.einsum(*args)
+
+        if scaled:
+            axes = tuple(range(1 if batched else 0, values.ndim))
+            total = values.sum(axis=axes, keepdims=True)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = np.where(total > 0, values / total, 0)
+                log_scale = log_scale + np.log(total.reshape(-1 if batched else ()))
+
+        return values, batched, log_scale
+
+    def _collect(self, upstream=None):
+        """Make sure all messages towards this node are valid.
+
+        Invalid messages are found with an (iterative) depth first
+        traversal; they are subsequently sent leaves first.
+
+        Args:
+            upstream (TreeEdge): edge to exclude.
+        """
+        pending = []
+        stack = [(self, upstream)]
+
+        while stack:
+            node, edge_to_parent = stack.pop()
+
+            for edge in node.get_downstream_edges(edge_to_parent):
+                if not edge._valid[node]:
+                    sender = edge.get_neighbor(node)
+                    pending.append((sender, edge))
+                    stack.append((sender, edge))
+
+        for sender, edge in reversed(pending):
+            sender._run(edge)
+            edge._valid[edge.get_neighbor(sender)] = True
+
+    def _ensure_belief(self):
+        """Make sure this node's belief is valid and return it.
+
+        Returns:
+            numpy.ndarray: normalized belief over the node's cluster (all
+            zeros if the evidence is impossible).
+        """
+        if not self._belief_valid:
+            self._collect()
+            self._run()
+            self._belief_valid = True
+
+        return self._belief
 
     def get_downstream_edges(self, upstream=None):
         return [e for e in self._edges if e is not upstream]
 
     def get_all_downstream_nodes(self, upstream):
-        edges = self.get_downstream_edges(upstream)
-
+        """Return this node and all nodes downstream of `upstream`."""
         downstream = []
+        stack = [(self, upstream)]
 
-        for edge in edges:
-            node = edge.get_neighbor(self)
-            downstream.extend(node.get_all_downstream_nodes(edge))
+        while stack:
+            node, edge = stack.pop()
+            downstream.append(node)
 
-        return [self, ] + downstream
+            for e in node.get_downstream_edges(edge):
+                stack.append((e.get_neighbor(node), e))
+
+        return downstream
 
     def pull(self, upstream=None):
         """Trigger pulling of messages towards this node.
 
         This entails:
-         - calling pull() on each of the downstream edges
-         - multiplying the results into this factor
+         - making sure all messages from the downstream edges are valid
+         - multiplying them into this node's potential and indicators
          - if an upstream edge is specified, the result is projected onto the
            upstream edge's separator.
 
+        Messages are computed in place by the compiled tree; a Factor is only
+        created for the result.
+
         :return: factor.Factor
         """
-        # mulf = lambda x, y: mul(x, y, False)
-
-        downstream_edges = self.get_downstream_edges(upstream)
-        result = self.factors_multiplied
-        result = reduce(mul, [result, *self.indicators])
-
-        if downstream_edges:
-            downstream_results = []
-
-            for e in downstream_edges:
-                if e not in self._cache:
-                    n = e.get_neighbor(self)
-                    self._cache[e] = n.pull(e)
-
-                downstream_results.append(self._cache[e])
-
-            # result = reduce(mul, downstream_results + [result])
-            result = reduce(mul, downstream_results + [result])
+        self._tree.ensure_compiled()
+        self._collect(upstream)
 
         if upstream:
-            return result.project(upstream.separator)
+            values = self._run(upstream)
+            states = {RV: self._states[RV] for RV in upstream._scope}
+            return Factor(values, states)
 
-        return result
+        return Factor(self._ensure_belief(), self._states)
 
     def project(self, RV, normalize=True):
         """Trigger a pull and project the result onto RV.
@@ -631,10 +1340,20 @@ class TreeNode(object):
         Returns:
             ...
         """
-        result = self.pull().project(RV)
+        self._tree.ensure_compiled()
+
+        Q = {RV} if isinstance(RV, str) else set(RV)
+        keep = [RV for RV in self._scope if RV in Q]
+
+        # Sum out the remaining axes of the belief.
+        belief = self._ensure_belief()
+        axes = tuple(idx for idx, RV in enumerate(self._scope) if RV not in Q)
+        values = belief.sum(axis=axes)
 
         if normalize:
-            return result.normalize()
+            values = values / values.sum()
+
+        reduced = [RV for RV in self._tree._bn.scope if RV in Q and RV not in keep]
 
-        return result
+        return self._tree._expand_reduced(values, keep, reduced)
 
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Query: a pre-compiled query on a BayesianNetwork."""
+import numpy as np
+
+from .cpt import CPT
+from . import error
+
+import logging
+log = logging.getLogger('thomas.query')
+
+
+# ------------------------------------------------------------------------------
+# Query
+# ------------------------------------------------------------------------------
+class Query(object):
+    """A query that can be executed repeatedly with different evidence.
+
+    Parsing the query string, looking up the variables in the junction tree
+    and mapping states to indices happens once. Executing the query sets the
+    evidence directly on the tree's indicators and reads the result off the
+    belief of the cluster that contains the query variables (or, if no
+    single cluster does, off the subtree that connects them).
+
+    The query P(I,G=g1|D,L=l0) would imply:
+        qd = ['I']
+        qv = {'G': 'g1'}
+        ed = ['D']
+        ev = {'L': 'l0'}
+
+    Example:
+        >>> query = bn.compile_query('I|L=l0')
+        >>> query()           # equivalent to bn.P('I|L=l0')
+        >>> query(L='l1')     # equivalent to bn.P('I|L=l1')
+    """
+
+    def __init__(self, bn, qd, qv, ed, ev):
+        """Initialize a new Query.
+
+        Args:
+            bn (BayesianNetwork): network to query.
+            qd (list): query distributions: RVs to query
+            qv (dict): query values: RV-values to extract
+            ed (list): evidence distributions: coniditioning RVs to include
+            ev (dict): evidence values: default values to set as evidence.
+        """
+        self._bn = bn
+        self.qd = list(qd)
+        self.qv = dict(qv)
+        self.ed = list(ed)
+        self.ev = dict(ev)
+
+        # Axes of the joint: the query values are indexed out, the evidence
+        # distributions are conditioned on.
+        self._scope = list(dict.fromkeys(self.qd + list(self.qv) + self.ed))
+
+        missing = set(self._scope) - set(bn.nodes)
+
+        if missing:
+            raise error.NotInScopeError(missing, list(bn.nodes))
+
+        self._states = {RV: bn.nodes[RV].states for RV in self._scope}
+
+        # Index to extract the query values; slices for the other axes.
+        index = []
+
+        for RV in self._scope:
+            if RV in self.qv:
+                states = self._states[RV]
+
+                if self.qv[RV] not in states:
+                    raise error.InvalidStateError(RV, self.qv[RV])
+
+                index.append(states.index(self.qv[RV]))
+            else:
+                index.append(slice(None))
+
+        self._index = tuple(index)
+
+        # Axes to sum out when conditioning on the evidence distributions.
+        self._marginal_axes = tuple(
+            idx for idx, RV in enumerate(self._scope) if RV not in self.ed
+        )
+
+        # Set by _resolve()
+        self._jt = None
+        self._node = None
+        self._node_scope = None
+        self._labels = None
+        self._evidence = {}
+
+        # Validate the default evidence.
+        self._resolve()
+
+        for RV, state in self.ev.items():
+            self._get_state_index(RV, state)
+
+    def __repr__(self):
+        """x.__repr__() <==> repr(x)"""
+        query_str = self._bn.create_query_string(self.qd, self.qv, self.ed, self.ev)
+        return f"<Query P({query_str})>"
+
+    def __call__(self, **evidence):
+        """Execute the query.
+
+        Kwargs:
+            evidence (dict): states, indexed by RV; overrides the evidence
+                values the query was compiled with. Evidence on other
+                variables in the network is retracted.
+
+        Returns:
+            CPT or numpy.ndarray (iff query values were specified); the same
+            as `BayesianNetwork.compute_posterior()`.
+        """
+        if evidence:
+            evidence = {**self.ev, **evidence}
+        else:
+            evidence = self.ev
+
+        jt = self._bn.junction_tree
+
+        if jt is not self._jt:
+            self._resolve()
+
+        self._set_evidence(evidence)
+
+        if jt._reduced:
+            jt.expand_evidence(*[RV for RV in self._scope if RV in jt._reduced])
+
+        jt.ensure_compiled()
+
+        if self._node is None:
+            values = jt.compute_joint(self._scope).values
+        else:
+            if self._node._scope is not self._node_scope:
+                self._compute_labels()
+
+            belief = self._node._ensure_belief()
+            values = np.einsum(belief, *self._labels)
+
+        values = values / values.sum()
+
+        if self.ed:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = values / values.sum(axis=self._marginal_axes, keepdims=True)
+
+            values[np.isnan(values)] = 0
+
+        if self.qv:
+            return np.array(values[self._index]).reshape(-1)
+
+        return CPT(values, states=self._states, conditioned=self.qd)
+
+    def _resolve(self):
+        """Look up the cluster that contains the query's variables."""
+        jt = self._bn.junction_tree
+
+        self._jt = jt
+        self._node = jt.get_node_for_set(set(self._scope))
+        self._node_scope = None
+        self._evidence = {}
+
+        if self._node is None:
+            log.debug(f'{self!r} is answered using out-of-clique inference')
+
+    def _compute_labels(self):
+        """Compute the einsum labels to project the node's belief."""
+        node = self._node
+        self._node_scope = node._scope
+        self._labels = (
+            list(range(len(node._scope))),
+            [node._labels[RV] for RV in self._scope],
+        )
+
+    def _get_state_index(self, RV, state):
+        """Return the indicator for RV and the index of state."""
+        if RV not in self._evidence:
+            if RV not in self._jt.indicators:
+                raise error.NotInScopeError(RV, list(self._jt.indicators))
+
+            indicator = self._jt.indicators[RV]
+            states = indicator.states[RV]
+            self._evidence[RV] = (indicator, dict(zip(states, range(len(states)))))
+
+        indicator, index = self._evidence[RV]
+
+        if state not in index:
+            raise error.InvalidStateError(RV, state, indicator)
+
+        return indicator, index[state]
+
+    def _set_evidence(self, evidence):
+        """Replace the evidence on the junction tree.
+
+        Equivalent to `JunctionTree.replace_evidence()`, but states are
+        mapped to indices using the lookup tables built by this query.
+        """
+        jt = self._jt
+        jt.reset_evidence([RV for RV in jt.indicators if RV not in evidence])
+
+        for RV, state in evidence.items():
+            indicator, idx = self._get_state_index(RV, state)
+            values = indicator.values
+
+            if values[idx] == 1.0 and values.sum() == 1.0:
+                # This evidence has already been set.
+                continue
+
+            values[:] = 0
+            values[idx] = 1
+            jt.invalidate_evidence(RV)
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""Sampling from a BayesianNetwork.
+
+Samples are drawn in topological order: each node's states are drawn for all
+samples at once by looking up the cumulative distribution in its CPT for the
+parents' sampled states. Samples are represented as integer codes (indices
+into the nodes' states), indexed by RV, like the output of `encode_data()`.
+"""
+import numpy as np
+import pandas as pd
+
+from .factor import _aligned_values
+from . import error
+
+import logging
+log = logging.getLogger('thomas.sampling')
+
+
+# ------------------------------------------------------------------------------
+# Helpers
+# ------------------------------------------------------------------------------
+def topological_order(bn):
+    """Return the network's variables, ordered parents before children."""
+    order = []
+    placed = set()
+    remaining = list(bn.nodes)
+
+    while remaining:
+        pending = []
+
+        for RV in remaining:
+            if all(p.RV in placed for p in bn.nodes[RV].parents):
+                order.append(RV)
+                placed.add(RV)
+            else:
+                pending.append(RV)
+
+        if len(pending) == len(remaining):
+            raise ValueError(f'Network contains a cycle: {pending}')
+
+        remaining = pending
+
+    return order
+
+def get_sampling_tables(bn):
+    """Prepare the CPTs for sampling.
+
+    Args:
+        bn (BayesianNetwork): network
+
+    Returns:
+        list of (RV, parents, shape, values, cumulative) tuples in
+        topological order. `shape` holds the parents' number of states,
+        `values` the CPT with the parents' configurations along the first
+        axis and the node's states along the second and `cumulative` its
+        cumulative sums along the second axis. States are in the order of
+        the nodes' states (which may differ from the order in the CPTs).
+    """
+    signatures = {RV: tuple(states) for RV, states in bn.states.items()}
+    tables = []
+
+    for RV in topological_order(bn):
+        cpt = bn.nodes[RV].cpt
+        aligned = _aligned_values(cpt, signatures)
+
+        # The conditioned variable is always the last axis of a CPT.
+        parents = cpt.scope[:-1]
+        shape = aligned.shape[:-1]
+        values = aligned.reshape(-1, aligned.shape[-1])
+        tables.append((RV, parents, shape, values, np.cumsum(values, axis=1)))
+
+    return tables
+
+def get_configurations(codes, parents, shape):
+    """Return the row in a sampling table for each sample.
+
+    Args:
+        codes (dict): sampled codes, indexed by RV.
+        parents (list): the node's parents (in the order of the CPT).
+        shape (tuple): number of states for each parent.
+
+    Returns:
+        numpy.ndarray of ints, or 0 if the node does not have parents.
+    """
+    if not parents:
+        return 0
+
+    return np.ravel_multi_index([codes[p] for p in parents], shape)
+
+def draw(cumulative, config, rng, size):
+    """Draw states from cumulative distributions.
+
+    Args:
+        cumulative (numpy.ndarray): cumulative sums of (possibly
+            unnormalized) distributions; one per row.
+        config (numpy.ndarray): row to draw from for each sample.
+        rng (numpy.random.Generator): random number generator.
+        size (int): number of samples.
+
+    Returns:
+        numpy.ndarray of ints: the sampled states.
+    """
+    u = rng.random(size) * cumulative[config, -1]
+    codes = np.zeros(size, dtype=int)
+
+    # The sampled state is the number of cumulative values <= u. Looping over
+    # the states keeps memory use linear in the number of samples.
+    for j in range(cumulative.shape[1] - 1):
+        codes += cumulative[config, j] <= u
+
+    return codes
+
+def encode_evidence(bn, evidence):
+    """Map evidence states to codes.
+
+    Args:
+        bn (BayesianNetwork): network
+        evidence (dict): states, indexed by RV.
+
+    Returns:
+        dict of ints, indexed by RV. Codes are indices into the nodes'
+        states, like the columns of the sampling tables.
+    """
+    codes = {}
+
+    for RV, state in (evidence or {}).items():
+        if RV not in bn.nodes:
+            raise error.NotInScopeError(RV, list(bn.nodes))
+
+        states = bn.nodes[RV].states
+
+        if state not in states:
+            raise error.InvalidStateError(RV, state)
+
+        codes[RV] = states.index(state)
+
+    return codes
+
+def as_dataframe(bn, codes):
+    """Convert sampled codes to a DataFrame with categorical columns."""
+    return pd.DataFrame({
+        RV: pd.Categorical.from_codes(codes[RV], categories=node.states)
+        for RV, node in bn.nodes.items()
+    })
+
+
+# ------------------------------------------------------------------------------
+# Forward sampling
+# ------------------------------------------------------------------------------
+def forward_sample(bn, n, rng, evidence=None, tables=None):
+    """Draw samples using ancestral sampling.
+
+    Samples that are inconsistent with the evidence are rejected as soon as
+    an observed variable has been sampled, so the remaining variables are
+    only sampled for the accepted samples.
+
+    Args:
+        bn (BayesianNetwork): network to sample from.
+        n (int): number of samples to draw.
+        rng (numpy.random.Generator): random number generator.
+        evidence (dict): codes, indexed by RV (see `encode_evidence()`).
+        tables (list): sampling tables as returned by
+            `get_sampling_tables()`. Computed if not provided.
+
+    Returns:
+        dict of numpy.ndarray of ints, indexed by RV. Contains at most `n`
+        (accepted) samples.
+    """
+    evidence = evidence or {}
+    tables = tables or get_sampling_tables(bn)
+    codes = {}
+    size = n
+
+    for RV, parents, shape, _, cumulative in tables:
+        config = get_configurations(codes, parents, shape)
+        codes[RV] = draw(cumulative, config, rng, size)
+
+        if RV in evidence:
+            accepted = codes[RV] == evidence[RV]
+            codes = {v: c[accepted] for v, c in codes.items()}
+            size = len(codes[RV])
+
+    return codes
+
+def sample(bn, n, seed=None, evidence=None, max_draws=None):
+    """Draw samples from a BayesianNetwork.
+
+    Without evidence, samples are drawn using ancestral sampling. With
+    evidence, samples that are inconsistent with the evidence are rejected
+    and sampling continues until `n` samples have been accepted.
+
+    Args:
+        bn (BayesianNetwork): network to sample from.
+        n (int): number of samples.
+        seed (int, numpy.random.Generator): seed for the random number
+            generator.
+        evidence (dict): states, indexed by RV.
+        max_draws (int): maximum number of samples to draw when rejecting
+            samples. Defaults to 1000 * n.
+
+    Returns:
+        pandas.DataFrame with a categorical column for each variable.
+
+    Raises:
+        SamplingError: if fewer than `n` samples were accepted within
+            `max_draws` draws.
+    """
+    rng = np.random.default_rng(seed)
+    evidence = encode_evidence(bn, evidence)
+    tables = get_sampling_tables(bn)
+
+    if not evidence:
+        return as_dataframe(bn, forward_sample(bn, n, rng, tables=tables))
+
+    max_draws = max_draws or 1000 * n
+    batches = []
+    accepted = 0
+    draws = 0
+
+    while accepted < n:
+        if draws >= max_draws:
+            raise error.SamplingError(
+                f'Accepted {accepted} of {n} samples after {draws} draws; '
+                f'the evidence is (nearly) impossible.'
+            )
+
+        # Estimate the number of draws required from the acceptance rate.
+        rate = accepted / draws if accepted else 1 / max(draws, 1)
+        size = int(np.ceil(1.1 * (n - accepted) / rate))
+        size = max(1, min(size, max_draws - draws, 10 * n))
+
+        codes = forward_sample(bn, size, rng, evidence, tables)
+        batches.append(codes)
+        accepted += len(codes[tables[0][0]])
+        draws += size
+
+    log.debug(f'Accepted {accepted} of {draws} samples')
+
+    codes = {
+        RV: np.concatenate([batch[RV] for batch in batches])[:n]
+        for RV in bn.nodes
+    }
+
+    return as_dataframe(bn, codes)
+
+
+# ------------------------------------------------------------------------------
+# Approximate inference
+# ------------------------------------------------------------------------------
+def get_proposal_tables(bn, evidence, tables, epsilon=0.05):
+    """Compute an importance sampling proposal by pre-propagating evidence.
+
+    A single top-down pass computes (approximate) priors and a single
+    bottom-up pass collects the evidence from each node's descendants as
+    likelihoods (lambda). These passes are exact for polytrees. The proposal
+    for a node is its CPT multiplied by its lambda, mixed with the CPT so
+    every state that is possible under the CPT can still be sampled.
+
+    Args:
+        bn (BayesianNetwork): network
+        evidence (dict): codes, indexed by RV.
+        tables (list): sampling tables (see `get_sampling_tables()`).
+        epsilon (float): weight of the CPT in the mixture.
+
+    Returns:
+        dict of (values, cumulative) tuples for the unobserved variables,
+        indexed by RV; laid out like the sampling tables.
+    """
+    def normalize(values):
+        total = values.sum(axis=-1, keepdims=True)
+        return np.divide(values, total, out=np.zeros_like(values), where=total > 0)
+
+    # Top-down: priors, ignoring the evidence.
+    prior = {}
+
+    for RV, parents, shape, values, _ in tables:
+        joint = normalize(values).reshape(*shape, values.shape[1])
+        args = [joint, list(range(len(parents) + 1))]
+
+        for idx, parent in enumerate(parents):
+            args += [prior[parent], [idx]]
+
+        prior[RV] = normalize(np.einsum(*args, [len(parents)]))
+
+    # Bottom-up: likelihoods of the evidence.
+    likelihood = {RV: np.ones(values.shape[1]) for RV, _, _, values, _ in tables}
+
+    for RV, parents, shape, values, _ in reversed(tables):
+        if RV in evidence:
+            indicator = np.zeros(values.shape[1])
+            indicator[evidence[RV]] = 1
+            likelihood[RV] = likelihood[RV] * indicator
+
+        if likelihood[RV].sum() == 0:
+            # Conflicting evidence; don't let it affect the proposal.
+            likelihood[RV] = np.ones(values.shape[1])
+
+        likelihood[RV] = normalize(likelihood[RV])
+        joint = normalize(values).reshape(*shape, values.shape[1])
+
+        for idx, parent in enumerate(parents):
+            args = [joint, list(range(len(parents) + 1))]
+            args += [likelihood[RV], [len(parents)]]
+
+            for j, other in enumerate(parents):
+                if j != idx:
+                    args += [prior[other], [j]]
+
+            message = normalize(np.einsum(*args, [idx]))
+
+            if message.sum() > 0:
+                likelihood[parent] = likelihood[parent] * message
+
+    proposal = {}
+
+    for RV, parents, shape, values, _ in tables:
+        if RV in evidence:
+            continue
+
+        cpt = normalize(values)
+        q = normalize(cpt * likelihood[RV])
+
+        # Rows without support (e.g. conflicting evidence) fall back to the CPT.
+        empty = q.sum(axis=1) == 0
+        q[empty] = cpt[empty]
+        q = (1 - epsilon) * q + epsilon * cpt
+
+        proposal[RV] = (q, np.cumsum(q, axis=1))
+
+    return proposal
+
+def weighted_sample(bn, n, rng, evidence, tables, proposal=None):
+    """Draw samples with the evidence clamped, weighted by P(x, e) / Q(x).
+
+    Without a proposal, the unobserved variables are sampled from their CPTs
+    (likelihood weighting) and the weights reduce to P(e | parents).
+
+    Args:
+        bn (BayesianNetwork): network to sample from.
+        n (int): number of samples to draw.
+        rng (numpy.random.Generator): random number generator.
+        evidence (dict): codes, indexed by RV (see `encode_evidence()`).
+        tables (list): sampling tables (see `get_sampling_tables()`).
+        proposal (dict): proposal tables (see `get_proposal_tables()`).
+
+    Returns:
+        tuple (dict, numpy.ndarray): the sampled codes, indexed by RV, and
+        the log of the weights.
+    """
+    codes = {}
+    log_weights = np.zeros(n)
+
+    with np.errstate(divide='ignore'):
+        for RV, parents, shape, values, cumulative in tables:
+            config = get_configurations(codes, parents, shape)
+
+            if RV in evidence:
+                codes[RV] = np.full(n, evidence[RV])
+                log_weights += np.log(values[config, evidence[RV]])
+                continue
+
+            if proposal is None:
+                codes[RV] = draw(cumulative, config, rng, n)
+
+                # Unnormalized CPTs scale the joint.
+                if not np.allclose(cumulative[:, -1], 1):
+                    log_weights += np.log(cumulative[config, -1])
+
+                continue
+
+            q, q_cumulative = proposal[RV]
+            codes[RV] = draw(q_cumulative, config, rng, n)
+            log_weights += np.log(values[config, codes[RV]])
+            log_weights -= np.log(q[config, codes[RV]])
+
+    return codes, log_weights
+
+def summarize_weights(S1, S2, axes):
+    """Compute self-normalized estimates and their standard errors.
+
+    Args:
+        S1 (numpy.ndarray): sum of the weights, per cell of the joint.
+        S2 (numpy.ndarray): sum of the squared weights, per cell.
+        axes (tuple): axes to normalize over; the remaining axes are
+            conditioned on.
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray): the estimates and their
+        (delta method) standard errors. Both are NaN for configurations of
+        the conditioning variables that were never sampled.
+    """
+    total = S1.sum(axis=axes, keepdims=True)
+    total_sq = S2.sum(axis=axes, keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        P = S1 / total
+        variance = (S2 * (1 - 2 * P) + P ** 2 * total_sq) / total ** 2
+
+    return P, np.sqrt(np.maximum(variance, 0))
+
+def estimate_posterior(bn, scope, ed, evidence, method='lw', samples=100000,
+                       seed=None, tol=None, batchsize=10000):
+    """Estimate a posterior distribution using weighted samples.
+
+    Samples are drawn in batches until the budget is spent or, if `tol` is
+    given, until the largest standard error is at most `tol`.
+
+    Args:
+        bn (BayesianNetwork): network
+        scope (list): variables of the joint distribution to estimate.
+        ed (list): variables in `scope` to condition on.
+        evidence (dict): states, indexed by RV.
+        method (str): 'lw' for likelihood weighting or 'is' for importance
+            sampling with an evidence pre-propagated proposal.
+        samples (int): maximum number of samples (budget).
+        seed (int, numpy.random.Generator): seed for the random number
+            generator.
+        tol (float): stop as soon as all standard errors are at most `tol`.
+        batchsize (int): number of samples per batch.
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray): the estimates and their standard
+        errors; axes in the order of `scope`.
+
+    Raises:
+        SamplingError: if none of the samples is consistent with the evidence.
+    """
+    if method not in ('lw', 'is'):
+        raise ValueError(f"Unknown sampling method '{method}'")
+
+    rng = np.random.default_rng(seed)
+    evidence = encode_evidence(bn, evidence)
+    tables = get_sampling_tables(bn)
+    proposal = None
+
+    if method == 'is':
+        proposal = get_proposal_tables(bn, evidence, tables)
+
+    shape = tuple(len(bn.nodes[RV].states) for RV in scope)
+    axes = tuple(idx for idx, RV in enumerate(scope) if RV not in ed)
+    size = int(np.prod(shape))
+
+    # Sums of the (squared) weights relative to exp(offset), which keeps
+    # track of the largest weight so far to prevent underflow.
+    S1 = np.zeros(size)
+    S2 = np.zeros(size)
+    offset = -np.inf
+    drawn = 0
+
+    while drawn < samples:
+        n = min(batchsize, samples - drawn)
+        codes, log_weights = weighted_sample(bn, n, rng, evidence, tables, proposal)
+        drawn += n
+
+        largest = log_weights.max()
+
+        if largest == -np.inf:
+            continue
+
+        if largest > offset:
+            if offset > -np.inf:
+                S1 *= np.exp(offset - largest)
+                S2 *= np.exp(2 * (offset - largest))
+
+            offset = largest
+
+        weights = np.exp(log_weights - offset)
+
+        if scope:
+            cells = np.ravel_multi_index([codes[RV] for RV in scope], shape)
+        else:
+            cells = np.zeros(n, dtype=int)
+
+        S1 += np.bincount(cells, weights=weights, minlength=size)
+        S2 += np.bincount(cells, weights=weights ** 2, minlength=size)
+
+        if tol is not None:
+            _, stderr = summarize_weights(S1.reshape(shape), S2.reshape(shape), axes)
+
+            if not np.isnan(stderr).any() and stderr.max() <= tol:
+                break
+
+    if offset == -np.inf:
+        raise error.SamplingError(
+            f'None of the {drawn} samples is consistent with the evidence.'
+        )
+
+    log.debug(f'Effective sample size: {S1.sum() ** 2 / S2.sum():.0f} of {drawn}')
+
+    return summarize_weights(S1.reshape(shape), S2.reshape(shape), axes)